@@ -0,0 +1,106 @@
+from typing import Any, Optional
+from twitchio.ext import commands
+from Core.ChannelConfig import ChannelSettings
+from Core.CommandString import ArgumentError, arguments
+from Core.MessageFunctions import send_message
+
+from Cogs.OllieBotCog import OllieBotCog
+
+__all__ = ("ConfigHandler",)
+
+class ConfigHandler(OllieBotCog):
+    "Class for handling moderators' changes to the modes and variables of the bot's modules in their channel."
+    
+    @classmethod
+    def module_name(cls) -> str:
+        return "config"
+    
+    @classmethod
+    def module_modes(cls) -> dict[str, bool]:
+        return {}
+    
+    def __get_module(self, module_name: str) -> Optional[OllieBotCog]:
+        "Get the cog of the module with the given name, loading it if it is not loaded, or None if there is no such module."
+        cog_name: Optional[str] = self.bot.cog_loader.find_module(module_name.lower())
+        if cog_name is None:
+            return None
+        cog = self.bot.cog_loader.load(cog_name)
+        return cog if isinstance(cog, OllieBotCog) else None
+    
+    @commands.command(name="modes")
+    @arguments("module")
+    async def list_modes(self, context: commands.Context) -> None:
+        "List the modes and variables of a module in this channel."
+        if not context.author.is_mod:
+            return
+        sender: str = context.author.name
+        try:
+            namespace: dict[str, Any] = self.parse_arguments(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?modes <module>")
+            return
+        module: Optional[OllieBotCog] = self.__get_module(namespace["module"])
+        if module is None:
+            send_message(context, f"{sender} : Unknown module \"{namespace['module']}\".")
+            return
+        settings: ChannelSettings = module.settings(context.channel.name)
+        send_message(context, f"{sender} : Modes for {module.module_name()} :: "
+                            + (", ".join(f"{mode}: {'on' if enabled else 'off'}" for mode, enabled in settings.modes.items()) or "none")
+                            + (" | Variables :: " + ", ".join(f"{var_name}: {value}" for var_name, value in settings.variables.items())
+                               if settings.variables else ""))
+    
+    @commands.command()
+    @arguments("module", "mode", "state?")
+    async def mode(self, context: commands.Context) -> None:
+        "Enable or disable a mode of a module in this channel, toggling it if no state is given."
+        if not context.author.is_mod:
+            return
+        sender: str = context.author.name
+        try:
+            namespace: dict[str, Any] = self.parse_arguments(context)
+            enable: Optional[bool] = None
+            if namespace["state"] is not None:
+                enable = namespace["state"].lower() in ("on", "enable", "true")
+                if not enable and namespace["state"].lower() not in ("off", "disable", "false"):
+                    raise ArgumentError(f"Unknown state \"{namespace['state']}\", must be on or off.")
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?mode <module> <mode> [on|off]")
+            return
+        module: Optional[OllieBotCog] = self.__get_module(namespace["module"])
+        if module is None:
+            send_message(context, f"{sender} : Unknown module \"{namespace['module']}\".")
+            return
+        state: Optional[bool] = await module.set_mode(context.channel.name, namespace["mode"].lower(), enable)
+        if state is None:
+            send_message(context, f"{sender} : Unknown mode, must be one of; {', '.join(await module.modes())}")
+        else: send_message(context, f"{sender} : {module.module_name()} mode {namespace['mode'].lower()} is now {'on' if state else 'off'}.")
+    
+    @commands.command()
+    @arguments("module", "name", "value?")
+    async def var(self, context: commands.Context) -> None:
+        "Get the value of a variable of a module in this channel, or set it if a value is given."
+        if not context.author.is_mod:
+            return
+        sender: str = context.author.name
+        try:
+            namespace: dict[str, Any] = self.parse_arguments(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?var <module> <name> [value]")
+            return
+        module: Optional[OllieBotCog] = self.__get_module(namespace["module"])
+        if module is None:
+            send_message(context, f"{sender} : Unknown module \"{namespace['module']}\".")
+            return
+        var_name: str = namespace["name"].lower()
+        try:
+            if namespace["value"] is not None:
+                await module.set_var(context.channel.name, var_name, namespace["value"])
+            value: Any = await module.get_var(context.channel.name, var_name)
+        except KeyError:
+            send_message(context, f"{sender} : Unknown variable, must be one of; "
+                                + (", ".join(var_name for var_name, _ in await module.accepts_get_vars()) or "none"))
+            return
+        except ValueError as error:
+            send_message(context, f"{sender} : Invalid value for {var_name}: {error}")
+            return
+        send_message(context, f"{sender} : {module.module_name()} variable {var_name} is {value}.")
@@ -1,16 +1,56 @@
 from abc import ABCMeta, abstractclassmethod
+import inspect
 from typing import Any, Iterable, Optional, Union, final
 from twitchio.ext import commands
 
-## Problem is that we can only create one instance of a cog (because all instances have the same name due to the cog meta-class).
-## This means that are modes and variables need to be remember for all joined channels by a single cog instance!
+from Core.ChannelConfig import ChannelConfigStore, ChannelSettings
+from Core.CommandString import ArgumentSchema, get_argument_spec, parse_command_string
+from Core.SendScheduler import Priority
+
+## We can only create one instance of a cog (because all instances have the same name due to the cog meta-class).
+## This means that modes and variables are kept per channel in the bot's channel config store, rather than on the cog.
 
 class OllieBotCog(commands.Cog):
     
-    __slots__ = ("__modes", "__variables")
+    __slots__ = ("bot", "__config", "__module_name")
+    
+    ## Maps the names of this cog's commands to their compiled argument schemas.
+    __argument_schemas: dict[str, ArgumentSchema] = {}
+    
+    def __init_subclass__(cls, **kwargs) -> None:
+        "Compile the argument schemas of the cog's commands once, when the cog class is defined."
+        super().__init_subclass__(**kwargs)
+        cls.__argument_schemas = {member.name : ArgumentSchema(*spec)
+                                  for _, member in inspect.getmembers(cls)
+                                  if isinstance(member, commands.Command)
+                                  and (spec := get_argument_spec(member)) is not None}
+    
+    def __init__(self, bot: commands.Bot) -> None:
+        self.bot: commands.Bot = bot
+        self.__module_name: str = self.module_name()
+        self.__config: ChannelConfigStore = bot.channel_config
+        self.__config.register_module(self.__module_name, self.module_modes(), self.module_variables())
     
-    def __init__(self) -> None:
-        self.__modes: dict[str, bool] = self.module_modes()
+    def send(self, channel_name: str, message: str, priority: Priority = Priority.REPLY) -> bool:
+        """
+        Queue a message to be sent to the given channel through the bot's send scheduler.
+        
+        For handlers that are given a message rather than a context.
+        Returns False if the message was merged or dropped by the scheduler under backpressure.
+        """
+        return self.bot.send_scheduler.submit(channel_name, message, priority)
+    
+    ##################################################
+    #### Command arguments
+    
+    @final
+    def parse_arguments(self, context: commands.Context) -> dict[str, Any]:
+        """
+        Parse the arguments of the command being invoked against its declared schema.
+        
+        Raises an `ArgumentError` if the arguments do not match the schema.
+        """
+        return self.__argument_schemas[context.command.name].parse(parse_command_string(context).arguments)
     
     ##################################################
     #### Module modes
@@ -24,44 +64,110 @@ class OllieBotCog(commands.Cog):
         "The modes that can be changed on this module and their default state."
         raise NotImplementedError()
     
+    @classmethod
+    def module_variables(cls) -> dict[str, Any]:
+        """
+        The variables that can be changed on this module and their default values.
+        
+        Values given as strings, such as from chat, are converted to the type of the variable's default.
+        """
+        return {}
+    
+    @classmethod
+    def module_variable_bounds(cls) -> dict[str, tuple[Optional[float], Optional[float]]]:
+        "The inclusive lowest and highest values of this module's numeric variables, either can be None for no bound."
+        return {}
+    
+    @final
+    def settings(self, channel_name: str) -> ChannelSettings:
+        "Get this module's modes and variables in the given channel, this is a single dictionary lookup once the channel is loaded."
+        return self.__config.get(self.__module_name, channel_name)
+    
     @final
     async def modes(self) -> list[str]:
         "The modes that can be changed on this module."
-        return list(self.__modes.keys())
+        return list(self.__config.defaults(self.__module_name).modes.keys())
     
     @final
     async def accepts_mode(self, mode: str) -> bool:
         "Check if a mode or modes can be changed on this module."
-        return mode in self.__modes
+        return mode in self.__config.defaults(self.__module_name).modes
     
     @final
-    async def get_mode(self, mode: str) -> bool:
-        "Get the state (whether it is enabled or disabled) of the given mode."
-        return self.__modes.get(mode, False)
+    async def get_mode(self, channel_name: str, mode: str) -> bool:
+        "Get the state (whether it is enabled or disabled) of the given mode in the given channel."
+        return self.settings(channel_name).modes.get(mode, False)
     
     @final
-    async def set_mode(self, mode: str, enable: Optional[bool] = None) -> None:
-        "Set the state (enable or disable) of the given mode in this module."
-        if self.accepts_mode(mode):
-            if enable is not None:
-                self.__modes[mode] = enable
-            else: self.__modes[mode] = not self.__modes[mode]
+    async def set_mode(self, channel_name: str, mode: str, enable: Optional[bool] = None) -> Optional[bool]:
+        """
+        Set the state (enable or disable) of the given mode in this module in the given channel, toggling it if no state is given.
+        
+        Returns the new state of the mode, or None if this module does not accept the mode.
+        """
+        if not await self.accepts_mode(mode):
+            return None
+        if enable is None:
+            enable = not self.settings(channel_name).modes[mode]
+        self.__config.set_mode(self.__module_name, channel_name, mode, enable)
+        return enable
     
     ##################################################
     #### Module local variables
     
     async def accepts_set_vars(self) -> list[tuple[str, type]]:
-        "Set the variables that the module accepts to modify its behaviour."
-        return []
+        "Get the variables that the module accepts to modify its behaviour, and their types."
+        return [(var_name, type(default)) for var_name, default in self.__config.defaults(self.__module_name).variables.items()]
     
     async def accepts_get_vars(self) -> list[tuple[str, type]]:
-        "Get the current values of variables that the module accepts to modify its behaviour."
-        return []
+        "Get the variables that the module exposes, and their types."
+        return await self.accepts_set_vars()
     
-    async def set_var(self, var_name: str, value: Any) -> None:
-        "Set the value of a variable."
-        return None
+    async def set_var(self, channel_name: str, var_name: str, value: Any) -> None:
+        """
+        Set the value of a variable in the given channel.
+        
+        Raises a `KeyError` if the module does not accept the variable, or a `ValueError` if the value cannot be converted to its type
+        or is outside its bounds.
+        """
+        var_type: type = type(self.__config.defaults(self.__module_name).variables[var_name])
+        if isinstance(value, str) and var_type is not str:
+            value = convert_value(value, var_type)
+        check_value(value, var_type, self.module_variable_bounds().get(var_name))
+        self.__config.set_var(self.__module_name, channel_name, var_name, value)
     
-    async def get_var(self, var_name: str) -> Any:
-        "Get the value of a variable."
-        return None
\ No newline at end of file
+    async def get_var(self, channel_name: str, var_name: str) -> Any:
+        "Get the value of a variable in the given channel, raises a `KeyError` if the module does not accept the variable."
+        return self.settings(channel_name).variables[var_name]
+
+## How the types of variables are named to chatters.
+_TYPE_NAMES: dict[type, str] = {bool : "on or off", int : "a whole number", float : "a number", str : "text"}
+
+def convert_value(value: str, var_type: type) -> Any:
+    "Convert a string to the given type, accepting on/off, yes/no and true/false for booleans."
+    if var_type is bool:
+        lowered: str = value.lower()
+        if lowered in ("on", "yes", "true", "1"):
+            return True
+        if lowered in ("off", "no", "false", "0"):
+            return False
+        raise ValueError(f"Expected on or off, got \"{value}\".")
+    try:
+        return var_type(value)
+    except ValueError:
+        raise ValueError(f"Expected {_TYPE_NAMES.get(var_type, var_type.__name__)}, got \"{value}\".") from None
+
+def check_value(value: Any, var_type: type, bounds: Optional[tuple[Optional[float], Optional[float]]] = None) -> None:
+    "Raise a `ValueError` if a value is not of the given type, or is outside the given inclusive bounds."
+    ## Booleans are integers to Python, but never a valid number for a variable.
+    if not isinstance(value, var_type) or (isinstance(value, bool) and var_type is not bool):
+        raise ValueError(f"Expected {_TYPE_NAMES.get(var_type, var_type.__name__)}, got \"{value}\".")
+    if bounds is None:
+        return
+    lowest, highest = bounds
+    if (lowest is not None and value < lowest) or (highest is not None and value > highest):
+        if highest is None:
+            raise ValueError(f"Expected at least {lowest}, got {value}.")
+        if lowest is None:
+            raise ValueError(f"Expected at most {highest}, got {value}.")
+        raise ValueError(f"Expected {lowest} to {highest}, got {value}.")
@@ -1,30 +1,125 @@
+import asyncio
 from asyncio import Lock
 import sqlite3
-import argparse
+import time
 
-from typing import Literal, Optional
+from typing import Any, Literal, Mapping, Optional, Sequence
 import twitchio
 from twitchio.ext import commands
-from Core.MessageFunctions import get_command_string, get_message
+from Core.ChannelConfig import ChannelSettings
+from Core.Chatters import ChatterCache, surrogate_id
+from Core.Helix import HelixError
+from Core.CommandString import ArgumentError, arguments
+from Core.MessageFunctions import send_message
+from Core.Moderation import TIMEOUT_DURATIONS
+from Core.Metrics import REGISTRY, Counter, Histogram
+from Core.Emotes import EmoteRegistry
+from Core.PyramidDetector import DetectorState, PyramidEvent, PyramidEventKind, advance, pre_reject
+from Core.ScoreCache import ScoreCache
+from Core.ScoreWriter import ROLLUP_TABLES, SCORE_FIELDS, ScoreWriter, create_history_tables, create_score_table, period_start
+from Core.Snapshot import SavedPyramid
 
 from Cogs.OllieBotCog import OllieBotCog
 
 __all__ = ("PyramidHandler")
 
+_LOCK_WAIT_SECONDS: Histogram = REGISTRY.histogram("olliebot_pyramid_lock_wait_seconds", "Time spent waiting on a channel's pyramid lock.")
+_DECLARE_SECONDS: Histogram = REGISTRY.histogram("olliebot_score_seconds", "Pyramid score operation latency, by operation.", {"operation" : "declare"})
+_GET_SCORE_SECONDS: Histogram = REGISTRY.histogram("olliebot_score_seconds", "Pyramid score operation latency, by operation.", {"operation" : "get"})
+_HIGH_SCORES_SECONDS: Histogram = REGISTRY.histogram("olliebot_score_seconds", "Pyramid score operation latency, by operation.", {"operation" : "high_scores"})
+_PERIOD_HIGH_SCORES_SECONDS: Histogram = REGISTRY.histogram("olliebot_score_seconds", "Pyramid score operation latency, by operation.", {"operation" : "period_high_scores"})
+_RANK_SECONDS: Histogram = REGISTRY.histogram("olliebot_score_seconds", "Pyramid score operation latency, by operation.", {"operation" : "rank"})
+_PRE_REJECTED: Counter = REGISTRY.counter("olliebot_pyramid_pre_rejected_total", "Messages rejected from pyramid tracking by their first word alone.")
+_DB_QUERIES: Counter = REGISTRY.counter("olliebot_db_queries_total", "Queries made to the pyramid database outside the score cache.")
+
+## The score types chatters can look up, ranked and listed by.
+_SCORE_TYPES: tuple[str, ...] = ("success", "failed", "blocked", "stolen")
+
+## The number of chatters on each page of the high scores.
+_HIGH_SCORES_PAGE_SIZE: int = 4
+
+## Column names cannot be bound parameters, so the queries of each score column are built once from
+## the known score fields, and only ever looked up by score type. Every other value is bound.
+## Each is answered from the score column's index, ties are broken by chatter name then user id as in the score cache.
+_SCORE_INDEXES: tuple[str, ...] = tuple(f"""
+                                        CREATE INDEX IF NOT EXISTS pyramid_scores_{score}
+                                        ON pyramid_scores ({score} DESC, chatter_name)
+                                        """
+                                        for score in SCORE_FIELDS)
+_HIGH_SCORES_QUERIES: dict[str, str] = {score : f"""
+                                                SELECT chatter_name, {score}
+                                                FROM pyramid_scores
+                                                ORDER BY {score} DESC, chatter_name, user_id
+                                                LIMIT :limit OFFSET :offset
+                                                """
+                                        for score in SCORE_FIELDS}
+_PERIOD_HIGH_SCORES_QUERIES: dict[tuple[str, str], str] = {(period, score) : f"""
+                                                                             SELECT chatter_name, {score}
+                                                                             FROM {table}
+                                                                             WHERE channel_name = :channel_name
+                                                                                   AND period_start = :period_start
+                                                                                   AND {score} > 0
+                                                                             ORDER BY {score} DESC, chatter_name, user_id
+                                                                             LIMIT :limit
+                                                                             """
+                                                            for period, table in ROLLUP_TABLES.items()
+                                                            for score in SCORE_FIELDS}
+_RANK_QUERIES: dict[str, str] = {score : f"""
+                                         SELECT COUNT(*)
+                                         FROM pyramid_scores
+                                         WHERE {score} > :value
+                                         """
+                                 for score in SCORE_FIELDS}
+
+class PyramidState(DetectorState):
+    "The pyramid tracking state of a single channel."
+    
+    __slots__ = ("lock",
+                 "last_active")
+    
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock: Lock = Lock()
+        self.last_active: float = time.monotonic()
+    
+    @classmethod
+    def from_saved(cls, saved: SavedPyramid) -> "PyramidState":
+        "Create a state continuing a pyramid attempt saved in a snapshot."
+        state: PyramidState = cls()
+        state.last_sender_name = saved.last_sender_name
+        state.pyramid_emote = saved.pyramid_emote
+        state.pyramid_progress = saved.pyramid_progress
+        state.pyramid_max_height = saved.pyramid_max_height
+        state.last_active -= max(0.0, time.time() - saved.last_active)
+        return state
+    
+    def saved(self) -> SavedPyramid:
+        "Get the pyramid attempt to save in a snapshot."
+        return SavedPyramid(self.last_sender_name, self.pyramid_emote, self.pyramid_progress, self.pyramid_max_height,
+                            time.time() - (time.monotonic() - self.last_active))
+
 class PyramidHandler(OllieBotCog):
     "Class for handling pyramid attempts."
     
     __slots__ = ("__connection",
                  "__cursor",
-                 "__theif",
-                 "__destroy",
-                 "__timeout",
-                 "__last_sender_name",
-                 "__pyramid_emote",
-                 "__pyramid_progress",
-                 "__pyramid_max_height")
+                 "__chatters",
+                 "__unresolved",
+                 "__emotes",
+                 "__writer",
+                 "__owns_writer",
+                 "__scores",
+                 "__states",
+                 "__idle_timeout",
+                 "__last_sweep")
     
-    def __init__(self) -> None:
+    def __init__(self,
+                 bot: commands.Bot,
+                 database_path: str = "SQL/pyramids.sqlite3",
+                 idle_timeout: float = 1800.0,
+                 score_writer: Optional[ScoreWriter] = None,
+                 restored_states: Optional[Mapping[str, SavedPyramid]] = None
+                 ) -> None:
         """
         Create a pyramid handler.
         
@@ -35,234 +130,436 @@ class PyramidHandler(OllieBotCog):
         `destroyer` - Destroy pyramids when they reach 3-width.
         
         `timeout` - Timeout failed or incorrect pyramids.
+        
+        Variables
+        ---------
+        `timeout_duration` - The length in seconds of timeouts for failed pyramids.
+        
+        Modes and variables are set separately for each channel.
+        
+        Pyramids are tracked separately for each channel, channels that have
+        not had a message in `idle_timeout` seconds have their state discarded.
+        Pyramid attempts saved in the bot's last snapshot can be given to continue them from where they were.
+        
+        Scores are written by a score writer thread for the database, unless another
+        score writer is given, such as one shared between several bot processes or one
+        kept by the bot across reloads of this cog. A given score writer is not closed with the handler.
+        
+        Only emotes can build pyramids in channels whose emotes the bot knows, or that Twitch tags in the message,
+        and a message not starting with one is rejected from its first word, without waiting on the channel's lock.
+        
+        Scores are keyed by user id, so they follow chatters through renames, names are resolved
+        to ids through the bot's chatter cache, and looked up through Helix only when not cached.
+        Results of a chatter whose lookup failed are recorded under a surrogate id, and claimed by their real id once it is known.
         """
-        ## SQL connections
-        self.__connection: sqlite3.Connection = sqlite3.connect("SQL/pyramids.sqlite3")
-        self.__cursor: sqlite3.Cursor = self.__connection.cursor()
+        super().__init__(bot)
         
-        ## Modes
-        self.__theif: bool = False
-        self.__destroy: bool = False
-        self.__timeout: bool = True
+        ## SQL connections, scores are read through the score cache and written behind by the score writer thread
+        self.__connection: sqlite3.Connection = sqlite3.connect(database_path)
+        self.__cursor: sqlite3.Cursor = self.__connection.cursor()
+        self.__chatters: ChatterCache = bot.chatters
+        ## The names of chatters with results recorded under a surrogate id because their lookup failed.
+        self.__unresolved: set[str] = set()
+        self.__emotes: EmoteRegistry = bot.emotes
+        create_score_table(self.__connection)
+        with self.__connection:
+            for index_query in _SCORE_INDEXES:
+                self.__connection.execute(index_query)
+        create_history_tables(self.__connection)
+        self.__writer: ScoreWriter = score_writer if score_writer is not None else ScoreWriter(database_path)
+        self.__owns_writer: bool = score_writer is None
+        self.__scores: ScoreCache = ScoreCache(self.__connection, self.__writer)
+        REGISTRY.counter("olliebot_score_cache_hits_total", "Score lookups answered from memory.", function=lambda: self.__scores.hits)
+        REGISTRY.counter("olliebot_score_cache_misses_total", "Score lookups that read the database.", function=lambda: self.__scores.misses)
+        REGISTRY.counter("olliebot_db_commits_total", "Pyramid score transactions committed.", function=lambda: self.__writer.commits)
         
-        ## Pyramid tracking variables
-        self.__lock: Lock = Lock()
-        self.__last_sender_name: str = ""
-        self.__pyramid_emote: str = ""
-        self.__pyramid_progress: int = 0
-        self.__pyramid_max_height: int = 0
+        ## Pyramid tracking states, created on a channel's first message
+        self.__states: dict[str, PyramidState] = {channel_name : PyramidState.from_saved(saved)
+                                                  for channel_name, saved in (restored_states or {}).items()}
+        self.__idle_timeout: float = idle_timeout
+        self.__last_sweep: float = time.monotonic()
+        REGISTRY.gauge("olliebot_pyramid_states", "Channels with a pyramid tracking state.", function=lambda: len(self.__states))
     
     @classmethod
-    def module_name() -> str:
+    def module_name(cls) -> str:
         return "pyramids"
     
     @classmethod
-    def module_modes() -> dict[str, bool]:
+    def module_modes(cls) -> dict[str, bool]:
         return {"theif" : False, "destroy" : False, "timeout" : True}
     
-    async def handle_pyramids(self, context: commands.Context) -> None:
+    @classmethod
+    def module_variables(cls) -> dict[str, Any]:
+        return {"timeout_duration" : 600}
+    
+    @classmethod
+    def module_variable_bounds(cls) -> dict[str, tuple[Optional[float], Optional[float]]]:
+        return {"timeout_duration" : TIMEOUT_DURATIONS}
+    
+    def __get_state(self, channel_name: str) -> PyramidState:
+        "Get the pyramid state of a channel, creating it if the channel has none."
+        time_now: float = time.monotonic()
+        self.__evict_idle_states(time_now)
+        state: Optional[PyramidState] = self.__states.get(channel_name)
+        if state is None:
+            state = self.__states[channel_name] = PyramidState()
+        else: state.last_active = time_now
+        return state
+    
+    def __evict_idle_states(self, time_now: float) -> None:
+        "Discard the states of channels that have been idle for longer than the idle timeout, at most once a minute."
+        if time_now - self.__last_sweep < 60.0:
+            return
+        self.__last_sweep = time_now
+        for channel_name in [channel_name for channel_name, state in self.__states.items()
+                             if (time_now - state.last_active) > self.__idle_timeout
+                             and not state.lock.locked()]:
+            del self.__states[channel_name]
+    
+    async def handle_pyramids(self, message: twitchio.Message) -> None:
         "Handle the pyramids for the given chat message, requires echo messages."
-        async with self.__lock:
-            message: twitchio.Message = get_message(context)
-            split_message: list[str] = str(message.content).split(" ")
-            current_sender_name: str = str(context.author.name)
-            is_stolen: bool = False
-            
-            ## The pyramid has been progressed correctly iff;
-            ##      - All the words in the message are the same,
-            ##      - The number of messages is one greater or one smaller than the number in the previous level.
-            if valid := (all(emote == self.__pyramid_emote
-                            for emote in split_message)
-                        and ((pyramid_level := len(split_message))
-                            in [self.__pyramid_progress + 1,
-                                self.__pyramid_progress - 1])):
-                
-                ## Check whether we are going down or up the pyramid
-                on_downwards: bool = pyramid_level == (self.__pyramid_progress - 1)
-                on_upwards: bool = not on_downwards
-                
-                ## Update the progres of the pyramid
-                self.__pyramid_max_height = max(self.__pyramid_max_height, pyramid_level)
-                self.__pyramid_progress = pyramid_level
+        channel_name: str = message.channel.name
+        state: PyramidState = self.__get_state(channel_name)
+        emotes: Optional[frozenset[str]] = self.__emotes.get(channel_name)
+        ## Twitch tags the emotes in a message, which include emotes the registry cannot know, such as other channels' subscriber emotes.
+        emote_tag: str = (message.tags or {}).get("emotes") or ""
+        ## Most messages do not start with an emote, if the lock is free such a message can be rejected in place,
+        ## as nothing else can be changing the state, otherwise it waits its turn so messages are seen in order.
+        if (emotes is not None and not state.lock.locked()
+            and pre_reject(state, str(message.author.name), str(message.content), emotes, emote_tag)):
+            _PRE_REJECTED.inc()
+            return
+        settings: ChannelSettings = self.settings(channel_name)
+        start: float = time.perf_counter()
+        async with state.lock:
+            _LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+            current_sender_name: str = str(message.author.name)
+            current_sender_id: Optional[int] = int(message.author.id) if message.author.id else None
+            events: Sequence[PyramidEvent] = advance(state, current_sender_name, message.author.badges, str(message.content), emotes, emote_tag)
+            for event in events:
                 
                 ## Try to destroy the pyramid after level 3
-                if self.__destroy and on_upwards and pyramid_level == 3:
-                    await context.send(f"No {message.author.name} :)")
+                if event.kind is PyramidEventKind.REACHED_THREE:
+                    if settings.modes["destroy"]:
+                        self.send(channel_name, f"No {message.author.name} :)")
                 
                 ## Try to steal the pyramid on the last emote
-                if self.__theif and on_downwards and pyramid_level == 2:
-                    await context.send(f"{self.__pyramid_emote}")
+                elif event.kind is PyramidEventKind.ONE_FROM_COMPLETE:
+                    if settings.modes["theif"]:
+                        self.send(channel_name, f"{event.other}")
                 
-                ## Declare success if the pyramid is complete
-                if (on_downwards and pyramid_level == 1
-                    and self.__pyramid_max_height >= 3):
-                    
-                    ## The pyramid was stolen iff the current sender is not the same as the last
-                    is_stolen = current_sender_name != self.__last_sender_name
-                    
-                    if (self.__pyramid_max_height == 3
-                        and not is_stolen
-                        and any((user_type in context.author.badges
-                                and context.author.badges[user_type] == "1")
-                                for user_type in ["vip", "moderator"])):
-                        await context.send(f"That doesn't count {current_sender_name} Weirdge")
-                        return
-                    
-                    ## Declare success
-                    await self.declare_pyramid(current_sender_name, result="success", stolen=is_stolen, size=self.__pyramid_max_height)
+                elif event.kind is PyramidEventKind.DOES_NOT_COUNT:
+                    self.send(channel_name, f"That doesn't count {current_sender_name} Weirdge")
+                
+                ## Declare success
+                elif event.kind is PyramidEventKind.SUCCESS:
+                    await self.declare_pyramid(event.chatter_name, result="success", stolen=event.stolen, size=event.size,
+                                               channel_name=channel_name, stolen_from=event.other if event.stolen else "",
+                                               user_id=current_sender_id)
                     if current_sender_name != "OllieDoggoBot":
-                        total_successes = await self.get_score(current_sender_name, score="success")
-                        await context.send(f"OhMyDog Nice pyramid {current_sender_name} POGGERS Thats your {make_ordinal(total_successes)} successful pyramid Radge"
-                                           + (f" You stole it from {self.__last_sender_name} PepeLaugh" if is_stolen else ""))
+                        total_successes = await self.get_score(event.chatter_name, score="success", user_id=current_sender_id)
+                        self.send(channel_name, f"OhMyDog Nice pyramid {event.chatter_name} POGGERS Thats your {make_ordinal(total_successes)} successful pyramid Radge"
+                                              + (f" You stole it from {event.other} PepeLaugh" if event.stolen else ""))
                         ## TODO update to be stolen from any previous chatter: self.__last_different_chatter
-            
-            ## This is a failed pyramid iff;
-            ##      - It is invalid but has progressed beyond its base size,
-            ##      - Or it was stolen.
-            if (not valid and self.__pyramid_progress >= 2) or is_stolen:
-                await self.declare_pyramid(self.__last_sender_name, result="failed")
-                total_failures = await self.get_score(self.__last_sender_name, score="failed")
                 
-                if self.__timeout:
-                    if current_sender_name == "OllieDoggoBot":
-                        await context.send(f"Get absolutely destroyed {self.__last_sender_name} EZ Clap Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping See you in 10 peepoHey")
-                    else: await context.send(f"You tried {self.__last_sender_name}, you failed :) Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping See you in 10 peepoHey")
+                ## Declare failure, timing out the last sender to post a valid level of the pyramid.
+                elif event.kind is PyramidEventKind.FAILED:
+                    ## The builder sent the previous valid level, so their id is almost always cached.
+                    builder_id: int = await self.__get_user_id(event.chatter_name)
+                    await self.declare_pyramid(event.chatter_name, result="failed", channel_name=channel_name, user_id=builder_id)
+                    total_failures = await self.get_score(event.chatter_name, score="failed", user_id=builder_id)
                     
-                    ## Timeout the last sender to post a valid level of the pyramid.
-                    await context.send(f"/timeout {self.__last_sender_name} 600")
-                
-                else: await context.send(f"Absolute failure {self.__last_sender_name} PogO Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping")
+                    if settings.modes["timeout"]:
+                        timeout_duration: int = settings.variables["timeout_duration"]
+                        if current_sender_name == "OllieDoggoBot":
+                            self.send(channel_name, f"Get absolutely destroyed {event.chatter_name} EZ Clap Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping See you in {timeout_duration // 60} peepoHey")
+                        else: self.send(channel_name, f"You tried {event.chatter_name}, you failed :) Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping See you in {timeout_duration // 60} peepoHey")
+                        self.bot.moderation.timeout(channel_name, event.chatter_name, timeout_duration, "Failed a pyramid", builder_id)
+                    
+                    else: self.send(channel_name, f"Absolute failure {event.chatter_name} PogO Thats your {make_ordinal(total_failures)} failed pyramid WeirdChamping")
                 
                 ## If the pyramid was blocked
-                if not is_stolen and current_sender_name != self.__last_sender_name:
-                    await self.declare_pyramid(current_sender_name, result="blocked")
-                    total_blocked = await self.get_score(current_sender_name, score="blocked")
-                    await context.send(f"Nice block {current_sender_name} BASED Thats your {make_ordinal(total_blocked)} blocked pyramid YEP")
-            
-            ## Reset the pyramid if it is no longer valid (it was not progressed correctly).
-            if not valid:
-                self.__pyramid_emote = split_message[0]
-                self.__pyramid_max_height = 1
-                self.__pyramid_progress = 1
-            
-            ## Keep track to sent the most recent valid level in the pyramid
-            self.__last_sender_name = current_sender_name
+                elif event.kind is PyramidEventKind.BLOCKED:
+                    await self.declare_pyramid(event.chatter_name, result="blocked", channel_name=channel_name, user_id=current_sender_id)
+                    total_blocked = await self.get_score(event.chatter_name, score="blocked", user_id=current_sender_id)
+                    self.send(channel_name, f"Nice block {event.chatter_name} BASED Thats your {make_ordinal(total_blocked)} blocked pyramid YEP")
+    
+    async def __get_user_id(self, chatter_name: str) -> int:
+        """
+        Get the user id a chatter's results are recorded under.
+        
+        Chatters that do not exist on Twitch, such as deleted accounts, are given a surrogate id.
+        Chatters whose lookup failed are too, until their real id is known and claims their results.
+        """
+        user_id: Optional[int] = self.__chatters.get_id(chatter_name)
+        if user_id is None:
+            try:
+                user_id = await self.__chatters.resolve_one(chatter_name)
+            except HelixError:
+                self.__unresolved.add(chatter_name.lower())
+                return surrogate_id(chatter_name)
+        return user_id if user_id is not None else surrogate_id(chatter_name)
+    
+    def __claim(self, chatter_name: str, user_id: int) -> None:
+        "Move the results recorded under a chatter's surrogate id while their lookup failed to their real id."
+        if self.__unresolved and user_id >= 0 and chatter_name.lower() in self.__unresolved:
+            self.__unresolved.discard(chatter_name.lower())
+            self.__scores.claim(user_id, chatter_name.lower())
     
     async def declare_pyramid(self,
                               chatter_name: str,
                               result: Literal["success", "failed", "blocked"],
                               stolen: bool = False,
-                              size: int = 0
+                              size: int = 0,
+                              channel_name: Optional[str] = None,
+                              stolen_from: str = "",
+                              user_id: Optional[int] = None
                               ) -> None:
-        "Declare that a chatter succeeded or failed a pyramid attempt."
-        ## Fields are:
-        ##      - chatter_name: varchar(255) PRIMARY KEY,
-        ##      - success: int,
-        ##      - failed: int,
-        ##      - blocked: int,
-        ##      - stolen: int,
-        ##      - biggest: int.
-        self.__cursor.execute("""
-                              INSERT OR IGNORE INTO pyramid_scores
-                              VALUES (:name, 0, 0, 0, 0, 0)
-                              """,
-                              {"name" : chatter_name})
-        self.__cursor.execute(f"""
-                              UPDATE pyramid_scores
-                              SET {result} = {result} + 1,
-                                   stolen = stolen + :stolen,
-                                   biggest = MAX(:size, biggest)
-                              WHERE chatter_name = :name
-                              """,
-                              {"stolen" : 1 if stolen else 0,
-                               "size" : size,
-                               "name" : chatter_name})
-        self.__connection.commit()
+        """
+        Declare that a chatter succeeded or failed a pyramid attempt.
+        
+        The result is applied to the score cache immediately and committed in the background.
+        If the channel the pyramid was in is given, the result is also added to the pyramid event log and the channel's rollups.
+        If the chatter's user id is not given, it is resolved from their name.
+        """
+        if user_id is None:
+            user_id = await self.__get_user_id(chatter_name)
+        self.__claim(chatter_name, user_id)
+        with _DECLARE_SECONDS.time():
+            self.__scores.record(user_id, chatter_name.lower(), result, stolen, size, channel_name, stolen_from)
     
     async def get_score(self,
                         chatter_name: str,
                         score: Literal["success", "failed", "blocked", "stolen"],
+                        user_id: Optional[int] = None
                         ) -> Optional[int]:
-        self.__cursor.execute(f"""
-                              SELECT chatter_name, {score}
-                              FROM pyramid_scores
-                              WHERE chatter_name = :name
-                              """,
-                              {"name" : chatter_name})
-        result: Optional[tuple[str, int]] = self.__cursor.fetchone()
-        if result is not None:
-            return result[1]
-        return None
+        "Get a chatter's score, including results that are queued but not yet committed, or None if they have never been recorded."
+        if user_id is None:
+            user_id = await self.__get_user_id(chatter_name)
+        self.__claim(chatter_name, user_id)
+        with _GET_SCORE_SECONDS.time():
+            return self.__scores.get_score(user_id, score, chatter_name.lower())
     
     async def get_high_scores(self,
                               score: Literal["success", "failed", "blocked", "stolen"],
-                              top_scores: int = 4
+                              top_scores: int = _HIGH_SCORES_PAGE_SIZE,
+                              offset: int = 0
                               ) -> list[tuple[str, int]]:
-        self.__cursor.execute(f"""
-                              SELECT *
-                              FROM (SELECT chatter_name, {score} FROM pyramid_scores ORDER BY {score} DESC)
-                              LIMIT {top_scores}
-                              """)
-        return self.__cursor.fetchall()
+        """
+        Get the chatters with the highest scores, skipping the given number of chatters first.
+        
+        Answered from the leaderboard index where possible, otherwise from the score column's index.
+        """
+        if score not in _HIGH_SCORES_QUERIES:
+            raise ValueError(f"Unknown score type: {score}")
+        with _HIGH_SCORES_SECONDS.time():
+            high_scores: Optional[list[tuple[str, int]]] = self.__scores.get_high_scores(score, top_scores, offset)
+            if high_scores is not None:
+                return high_scores
+            _DB_QUERIES.inc()
+            self.__cursor.execute(_HIGH_SCORES_QUERIES[score], {"limit" : top_scores, "offset" : offset})
+            return self.__cursor.fetchall()
     
-    def _get_pyramid_score_args(self, context: commands.Context, user_optional: bool = True) -> tuple[str, str]:
-        if not hasattr(self, "pyramid_score_parser"):
-            
-            parser = argparse.ArgumentParser()
-            parser.add_argument("score", type=str)
-            parser.add_argument("-user", type=str, default=None)
-            
-            self.pyramid_score_parser = parser
+    async def get_period_high_scores(self,
+                                     channel_name: str,
+                                     score: Literal["success", "failed", "blocked", "stolen"],
+                                     period: Literal["day", "week"],
+                                     top_scores: int = _HIGH_SCORES_PAGE_SIZE
+                                     ) -> list[tuple[str, int]]:
+        """
+        Get the chatters with the highest scores in a channel in the current UTC day or week.
         
-        namespace: argparse.Namespace = self.pyramid_score_parser.parse_known_args(get_command_string(context, split=True))[0]
+        Read from the channel's rollup for the period, so the cost depends only on the number of chatters
+        with results in that period, never on the length of the history. Results are included once committed.
+        """
+        if (period, score) not in _PERIOD_HIGH_SCORES_QUERIES:
+            raise ValueError(f"Unknown score type or period: {score}, {period}")
+        with _PERIOD_HIGH_SCORES_SECONDS.time():
+            _DB_QUERIES.inc()
+            self.__cursor.execute(_PERIOD_HIGH_SCORES_QUERIES[(period, score)],
+                                  {"channel_name" : channel_name,
+                                   "period_start" : period_start(time.time(), period),
+                                   "limit" : top_scores})
+            return self.__cursor.fetchall()
+    
+    async def get_rank(self,
+                       chatter_name: str,
+                       score: Literal["success", "failed", "blocked", "stolen"]
+                       ) -> Optional[tuple[int, int]]:
+        """
+        Get a chatter's rank and score, or None if they have never been recorded.
         
-        user: str = namespace.user
+        Chatters with equal scores share the same rank, one more than the number of chatters with a higher score.
+        The count is a range scan over the score column's index, so it never reads the table itself.
+        """
+        if score not in _RANK_QUERIES:
+            raise ValueError(f"Unknown score type: {score}")
+        user_id: int = await self.__get_user_id(chatter_name)
+        with _RANK_SECONDS.time():
+            value: Optional[int] = self.__scores.get_score(user_id, score, chatter_name.lower())
+            if value is None:
+                return None
+            _DB_QUERIES.inc()
+            self.__cursor.execute(_RANK_QUERIES[score], {"value" : value})
+            return (self.__cursor.fetchone()[0] + 1, value)
+    
+    def pyramid_states(self) -> dict[str, SavedPyramid]:
+        "Get the pyramid attempts in progress in each channel, to save in a snapshot."
+        return {channel_name : state.saved()
+                for channel_name, state in self.__states.items()
+                if state.pyramid_progress > 0}
+    
+    @property
+    def commits(self) -> int:
+        "The number of score transactions committed to the database."
+        return self.__writer.commits
+    
+    async def prepare_unload(self) -> None:
+        "Commit the scores queued in a writer kept by the bot before a reload, so the reloaded handler reads every result recorded by this one."
+        if not self.__owns_writer:
+            ## The flush waits on the writer thread, which could take up to its timeout, so it is waited on off the event loop.
+            await asyncio.to_thread(self.__writer.flush, 30.0)
+    
+    def close(self) -> None:
+        "Close the database connections, and commit all queued scores and close the score writer if the handler owns it."
+        if self.__owns_writer:
+            self.__writer.close()
+        self.__connection.close()
+    
+    def cog_unload(self) -> None:
+        self.close()
+    
+    def _get_pyramid_score_args(self, context: commands.Context, user_optional: bool = True) -> tuple[str, str]:
+        "Get the score type and user arguments of a pyramid score command, raises an `ArgumentError` if they are invalid."
+        namespace: dict[str, Optional[str]] = self.parse_arguments(context)
+        
+        user: Optional[str] = namespace["user"]
         if user is None:
             if user_optional:
                 user = context.author.name
-            else: raise ValueError("User is required.")
+            else: raise ArgumentError("You must specify a user to declare a pyramid.")
         if user.startswith("@"):
             user = user[1:]
         
-        return (namespace.score, user.lower())
+        return (namespace["score"], user.lower())
     
     @commands.command()
+    @arguments("score", user=None)
     async def pyramid_score(self, context: commands.Context) -> None:
         sender: str = context.author.name
-        score_type, user = self._get_pyramid_score_args(context)
-        if score_type not in ["success", "failed", "blocked", "stolen"]:
-            await context.send(f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
+        try:
+            score_type, user = self._get_pyramid_score_args(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?pyramid_score <success|failed|blocked|stolen> [-user <name>]")
+            return
+        if score_type not in _SCORE_TYPES:
+            send_message(context, f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
         else:
             score: Optional[int] = await self.get_score(user, score_type)
             if score is None:
-                await context.send(f"{sender} : Cannot find user \"{user}\" in database.")
+                send_message(context, f"{sender} : Cannot find user \"{user}\" in database.")
+            else:
+                if user != sender:
+                    send_message(context, f"{sender} : {user} has {'completed' if score_type == 'success' else score_type} {score} pyramids.")
+                else: send_message(context, f"{sender} : You have {'completed' if score_type == 'success' else score_type} {score} pyramids.")
+    
+    @commands.command()
+    @arguments("score", user=None)
+    async def pyramid_rank(self, context: commands.Context) -> None:
+        sender: str = context.author.name
+        try:
+            score_type, user = self._get_pyramid_score_args(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?pyramid_rank <success|failed|blocked|stolen> [-user <name>]")
+            return
+        if score_type not in _SCORE_TYPES:
+            send_message(context, f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
+        else:
+            rank: Optional[tuple[int, int]] = await self.get_rank(user, score_type)
+            if rank is None:
+                send_message(context, f"{sender} : Cannot find user \"{user}\" in database.")
             else:
                 if user != sender:
-                    await context.send(f"{sender} : {user} has {'completed' if score_type == 'success' else score_type} {score} pyramids.")
-                else: await context.send(f"{sender} : You have {'completed' if score_type == 'success' else score_type} {score} pyramids.")
+                    send_message(context, f"{sender} : {user} is ranked {make_ordinal(rank[0])} for {'completed' if score_type == 'success' else score_type} pyramids with {rank[1]}.")
+                else: send_message(context, f"{sender} : You are ranked {make_ordinal(rank[0])} for {'completed' if score_type == 'success' else score_type} pyramids with {rank[1]}.")
+    
+    def _get_page_arg(self, context: commands.Context) -> int:
+        "Get the page argument of a paginated command, given as `page N` or just `N`, raises an `ArgumentError` if it is invalid."
+        namespace: dict[str, Optional[str]] = self.parse_arguments(context)
+        page: Optional[str] = namespace["page"]
+        if page is None:
+            return 1
+        if page.lower() == "page":
+            page = namespace["number"]
+            if page is None:
+                raise ArgumentError("Missing argument: page number.")
+        if not page.isdigit() or int(page) < 1:
+            raise ArgumentError(f"Invalid page number \"{page}\".")
+        return int(page)
     
     @commands.command()
+    @arguments("score", "page?", "number?", user=None)
     async def pyramid_high_scores(self, context: commands.Context) -> None:
         sender: str = context.author.name
-        score_type, user = self._get_pyramid_score_args(context)
-        if score_type not in ["success", "failed", "blocked", "stolen"]:
-            await context.send(f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
+        try:
+            score_type, user = self._get_pyramid_score_args(context)
+            page: int = self._get_page_arg(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?pyramid_high_scores <success|failed|blocked|stolen> [page <number>]")
+            return
+        if score_type not in _SCORE_TYPES:
+            send_message(context, f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
         else:
-            high_scores: list[tuple[str, int]] = await self.get_high_scores(score_type)
-            await context.send(f"{sender} : Current high scores for {'completed' if score_type == 'success' else score_type} pyramids :: "
+            offset: int = (page - 1) * _HIGH_SCORES_PAGE_SIZE
+            high_scores: list[tuple[str, int]] = await self.get_high_scores(score_type, _HIGH_SCORES_PAGE_SIZE, offset)
+            if not high_scores:
+                send_message(context, f"{sender} : There is no page {page} of high scores for {'completed' if score_type == 'success' else score_type} pyramids.")
+                return
+            send_message(context, f"{sender} : Current high scores for {'completed' if score_type == 'success' else score_type} pyramids"
+                               + (f" (page {page})" if page > 1 else "") + " :: "
+                               + ", ".join(f"{make_ordinal(i)}: {result[1]} - {result[0]}" for i, result in enumerate(high_scores, start=offset + 1)))
+    
+    @commands.command()
+    @arguments("score", "period?")
+    async def pyramid_top(self, context: commands.Context) -> None:
+        sender: str = context.author.name
+        try:
+            namespace: dict[str, Optional[str]] = self.parse_arguments(context)
+        except ArgumentError as error:
+            send_message(context, f"{sender} : {error} Usage: ?pyramid_top <success|failed|blocked|stolen> [today|week]")
+            return
+        score_type: str = namespace["score"]
+        period: str = (namespace["period"] or "week").lower()
+        if period == "today":
+            period = "day"
+        if score_type not in _SCORE_TYPES:
+            send_message(context, f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
+        elif period not in ROLLUP_TABLES:
+            send_message(context, f"{sender} : Unknown period, must be one of; today, week")
+        else:
+            high_scores: list[tuple[str, int]] = await self.get_period_high_scores(context.channel.name, score_type, period)
+            period_name: str = "today" if period == "day" else "this week"
+            if not high_scores:
+                send_message(context, f"{sender} : No {'completed' if score_type == 'success' else score_type} pyramids {period_name} yet.")
+                return
+            send_message(context, f"{sender} : Top {'completed' if score_type == 'success' else score_type} pyramids {period_name} :: "
                                + ", ".join(f"{make_ordinal(i)}: {result[1]} - {result[0]}" for i, result in enumerate(high_scores, start=1)))
     
     @commands.command()
+    @arguments("score", user=None)
     async def add_pyramid(self, context: commands.Context) -> None:
         if context.author.is_mod and context.author.name.lower() == "olliekampo":
             sender: str = context.author.name
             try:
                 score_type, user = self._get_pyramid_score_args(context, user_optional=False)
-            except ValueError:
-                await context.send(f"{sender} : You must specify a user to declare a pyramid.")
+            except ArgumentError as error:
+                send_message(context, f"{sender} : {error} Usage: ?add_pyramid <success|failed|blocked|stolen> -user <name>")
                 return
-            await self.declare_pyramid(user, score_type)
-            await context.send(f"{sender} : Declared pyramid as '{score_type}' for {user}.")
+            if score_type not in _SCORE_TYPES:
+                send_message(context, f"{sender} : Unkown score type, must be one of; success, failed, blocked, stolen")
+            else:
+                await self.declare_pyramid(user, score_type)
+                send_message(context, f"{sender} : Declared pyramid as '{score_type}' for {user}.")
 
 def make_ordinal(number: int) -> str:
     """
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import json
+import sqlite3
+from typing import Any, Optional
+
+__all__ = ("ChannelSettings",
+           "ChannelConfigStore")
+
+class ChannelSettings:
+    "The modes and variables of one module in one channel."
+
+    __slots__ = ("modes",
+                 "variables")
+
+    def __init__(self, modes: dict[str, bool], variables: dict[str, Any]) -> None:
+        self.modes: dict[str, bool] = modes
+        self.variables: dict[str, Any] = variables
+
+class ChannelConfigStore:
+    """
+    Per-channel module modes and variables, persisted to SQLite.
+
+    Modules register the modes and variables they accept with their defaults.
+    A channel's settings for a module are loaded on first use, from the defaults overlaid with
+    the values stored for the channel, and cached least-recently-used first up to the capacity.
+    Changes are written through to the database, so evicted settings are always reloaded as they were left.
+    Reading a channel's settings for a module that are already cached is a single dictionary lookup.
+    """
+
+    __slots__ = ("__connection",
+                 "__capacity",
+                 "__modules",
+                 "__settings",
+                 "__loads")
+
+    def __init__(self, database_path: str = "SQL/twitch_channels.sqlite3", capacity: int = 4096) -> None:
+        self.__connection: sqlite3.Connection = sqlite3.connect(database_path)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        with self.__connection:
+            self.__connection.execute("""
+                                      CREATE TABLE IF NOT EXISTS channel_config (channel_name varchar(255) NOT NULL,
+                                                                                 module varchar(255) NOT NULL,
+                                                                                 kind varchar(8) NOT NULL,
+                                                                                 name varchar(255) NOT NULL,
+                                                                                 value text,
+                                                                                 PRIMARY KEY (channel_name, module, kind, name))
+                                      """)
+        self.__capacity: int = capacity
+
+        ## Maps module names to their default modes and variables.
+        self.__modules: dict[str, ChannelSettings] = {}
+
+        ## Maps (module name, channel name) pairs to that module's settings in that channel.
+        self.__settings: OrderedDict[tuple[str, str], ChannelSettings] = OrderedDict()
+        self.__loads: int = 0
+
+    @property
+    def loads(self) -> int:
+        "The number of times settings had to be read from the database."
+        return self.__loads
+
+    def register_module(self, module_name: str, modes: dict[str, bool], variables: dict[str, Any]) -> None:
+        "Register the modes and variables a module accepts, and their defaults."
+        self.__modules[module_name] = ChannelSettings(dict(modes), dict(variables))
+
+    def accepts(self, module_name: str) -> bool:
+        "Check whether a module has been registered."
+        return module_name in self.__modules
+
+    def defaults(self, module_name: str) -> ChannelSettings:
+        "Get the default settings of a module, these must not be modified."
+        return self.__modules[module_name]
+
+    def get(self, module_name: str, channel_name: str) -> ChannelSettings:
+        "Get a module's settings in a channel, loading them if they are not cached."
+        key: tuple[str, str] = (module_name, channel_name)
+        settings: Optional[ChannelSettings] = self.__settings.get(key)
+        if settings is not None:
+            self.__settings.move_to_end(key)
+            return settings
+        return self.__load(key)
+
+    def set_mode(self, module_name: str, channel_name: str, mode: str, enabled: bool) -> None:
+        "Set the state of a mode of a module in a channel, raises a `KeyError` if the module does not accept the mode."
+        if mode not in self.__modules[module_name].modes:
+            raise KeyError(mode)
+        self.__store(module_name, channel_name, "mode", mode, enabled)
+        self.get(module_name, channel_name).modes[mode] = enabled
+
+    def set_var(self, module_name: str, channel_name: str, name: str, value: Any) -> None:
+        "Set the value of a variable of a module in a channel, raises a `KeyError` if the module does not accept the variable."
+        if name not in self.__modules[module_name].variables:
+            raise KeyError(name)
+        self.__store(module_name, channel_name, "var", name, value)
+        self.get(module_name, channel_name).variables[name] = value
+
+    def close(self) -> None:
+        self.__connection.close()
+
+    def __load(self, key: tuple[str, str]) -> ChannelSettings:
+        defaults: ChannelSettings = self.__modules[key[0]]
+        settings: ChannelSettings = ChannelSettings(dict(defaults.modes), dict(defaults.variables))
+        self.__loads += 1
+        for kind, name, value in self.__connection.execute("""
+                                                           SELECT kind, name, value
+                                                           FROM channel_config
+                                                           WHERE module = :module AND channel_name = :channel_name
+                                                           """,
+                                                           {"module" : key[0], "channel_name" : key[1]}):
+            ## Settings a module no longer accepts are ignored.
+            values: dict[str, Any] = settings.modes if kind == "mode" else settings.variables
+            if name in values:
+                values[name] = json.loads(value)
+
+        self.__settings[key] = settings
+        if len(self.__settings) > self.__capacity:
+            self.__settings.popitem(last=False)
+        return settings
+
+    def __store(self, module_name: str, channel_name: str, kind: str, name: str, value: Any) -> None:
+        with self.__connection:
+            self.__connection.execute("""
+                                      INSERT OR REPLACE INTO channel_config
+                                      VALUES (:channel_name, :module, :kind, :name, :value)
+                                      """,
+                                      {"channel_name" : channel_name, "module" : module_name,
+                                       "kind" : kind, "name" : name, "value" : json.dumps(value)})
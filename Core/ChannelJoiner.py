@@ -0,0 +1,437 @@
+import asyncio
+from datetime import datetime
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Optional
+from urllib.parse import urlencode
+import aiohttp
+from aiohttp import web
+from twitchio.ext import commands
+
+from Core.Helix import HelixClient, HelixError
+from Core.Metrics import REGISTRY, Counter
+from Core.SendScheduler import TokenBucket
+
+__all__ = ("OAUTH_URL",
+           "ChannelCredentials",
+           "ChannelRegistry",
+           "OAuthClient",
+           "ChannelJoiner")
+
+OAUTH_URL: str = "https://id.twitch.tv/oauth2"
+
+_CHANNELS_JOINED: Counter = REGISTRY.counter("olliebot_channels_joined_total", "Channels joined by the channel joiner.")
+_TOKENS_REFRESHED: Counter = REGISTRY.counter("olliebot_tokens_refreshed_total", "Channel tokens refreshed before they expired.")
+_TOKEN_FAILURES: Counter = REGISTRY.counter("olliebot_token_failures_total", "Channel tokens that could not be refreshed.")
+
+def _read_tokens(tokens: dict[str, Any]) -> tuple[str, str, float]:
+    "Read the access token, refresh token and the unix time it expires at from a token response, raises a `ValueError` if any are missing."
+    access_token: Any = tokens.get("access_token")
+    refresh_token: Any = tokens.get("refresh_token")
+    expires_in: Any = tokens.get("expires_in")
+    if (not isinstance(access_token, str) or not access_token
+        or not isinstance(refresh_token, str) or not refresh_token
+        or not isinstance(expires_in, (int, float)) or isinstance(expires_in, bool)):
+        raise ValueError("The token response is missing its tokens or their expiry.")
+    return (access_token, refresh_token, time.time() + expires_in)
+
+class ChannelCredentials:
+    "The API credentials a channel's owner granted the bot."
+
+    __slots__ = ("channel_name",
+                 "owner_id",
+                 "access_token",
+                 "refresh_token",
+                 "expires_at",
+                 "tokens_valid")
+
+    def __init__(self,
+                 channel_name: str,
+                 owner_id: str,
+                 access_token: str,
+                 refresh_token: str,
+                 expires_at: float,
+                 tokens_valid: bool = True
+                 ) -> None:
+        self.channel_name: str = channel_name
+        self.owner_id: str = owner_id
+        self.access_token: str = access_token
+        self.refresh_token: str = refresh_token
+        ## The unix time the access token expires at.
+        self.expires_at: float = expires_at
+        self.tokens_valid: bool = tokens_valid
+
+class ChannelRegistry:
+    """
+    The channels the bot has been invited to, and their owners' credentials, stored in SQLite.
+
+    Fields are:
+        - channel_name: varchar(255) PRIMARY KEY,
+        - owner_id: varchar(255),
+        - join_date: text,
+        - enabled: int,
+        - auth_token: text,
+        - refresh_token: text,
+        - tokens_valid: int,
+        - expires_at: real.
+    """
+
+    __slots__ = ("__connection",
+                 "__lock")
+
+    def __init__(self, database_path: str = "SQL/twitch_channels.sqlite3") -> None:
+        ## The registry is used from worker threads, so that the event loop never waits on the database.
+        self.__connection: sqlite3.Connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.__lock: threading.Lock = threading.Lock()
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        with self.__connection:
+            self.__connection.execute("""
+                                      CREATE TABLE IF NOT EXISTS channels (channel_name varchar(255) NOT NULL PRIMARY KEY,
+                                                                           owner_id varchar(255),
+                                                                           join_date text,
+                                                                           enabled int DEFAULT 1,
+                                                                           auth_token text,
+                                                                           refresh_token text,
+                                                                           tokens_valid int DEFAULT 0,
+                                                                           expires_at real DEFAULT 0)
+                                      """)
+
+    def save(self, credentials: ChannelCredentials) -> None:
+        "Save a channel and its credentials, enabling it, keeping its original join date if it was already registered."
+        with self.__lock, self.__connection:
+            self.__connection.execute("""
+                                      INSERT INTO channels
+                                      VALUES (:channel_name, :owner_id, :join_date, 1, :auth_token, :refresh_token, :tokens_valid, :expires_at)
+                                      ON CONFLICT (channel_name) DO UPDATE
+                                      SET owner_id = excluded.owner_id,
+                                          enabled = 1,
+                                          auth_token = excluded.auth_token,
+                                          refresh_token = excluded.refresh_token,
+                                          tokens_valid = excluded.tokens_valid,
+                                          expires_at = excluded.expires_at
+                                      """,
+                                      {"channel_name" : credentials.channel_name,
+                                       "owner_id" : credentials.owner_id,
+                                       "join_date" : datetime.now().isoformat(timespec="seconds"),
+                                       "auth_token" : credentials.access_token,
+                                       "refresh_token" : credentials.refresh_token,
+                                       "tokens_valid" : int(credentials.tokens_valid),
+                                       "expires_at" : credentials.expires_at})
+
+    def load_enabled(self) -> list[ChannelCredentials]:
+        "Load the credentials of every enabled channel."
+        with self.__lock:
+            return [ChannelCredentials(channel_name, owner_id or "", auth_token or "", refresh_token or "",
+                                       expires_at or 0.0, bool(tokens_valid))
+                    for channel_name, owner_id, auth_token, refresh_token, expires_at, tokens_valid
+                    in self.__connection.execute("""
+                                                 SELECT channel_name, owner_id, auth_token, refresh_token, expires_at, tokens_valid
+                                                 FROM channels
+                                                 WHERE enabled
+                                                 """)]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+class OAuthClient:
+    "Client for the Twitch OAuth authorization code flow, sharing the Helix client's connection pool."
+
+    __slots__ = ("__helix",
+                 "__client_secret",
+                 "__redirect_uri",
+                 "__base_url")
+
+    def __init__(self,
+                 helix: HelixClient,
+                 client_secret: str,
+                 redirect_uri: str,
+                 base_url: str = OAUTH_URL
+                 ) -> None:
+        self.__helix: HelixClient = helix
+        self.__client_secret: str = client_secret
+        self.__redirect_uri: str = redirect_uri
+        self.__base_url: str = base_url.rstrip("/")
+
+    def authorize_url(self, scopes: Iterable[str], state: str) -> str:
+        "The url a channel owner visits to grant the bot access to their channel."
+        return f"{self.__base_url}/authorize?" + urlencode({"response_type" : "code",
+                                                            "client_id" : str(self.__helix.client_id),
+                                                            "redirect_uri" : self.__redirect_uri,
+                                                            "scope" : " ".join(scopes),
+                                                            "state" : state})
+
+    async def exchange_code(self, code: str) -> dict[str, Any]:
+        "Exchange an authorization code for an access token and refresh token."
+        return await self.__post_token({"grant_type" : "authorization_code",
+                                        "code" : code,
+                                        "redirect_uri" : self.__redirect_uri})
+
+    async def refresh(self, refresh_token: str) -> dict[str, Any]:
+        "Get a new access token and refresh token with a refresh token."
+        return await self.__post_token({"grant_type" : "refresh_token",
+                                        "refresh_token" : refresh_token})
+
+    async def validate(self, access_token: str) -> dict[str, Any]:
+        "Validate an access token, giving the login and user id of the user it belongs to."
+        return await self.__request("GET", "validate", headers={"Authorization" : f"OAuth {access_token}"})
+
+    async def __post_token(self, data: dict[str, str]) -> dict[str, Any]:
+        return await self.__request("POST", "token", data={"client_id" : str(self.__helix.client_id),
+                                                           "client_secret" : self.__client_secret,
+                                                           **data})
+
+    async def __request(self, method: str, endpoint: str, **kwargs: Any) -> dict[str, Any]:
+        "Make a request to an OAuth endpoint, raises a `ValueError` if it succeeds without a JSON object."
+        try:
+            async with self.__helix.session.request(method, f"{self.__base_url}/{endpoint}", **kwargs) as response:
+                try:
+                    data: Any = await response.json(content_type=None)
+                except ValueError:
+                    data = None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise HelixError("Connection Error", 0, str(error) or type(error).__name__) from error
+        if not isinstance(data, dict):
+            if response.status != 200:
+                raise HelixError("OAuth Error", response.status, "")
+            raise ValueError(f"The {endpoint} response is not a JSON object.")
+        if response.status != 200:
+            raise HelixError(data.get("error", "OAuth Error"), data.get("status", response.status), data.get("message", ""))
+        return data
+
+class ChannelJoiner:
+    """
+    Onboards channels whose owners have authorized the bot, without restarting it.
+
+    A redirect listener receives the authorization code, which is exchanged for tokens that are
+    validated to find the channel and its owner. The channel and its credentials are saved to the
+    registry and cached in memory, and the channel is queued to be joined.
+    Queued channels are joined in batches within Twitch's join rate limit, by a background task,
+    so onboarding never blocks the chat path. Another background task refreshes tokens before they expire.
+
+    Under a supervisor, one worker onboards channels without joining them, for the supervisor to assign them
+    to a worker when it next reads the registry, and the other workers only keep the credentials cached,
+    reloading them from the registry as the onboarding worker refreshes them.
+    """
+
+    __slots__ = ("__bot",
+                 "__registry",
+                 "__oauth",
+                 "__host",
+                 "__port",
+                 "__join",
+                 "__scopes",
+                 "__join_batch",
+                 "__join_bucket",
+                 "__refresh_margin",
+                 "__credentials",
+                 "__states",
+                 "__join_queue",
+                 "__runner",
+                 "__tasks")
+
+    def __init__(self,
+                 bot: commands.Bot,
+                 registry: ChannelRegistry,
+                 oauth: OAuthClient,
+                 port: Optional[int],
+                 host: str = "0.0.0.0",
+                 join: bool = True,
+                 scopes: Iterable[str] = ("moderator:manage:banned_users",),
+                 join_limit: tuple[int, float] = (20, 10.0),
+                 refresh_margin: float = 600.0
+                 ) -> None:
+        """
+        Create a channel joiner.
+
+        Parameters
+        ----------
+        `port: Optional[int]` - The port the redirect listener serves `/authorize` and `/callback` on,
+        or None to neither onboard channels nor refresh tokens, only reloading the credentials from the registry every minute.
+
+        `join: bool = True` - Whether onboarded channels are joined, otherwise they are only saved to the registry.
+
+        `scopes: Iterable[str]` - The scopes channel owners are asked to grant.
+
+        `join_limit: tuple[int, float] = (20, 10.0)` - The number of channels that may be joined per period in seconds.
+
+        `refresh_margin: float = 600.0` - Tokens are refreshed when they expire within this many seconds.
+        """
+        self.__bot: commands.Bot = bot
+        self.__registry: ChannelRegistry = registry
+        self.__oauth: OAuthClient = oauth
+        self.__host: str = host
+        self.__port: Optional[int] = port
+        self.__join: bool = join
+        self.__scopes: tuple[str, ...] = tuple(scopes)
+        self.__join_batch: int = join_limit[0]
+        self.__join_bucket: TokenBucket = TokenBucket(*join_limit)
+        self.__refresh_margin: float = refresh_margin
+
+        ## Maps channel names to their credentials.
+        self.__credentials: dict[str, ChannelCredentials] = {}
+        ## Maps the states of authorization requests that have not been redirected yet to the time they expire.
+        self.__states: dict[str, float] = {}
+        self.__join_queue: Optional[asyncio.Queue] = None
+        self.__runner: Optional[web.AppRunner] = None
+        self.__tasks: list[asyncio.Task] = []
+
+    def credentials(self, channel_name: str) -> Optional[ChannelCredentials]:
+        "Get the cached credentials of a channel, or None if it has none."
+        return self.__credentials.get(channel_name.lower())
+
+    def broadcaster_token(self, channel_name: str) -> Optional[tuple[int, str]]:
+        "Get the user id and access token of a channel's owner, for making API requests as them, or None if they have no valid token."
+        credentials: Optional[ChannelCredentials] = self.__credentials.get(channel_name.lower())
+        if credentials is None or not credentials.tokens_valid or not credentials.owner_id.isdigit():
+            return None
+        return (int(credentials.owner_id), credentials.access_token)
+
+    async def start(self, join_registered: bool = False) -> None:
+        """
+        Load the registry into the credential cache, and start the redirect listener and background tasks.
+
+        Registered channels are only joined if requested, since they are usually the bot's initial channels.
+        """
+        if self.__tasks:
+            return
+        self.__join_queue = asyncio.Queue()
+        for credentials in await asyncio.to_thread(self.__registry.load_enabled):
+            self.__credentials[credentials.channel_name] = credentials
+            if join_registered:
+                self.__join_queue.put_nowait(credentials.channel_name)
+
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        if self.__port is None:
+            self.__tasks = [loop.create_task(self.__reload_credentials())]
+            return
+        application: web.Application = web.Application()
+        application.router.add_get("/authorize", self.__handle_authorize)
+        application.router.add_get("/callback", self.__handle_callback)
+        self.__runner = web.AppRunner(application, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.__host, self.__port).start()
+        self.__tasks = [loop.create_task(self.__join_channels()),
+                        loop.create_task(self.__refresh_tokens())]
+
+    async def close(self) -> None:
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+        self.__registry.close()
+
+    ##################################################
+    #### Redirect listener
+
+    async def __handle_authorize(self, request: web.Request) -> web.Response:
+        "Redirect a channel owner to Twitch to authorize the bot, with a single use state to check the redirect against."
+        time_now: float = time.time()
+        for state in [state for state, expires_at in self.__states.items() if expires_at < time_now]:
+            del self.__states[state]
+        state: str = secrets.token_urlsafe(16)
+        self.__states[state] = time_now + 600.0
+        raise web.HTTPFound(self.__oauth.authorize_url(self.__scopes, state))
+
+    async def __handle_callback(self, request: web.Request) -> web.Response:
+        "Onboard the channel of an owner redirected back from Twitch."
+        if self.__states.pop(request.query.get("state", ""), 0.0) < time.time():
+            return web.Response(status=400, text="This authorization link has expired, please try again.")
+        if "code" not in request.query:
+            return web.Response(status=400, text=f"Authorization was not granted: {request.query.get('error_description', 'no code was given')}.")
+        try:
+            channel_name: str = await self.onboard(request.query["code"])
+        except HelixError as error:
+            print(f"Failed to onboard a channel: {error}")
+            return web.Response(status=502, text="Twitch could not confirm the authorization, please try again.")
+        except ValueError as error:
+            print(f"Failed to onboard a channel: {error}")
+            return web.Response(status=400, text="Twitch did not confirm the authorization, please try again.")
+        return web.Response(text=f"OllieBot will join {channel_name} shortly.")
+
+    async def onboard(self, code: str) -> str:
+        """
+        Exchange an authorization code, save the channel it belongs to, and queue the channel to be joined if this joiner joins channels.
+
+        Raises a `HelixError` if Twitch rejects the code or cannot be reached, and a `ValueError` if its responses are malformed.
+        """
+        access_token, refresh_token, expires_at = _read_tokens(await self.__oauth.exchange_code(code))
+        validation: dict[str, Any] = await self.__oauth.validate(access_token)
+        login: Any = validation.get("login")
+        owner_id: Any = validation.get("user_id")
+        if not isinstance(login, str) or not login or not isinstance(owner_id, str) or not owner_id.isdigit():
+            raise ValueError("The validate response is missing the login or user id of the token's owner.")
+        credentials: ChannelCredentials = ChannelCredentials(login.lower(), owner_id, access_token, refresh_token, expires_at)
+        await asyncio.to_thread(self.__registry.save, credentials)
+        self.__credentials[credentials.channel_name] = credentials
+        if self.__join:
+            self.__join_queue.put_nowait(credentials.channel_name)
+        return credentials.channel_name
+
+    ##################################################
+    #### Background tasks
+
+    async def __join_channels(self) -> None:
+        "Join queued channels in batches, as fast as the join rate limit allows."
+        while True:
+            batch: list[str] = [await self.__join_queue.get()]
+            while len(batch) < self.__join_batch and not self.__join_queue.empty():
+                batch.append(self.__join_queue.get_nowait())
+
+            ## Each channel takes a token, a batch larger than the tokens available is split.
+            joined: set[str] = {channel.name for channel in self.__bot.connected_channels}
+            batch = [channel_name for channel_name in dict.fromkeys(batch) if channel_name not in joined]
+            while batch:
+                await asyncio.sleep(self.__join_bucket.wait_time(time.monotonic()))
+                available: int = max(1, int(self.__join_bucket.tokens))
+                part, batch = batch[:available], batch[available:]
+                for _ in part:
+                    self.__join_bucket.take()
+                try:
+                    await self.__bot.join_channels(part)
+                    _CHANNELS_JOINED.inc(len(part))
+                except Exception as error:
+                    print(f"Failed to join {part}: {error}")
+
+    async def __reload_credentials(self) -> None:
+        "Reload the credentials of every channel from the registry every minute, as another process onboards channels and refreshes their tokens."
+        while True:
+            await asyncio.sleep(60.0)
+            self.__credentials = {credentials.channel_name : credentials
+                                  for credentials in await asyncio.to_thread(self.__registry.load_enabled)}
+
+    async def __refresh_tokens(self) -> None:
+        "Refresh the tokens of every channel whose access token expires within the refresh margin."
+        while True:
+            time_now: float = time.time()
+            expiring: list[ChannelCredentials] = [credentials for credentials in self.__credentials.values()
+                                                  if credentials.tokens_valid and credentials.refresh_token
+                                                  and credentials.expires_at - time_now < self.__refresh_margin]
+            for credentials in expiring:
+                try:
+                    tokens: tuple[str, str, float] = _read_tokens(await self.__oauth.refresh(credentials.refresh_token))
+                    credentials.access_token, credentials.refresh_token, credentials.expires_at = tokens
+                    _TOKENS_REFRESHED.inc()
+                except ValueError as error:
+                    ## A malformed response is retried on the next pass, like a connection error.
+                    print(f"Failed to refresh the tokens of {credentials.channel_name}: {error}")
+                    continue
+                except HelixError as error:
+                    print(f"Failed to refresh the tokens of {credentials.channel_name}: {error}")
+                    ## Connection errors are retried on the next pass, a rejected refresh token needs the owner to authorize the bot again.
+                    if error.status not in (400, 401):
+                        continue
+                    credentials.tokens_valid = False
+                    _TOKEN_FAILURES.inc()
+                await asyncio.to_thread(self.__registry.save, credentials)
+
+            ## Sleep until the next token enters the refresh margin, checking at least once a minute.
+            next_expiry: float = min((credentials.expires_at for credentials in self.__credentials.values()
+                                      if credentials.tokens_valid and credentials.refresh_token),
+                                     default=float("inf"))
+            await asyncio.sleep(min(60.0, max(5.0, next_expiry - self.__refresh_margin - time.time())))
@@ -0,0 +1,218 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import random
+import sys
+from typing import Iterable, Optional
+
+from Core.Helix import HelixClient, HelixError
+from Core.Metrics import REGISTRY, Counter
+
+__all__ = ("ChatterCache",
+           "surrogate_id")
+
+_LOOKUPS: Counter = REGISTRY.counter("olliebot_chatter_lookups_total", "Chatter names resolved to user ids through Helix.")
+_RETRIES: Counter = REGISTRY.counter("olliebot_chatter_lookup_retries_total", "Chatter lookups retried after a temporary Helix failure.")
+
+def surrogate_id(chatter_name: str) -> int:
+    """
+    A stand-in user id for a chatter whose real id is not known, such as a chatter from an old score table or a log.
+
+    Surrogate ids are negative, so they never collide with Twitch user ids, and are the same
+    in every process, so results recorded for the same name in different places land on the same row.
+    """
+    digest: bytes = hashlib.blake2b(chatter_name.lower().encode(), digest_size=7).digest()
+    return -(int.from_bytes(digest, "big") + 1)
+
+class ChatterCache:
+    """
+    An interning cache between chatter names and Twitch user ids.
+
+    Every chat message carries its sender's id, so the cache learns the names and ids of active chatters
+    for free, and names given as command arguments are resolved with batched Helix `/users` lookups.
+    Names are stored lowercased and interned, so every row, event and leaderboard entry for a
+    chatter shares a single string. When a chatter is renamed, their id maps to the new name and the old name is forgotten.
+    Least recently seen chatters are evicted once the cache is full.
+    Single names looked up in the same event loop iteration share one batched request,
+    and a request that fails temporarily, such as when rate limited, is retried with exponential backoff.
+    """
+
+    __slots__ = ("__helix",
+                 "__capacity",
+                 "__max_retries",
+                 "__backoff",
+                 "__ids",
+                 "__names",
+                 "__pending",
+                 "__in_flight",
+                 "__flush_scheduled",
+                 "__lookup_tasks")
+
+    def __init__(self, helix: HelixClient, capacity: int = 100_000, max_retries: int = 2, backoff: float = 0.5) -> None:
+        """
+        Create a chatter cache looking up names through the given client.
+
+        Parameters
+        ----------
+        `helix: HelixClient` - The client names that are not cached are looked up through.
+
+        `capacity: int = 100_000` - The maximum number of chatters to hold in memory.
+
+        `max_retries: int = 2` - The number of times a single name's lookup is retried before it is reported as failed.
+
+        `backoff: float = 0.5` - The time in seconds before the first retry, doubling with each retry.
+        """
+        self.__helix: HelixClient = helix
+        self.__capacity: int = capacity
+        self.__max_retries: int = max_retries
+        self.__backoff: float = backoff
+        ## Maps chatter names to user ids in order of use, and user ids back to names.
+        self.__ids: OrderedDict[str, int] = OrderedDict()
+        self.__names: dict[int, str] = {}
+        ## Single name lookups waiting to be sent, and those with a request in flight, mapped to their shared result.
+        self.__pending: dict[str, asyncio.Future] = {}
+        self.__in_flight: dict[str, asyncio.Future] = {}
+        self.__flush_scheduled: bool = False
+        self.__lookup_tasks: set[asyncio.Task] = set()
+        REGISTRY.gauge("olliebot_chatters_cached", "Chatter names with a cached user id.", function=lambda: len(self.__ids))
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+    def observe(self, chatter_name: str, user_id: int) -> str:
+        "Record that a chatter has the given name and id, and return the interned name."
+        name: Optional[str] = self.__names.get(user_id)
+        if name is not None and (name == chatter_name or name == chatter_name.lower()):
+            self.__ids.move_to_end(name)
+            return name
+
+        name = sys.intern(chatter_name.lower())
+        ## A renamed chatter's old name no longer refers to them.
+        if (previous := self.__names.get(user_id)) is not None:
+            self.__ids.pop(previous, None)
+        ## A name taken over by another account no longer refers to the old one.
+        if (previous_id := self.__ids.get(name)) is not None:
+            self.__names.pop(previous_id, None)
+        self.__ids[name] = user_id
+        self.__ids.move_to_end(name)
+        self.__names[user_id] = name
+        if len(self.__ids) > self.__capacity:
+            _, evicted_id = self.__ids.popitem(last=False)
+            self.__names.pop(evicted_id, None)
+        return name
+
+    def items(self) -> list[tuple[str, int]]:
+        "Get the name and user id of every cached chatter, least recently seen first."
+        return list(self.__ids.items())
+
+    def restore(self, chatters: Iterable[tuple[str, int]]) -> None:
+        "Record the names and user ids of chatters, given least recently seen first, such as from a snapshot of the bot's last run."
+        for chatter_name, user_id in chatters:
+            ## Chatters the cache knows nothing about are inserted directly, as there is no rename or taken name to handle.
+            if user_id in self.__names or (chatter_name := chatter_name.lower()) in self.__ids:
+                self.observe(chatter_name, user_id)
+                continue
+            name: str = sys.intern(chatter_name)
+            self.__ids[name] = user_id
+            self.__names[user_id] = name
+        while len(self.__ids) > self.__capacity:
+            _, evicted_id = self.__ids.popitem(last=False)
+            self.__names.pop(evicted_id, None)
+
+    def get_id(self, chatter_name: str) -> Optional[int]:
+        "Get a chatter's user id from memory, or None if it is not cached."
+        return self.__ids.get(chatter_name.lower())
+
+    def get_name(self, user_id: int) -> Optional[str]:
+        "Get the name of the chatter with the given user id from memory, or None if it is not cached."
+        return self.__names.get(user_id)
+
+    async def resolve(self, chatter_names: Iterable[str]) -> dict[str, int]:
+        """
+        Get the user ids of chatters, looking up every name that is not cached in batched Helix requests.
+
+        Names that do not exist, or that could not be looked up, are omitted.
+        """
+        user_ids: dict[str, int] = {}
+        missing: list[str] = []
+        for chatter_name in chatter_names:
+            name: str = chatter_name.lower()
+            user_id: Optional[int] = self.__ids.get(name)
+            if user_id is not None:
+                user_ids[name] = user_id
+            else: missing.append(name)
+        if missing:
+            _LOOKUPS.inc(len(missing))
+            try:
+                found: dict[str, str] = await self.__helix.get_user_ids(missing)
+            except HelixError as error:
+                print(f"Failed to look up chatters: {error}")
+                return user_ids
+            for name, user_id in found.items():
+                user_ids[self.observe(name, int(user_id))] = int(user_id)
+        return user_ids
+
+    async def resolve_one(self, chatter_name: str) -> Optional[int]:
+        """
+        Get the user id of a chatter, looking it up if it is not cached, or None if they do not exist.
+
+        Lookups made in the same event loop iteration are merged into a single batched request,
+        and lookups for a name that already has a request in flight share its result.
+        Raises `HelixError` if the lookup still failed after its retries, so a chatter is never mistaken for one that does not exist.
+        """
+        name: str = chatter_name.lower()
+        user_id: Optional[int] = self.__ids.get(name)
+        if user_id is not None:
+            return user_id
+        future: Optional[asyncio.Future] = self.__in_flight.get(name) or self.__pending.get(name)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.__pending[name] = future
+            if not self.__flush_scheduled:
+                self.__flush_scheduled = True
+                loop.call_soon(self.__flush_lookups)
+        return await asyncio.shield(future)
+
+    def __flush_lookups(self) -> None:
+        "Send all pending single name lookups as one batched request."
+        self.__flush_scheduled = False
+        batch: dict[str, asyncio.Future] = self.__pending
+        self.__pending = {}
+        self.__in_flight.update(batch)
+        task: asyncio.Task = asyncio.get_running_loop().create_task(self.__fetch_lookups(batch))
+        self.__lookup_tasks.add(task)
+        task.add_done_callback(self.__lookup_tasks.discard)
+
+    async def __fetch_lookups(self, batch: dict[str, asyncio.Future]) -> None:
+        _LOOKUPS.inc(len(batch))
+        attempt: int = 0
+        try:
+            while True:
+                try:
+                    found: dict[str, str] = await self.__helix.get_user_ids(batch)
+                    break
+                except HelixError as error:
+                    ## Rate limits, connection errors and server errors are temporary, anything else will fail again.
+                    if not (error.status == 429 or error.status == 0 or error.status >= 500) or attempt >= self.__max_retries:
+                        raise
+                    _RETRIES.inc()
+                    backoff: float = self.__backoff * (2 ** attempt) * (1.0 + (random.random() / 2.0))
+                    attempt += 1
+                    await asyncio.sleep(max(backoff, error.retry_after or 0.0))
+        except Exception as error:
+            print(f"Failed to look up chatters: {error}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+                    ## Mark the exception as retrieved in case every waiter was cancelled.
+                    future.exception()
+        else:
+            user_ids: dict[str, int] = {self.observe(name, int(user_id)) : int(user_id) for name, user_id in found.items()}
+            for name, future in batch.items():
+                if not future.done():
+                    future.set_result(user_ids.get(name))
+        finally:
+            for name, future in batch.items():
+                if self.__in_flight.get(name) is future:
+                    del self.__in_flight[name]
@@ -0,0 +1,226 @@
+import importlib
+import json
+import sys
+import time
+from types import ModuleType
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from twitchio.ext import commands
+
+from Core.Metrics import REGISTRY, Counter
+
+__all__ = ("CogSpec",
+           "CogLoader")
+
+_LOADS: Counter = REGISTRY.counter("olliebot_cog_loads_total", "Cogs imported and constructed, including reloads.")
+
+class CogSpec:
+    "A cog as described by the manifest, known before its module is imported."
+
+    __slots__ = ("name",
+                 "module",
+                 "module_name",
+                 "commands",
+                 "handlers")
+
+    def __init__(self,
+                 name: str,
+                 module: str,
+                 module_name: str,
+                 commands: Iterable[str] = (),
+                 handlers: Iterable[str] = ()
+                 ) -> None:
+        ## The cog's class name, which is also its name once added to the bot.
+        self.name: str = name
+        ## The module the cog's class is defined in.
+        self.module: str = module
+        ## The name the cog's modes and variables are kept under in the channel config.
+        self.module_name: str = module_name
+        ## The commands that load the cog on first use, including aliases.
+        self.commands: tuple[str, ...] = tuple(commands)
+        ## The cog's methods the bot calls from its message path, which load the cog on first call.
+        self.handlers: tuple[str, ...] = tuple(handlers)
+
+    @classmethod
+    def from_manifest(cls, entry: dict[str, Any]) -> "CogSpec":
+        "Create a spec from an entry of the manifest, raises a `ValueError` if the entry is invalid."
+        try:
+            return cls(entry["class"], entry["module"], entry["module_name"],
+                       entry.get("commands", ()), entry.get("handlers", ()))
+        except (KeyError, TypeError) as error:
+            raise ValueError(f"Invalid cog manifest entry {entry!r}: missing {error}.") from error
+
+class CogLoader:
+    """
+    Loads the bot's cogs lazily from a manifest, and reloads them in place.
+
+    The manifest lists each cog's class, module, and the commands and handlers that need it,
+    so nothing under `Cogs/` is imported at startup. A cog's module is imported and the cog is
+    constructed and added to the bot on its first command or handler call, or when it is loaded explicitly.
+    A loaded cog can be reloaded without touching the IRC connection, its module is re-imported and a new
+    instance replaces the old one, which is unloaded first so it can commit and close anything it holds.
+    Work a cog would otherwise block the event loop on while unloading, such as waiting on writes, goes in an
+    async `prepare_unload` method, which a reload awaits before unloading it.
+    State kept on the old instance, such as pyramids in progress, does not survive a reload.
+    Only the cog's own module is re-imported, modules it imports keep their loaded versions.
+    The time taken to import and construct each cog is recorded per cog.
+    """
+
+    __slots__ = ("__bot",
+                 "__specs",
+                 "__commands",
+                 "__options",
+                 "__modules",
+                 "__generations",
+                 "__timings")
+
+    def __init__(self, bot: commands.Bot, manifest_path: str = "Cogs/manifest.json") -> None:
+        """
+        Create a cog loader for the given bot, reading the cogs from the given manifest.
+
+        The manifest is a JSON object with a list of cogs, each an object with;
+            - class: str, the cog's class name,
+            - module: str, the module its class is defined in,
+            - module_name: str, the name of its modes and variables in the channel config,
+            - commands: list[str], the commands that load it on first use,
+            - handlers: list[str], the methods the bot calls from its message path.
+        """
+        self.__bot: commands.Bot = bot
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            manifest: dict[str, Any] = json.load(manifest_file)
+        self.__specs: dict[str, CogSpec] = {}
+        for entry in manifest.get("cogs", []):
+            spec: CogSpec = CogSpec.from_manifest(entry)
+            self.__specs[spec.name] = spec
+
+        ## Maps command names to the cog that defines them.
+        self.__commands: dict[str, str] = {command : spec.name for spec in self.__specs.values()
+                                           for command in spec.commands}
+
+        ## Functions giving the keyword arguments each cog is constructed with, called each time it is loaded.
+        self.__options: dict[str, Callable[[], dict[str, Any]]] = {}
+        self.__modules: dict[str, ModuleType] = {}
+        ## Incremented each time a cog is loaded or unloaded, so handlers know when to look up their method again.
+        self.__generations: dict[str, int] = {name : 0 for name in self.__specs}
+        ## Maps cog names to the seconds their most recent load spent importing and constructing.
+        self.__timings: dict[str, tuple[float, float]] = {}
+
+    @property
+    def specs(self) -> dict[str, CogSpec]:
+        "The cogs in the manifest, by name."
+        return dict(self.__specs)
+
+    @property
+    def timings(self) -> dict[str, tuple[float, float]]:
+        "The seconds spent importing and constructing each loaded cog in its most recent load."
+        return dict(self.__timings)
+
+    def configure(self, cog_name: str, options: Callable[[], dict[str, Any]]) -> None:
+        "Set the function giving the keyword arguments a cog is constructed with, beyond the bot."
+        if cog_name not in self.__specs:
+            raise KeyError(f"Unknown cog: {cog_name}")
+        self.__options[cog_name] = options
+
+    def get(self, cog_name: str) -> Optional[commands.Cog]:
+        "Get a cog if it is loaded, without loading it."
+        return self.__bot.cogs.get(cog_name)
+
+    def find_module(self, module_name: str) -> Optional[str]:
+        "Get the name of the cog whose modes and variables are kept under the given module name, or None if there is none."
+        for spec in self.__specs.values():
+            if spec.module_name == module_name:
+                return spec.name
+        return None
+
+    ##################################################
+    #### Loading
+
+    def load(self, cog_name: str) -> commands.Cog:
+        "Get a cog, importing and constructing it if it is not loaded, raises a `KeyError` if it is not in the manifest."
+        cog: Optional[commands.Cog] = self.__bot.cogs.get(cog_name)
+        if cog is not None:
+            return cog
+        spec: CogSpec = self.__specs[cog_name]
+        start: float = time.perf_counter()
+        module: ModuleType = self.__modules.get(spec.module) or importlib.import_module(spec.module)
+        return self.__construct(spec, module, time.perf_counter() - start)
+
+    def load_for_command(self, command_name: str) -> Optional[commands.Cog]:
+        "Load the cog that defines a command, if it is not loaded, and return it, or None if no cog in the manifest defines it."
+        cog_name: Optional[str] = self.__commands.get(command_name)
+        if cog_name is None:
+            return None
+        return self.load(cog_name)
+
+    def unload(self, cog_name: str) -> bool:
+        "Remove a cog from the bot, which calls its `cog_unload`, and return whether it was loaded."
+        if cog_name not in self.__bot.cogs:
+            return False
+        self.__bot.remove_cog(cog_name)
+        self.__generations[cog_name] += 1
+        return True
+
+    async def reload(self, cog_name: str) -> commands.Cog:
+        """
+        Re-import a cog's module and replace the cog with a new instance, loading it if it is not loaded.
+
+        If the module fails to import, the old cog is left loaded and the error is raised.
+        """
+        spec: CogSpec = self.__specs[cog_name]
+        start: float = time.perf_counter()
+        module: Optional[ModuleType] = self.__modules.get(spec.module) or sys.modules.get(spec.module)
+        ## The module is re-imported before the old cog is unloaded, so a syntax error leaves the old cog running.
+        module = importlib.reload(module) if module is not None else importlib.import_module(spec.module)
+        import_seconds: float = time.perf_counter() - start
+        if (prepare_unload := getattr(self.__bot.cogs.get(cog_name), "prepare_unload", None)) is not None:
+            await prepare_unload()
+        self.unload(cog_name)
+        return self.__construct(spec, module, import_seconds)
+
+    def close(self) -> None:
+        "Unload every loaded cog, in the reverse order of the manifest."
+        for cog_name in reversed(self.__specs):
+            self.unload(cog_name)
+
+    def __construct(self, spec: CogSpec, module: ModuleType, import_seconds: float) -> commands.Cog:
+        "Construct a cog from its imported module and add it to the bot, recording how long its load took."
+        start: float = time.perf_counter()
+        cog: commands.Cog = getattr(module, spec.name)(self.__bot, **self.__options.get(spec.name, dict)())
+        self.__bot.add_cog(cog)
+        init_seconds: float = time.perf_counter() - start
+
+        self.__modules[spec.module] = module
+        self.__generations[spec.name] += 1
+        self.__timings[spec.name] = (import_seconds, init_seconds)
+        _LOADS.inc()
+        for stage, seconds in (("import", import_seconds), ("init", init_seconds)):
+            REGISTRY.gauge("olliebot_cog_load_seconds", "Seconds the most recent load of a cog spent, by cog and stage.",
+                           {"cog" : spec.name, "stage" : stage}).set(seconds)
+        if unlisted := set(cog.commands) - set(spec.commands):
+            print(f"Commands of {spec.name} missing from the cog manifest, they cannot load it: {', '.join(sorted(unlisted))}")
+        return cog
+
+    ##################################################
+    #### Handlers
+
+    def handler(self, cog_name: str, method_name: str) -> Callable[..., Awaitable[Any]]:
+        """
+        Get a function calling one of a cog's handlers, which loads the cog on its first call.
+
+        The bound method is looked up again only after the cog is loaded, unloaded or reloaded,
+        so once the cog is loaded a call costs one comparison more than calling the method directly.
+        Raises a `KeyError` if the handler is not listed for the cog in the manifest.
+        """
+        if method_name not in self.__specs[cog_name].handlers:
+            raise KeyError(f"{cog_name}.{method_name} is not a handler in the cog manifest.")
+        generations: dict[str, int] = self.__generations
+        bound: Optional[Callable[..., Awaitable[Any]]] = None
+        generation: int = -1
+
+        async def call_handler(*args: Any) -> Any:
+            nonlocal bound, generation
+            if generation != generations[cog_name]:
+                bound = getattr(self.load(cog_name), method_name)
+                generation = generations[cog_name]
+            return await bound(*args)
+        call_handler.__name__ = method_name
+        return call_handler
@@ -0,0 +1,134 @@
+from typing import Any, Callable, Optional, Union
+from twitchio.ext import commands
+import twitchio
+
+__all__ = ("CommandString",
+           "ArgumentError",
+           "ArgumentSchema",
+           "arguments",
+           "get_argument_spec",
+           "parse_command_string")
+
+class CommandString:
+    """
+    A chat message decomposed into a command header, command name and arguments.
+
+    Messages are parsed once, the command string of a context is cached on the context
+    so that every handler of the same message shares it.
+    """
+
+    __slots__ = ("content",
+                 "header",
+                 "name",
+                 "arguments",
+                 "text")
+
+    def __init__(self, content: str, prefix: str = "?") -> None:
+        ## The full content of the message.
+        self.content: str = content
+
+        header, separator, text = content.partition(" ")
+
+        ## The command header, such as "?hello", or an empty string if the message is not a command.
+        self.header: str = header if header.startswith(prefix) else ""
+
+        ## The name of the command, the header without its prefix.
+        self.name: str = self.header[len(prefix):]
+
+        ## The words of the message that follow the header, or all the words of the message if it has no header.
+        self.arguments: list[str] = (text.split(" ") if separator else []) if self.header else content.split(" ")
+
+        ## The text of the message that follows the header, or the whole message if it has no arguments.
+        self.text: str = text if (self.header and separator) else content
+
+    @property
+    def is_command(self) -> bool:
+        "Whether the message starts with a command header."
+        return bool(self.header)
+
+def parse_command_string(message_or_context: Union[twitchio.Message, commands.Context]) -> CommandString:
+    "Get the command string of a message or context, parsing it only once per context."
+    if isinstance(message_or_context, commands.Context):
+        command_string: Optional[CommandString] = getattr(message_or_context, "command_string", None)
+        if command_string is None:
+            command_string = CommandString(str(message_or_context.message.content))
+            message_or_context.command_string = command_string
+        return command_string
+    return CommandString(str(message_or_context.content))
+
+##################################################
+#### Argument schemas
+
+class ArgumentError(ValueError):
+    "Raised when a command's arguments do not match its schema."
+
+class ArgumentSchema:
+    """
+    A compiled argument schema for a command.
+
+    Positional arguments are filled in order by words that are not options, and are required
+    unless their name ends with a question mark, in which case they are None when omitted.
+    Options are given as `-name value` and take a default when omitted.
+    Only declared option names are options, any other word starting with a dash, such as a negative number, is positional.
+    Surplus words are ignored.
+    """
+
+    __slots__ = ("__positionals",
+                 "__required",
+                 "__options")
+
+    def __init__(self, positionals: tuple[str, ...], options: dict[str, Any]) -> None:
+        self.__positionals: tuple[str, ...] = tuple(name.rstrip("?") for name in positionals)
+        ## The number of leading positional arguments that are required.
+        self.__required: int = sum(1 for name in positionals if not name.endswith("?"))
+        ## Maps option flags, such as "-user", to their (name, default value).
+        self.__options: dict[str, tuple[str, Any]] = {f"-{name}" : (name, default)
+                                                       for name, default in options.items()}
+
+    def parse(self, words: list[str]) -> dict[str, Any]:
+        "Parse a list of argument words into a mapping of argument names to values."
+        values: dict[str, Any] = {name : default for name, default in self.__options.values()}
+        values.update((name, None) for name in self.__positionals[self.__required:])
+        position: int = 0
+        index: int = 0
+        while index < len(words):
+            word: str = words[index]
+            index += 1
+            if not word:
+                continue
+            option: Optional[tuple[str, Any]] = self.__options.get(word)
+            if option is not None:
+                if index >= len(words) or not words[index]:
+                    raise ArgumentError(f"Option {word} requires a value.")
+                values[option[0]] = words[index]
+                index += 1
+                continue
+            if position < len(self.__positionals):
+                values[self.__positionals[position]] = word
+                position += 1
+
+        if position < self.__required:
+            raise ArgumentError(f"Missing argument: {self.__positionals[position]}.")
+        return values
+
+def arguments(*positionals: str, **options: Any) -> Callable[[Callable], Callable]:
+    """
+    Declare the argument schema of a command.
+
+    Must be applied beneath the `commands.command()` decorator, schemas are compiled when the cog class is defined.
+
+    ```
+    @commands.command()
+    @arguments("score", user=None)
+    async def pyramid_score(self, context: commands.Context) -> None:
+        ...
+    ```
+    """
+    def decorator(function: Callable) -> Callable:
+        function.__argument_spec__ = (positionals, options)
+        return function
+    return decorator
+
+def get_argument_spec(command: commands.Command) -> Optional[tuple[tuple[str, ...], dict[str, Any]]]:
+    "Get the argument spec declared on a command, or None if it has none."
+    return getattr(command._callback, "__argument_spec__", None)
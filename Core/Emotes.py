@@ -0,0 +1,348 @@
+import asyncio
+from functools import partial
+import glob
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Iterable, Mapping, Optional
+import aiohttp
+
+from Core.Helix import HelixClient, HelixError
+from Core.Metrics import REGISTRY, Counter
+
+__all__ = ("EMOTE_CACHE_PATH",
+           "THIRD_PARTY_EMOTE_URLS",
+           "EmoteRegistry",
+           "read_emote_cache",
+           "load_emote_sets")
+
+EMOTE_CACHE_PATH: str = "SQL/emotes.json"
+
+## The APIs of the third-party emote providers, each can be pointed at a local stand-in or left out.
+THIRD_PARTY_EMOTE_URLS: dict[str, str] = {"bttv" : "https://api.betterttv.net/3",
+                                          "ffz" : "https://api.frankerfacez.com/v1",
+                                          "7tv" : "https://7tv.io/v3"}
+
+_REFRESHES: Counter = REGISTRY.counter("olliebot_emote_refreshes_total", "Emote sets fetched, global or of a channel.")
+_REFRESH_ERRORS: Counter = REGISTRY.counter("olliebot_emote_refresh_errors_total", "Emote providers that failed to give a set.")
+
+class _ProviderError(Exception):
+    "Raised when an emote provider cannot be reached or gives an unexpected response."
+
+## An emote set read from the cache file is the epoch time it was fetched and its emotes.
+CachedEmotes = tuple[float, frozenset[str]]
+
+def read_emote_cache(cache_path: str) -> tuple[Optional[CachedEmotes], dict[str, CachedEmotes]]:
+    """
+    Read the global emotes, or None if they had never been fetched when the cache was written, and the emotes of only each channel.
+
+    Raises an `OSError` if the file cannot be read, or a `ValueError`, `KeyError` or `TypeError` if it is not an emote cache.
+    """
+    with open(cache_path, encoding="utf-8") as cache_file:
+        cache: dict[str, Any] = json.load(cache_file)
+    global_emotes: Optional[CachedEmotes] = None
+    if cache["global"] is not None:
+        global_emotes = (float(cache["global"]["updated"]), frozenset(cache["global"]["emotes"]))
+    return (global_emotes,
+            {channel_name : (float(entry["updated"]), frozenset(entry["emotes"]))
+             for channel_name, entry in cache["channels"].items()})
+
+def load_emote_sets(cache_path: str = EMOTE_CACHE_PATH) -> dict[str, frozenset[str]]:
+    """
+    Load the emotes usable in each channel from an emote cache file, exactly as an `EmoteRegistry` would on start,
+    for tools that detect pyramids offline. There are no sets if there is no cache, or none can be read.
+
+    The caches a supervisor's workers keep beside it, such as `emotes.0.json`, are read too,
+    and the most recently fetched emotes of each channel are used.
+    """
+    root, extension = os.path.splitext(cache_path)
+    global_emotes: Optional[CachedEmotes] = None
+    channel_emotes: dict[str, CachedEmotes] = {}
+    for path in [cache_path, *sorted(glob.glob(f"{glob.escape(root)}.[0-9]*{extension}"))]:
+        try:
+            cached_global, cached_channels = read_emote_cache(path)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print(f"Failed to read the emote cache {path}: {error}")
+            continue
+        if cached_global is not None and (global_emotes is None or cached_global[0] > global_emotes[0]):
+            global_emotes = cached_global
+        for channel_name, cached in cached_channels.items():
+            if channel_name not in channel_emotes or cached[0] > channel_emotes[channel_name][0]:
+                channel_emotes[channel_name] = cached
+    if global_emotes is None:
+        return {}
+    return {channel_name : global_emotes[1] | emotes for channel_name, (_, emotes) in channel_emotes.items()}
+
+class EmoteRegistry:
+    """
+    The emotes usable in each of the bot's channels, so handlers can tell emotes from words from memory without any I/O.
+
+    Each channel's emotes are the global and channel emotes of Twitch and of the third-party providers,
+    kept as a single frozenset per channel, so a lookup is one dictionary get and one set membership test.
+    Emotes are loaded from a local cache file when created, so they are known from the first message, and
+    sets older than the refresh interval are fetched again in the background once started, then written back to the cache.
+    A provider that fails to give a set leaves the emotes it gave before in place.
+    Channels whose emotes have never been fetched have no set, rather than only the global emotes,
+    so a handler never mistakes a channel's own emotes for words.
+    """
+
+    __slots__ = ("__helix",
+                 "__cache_path",
+                 "__refresh_interval",
+                 "__third_party_urls",
+                 "__channels",
+                 "__global",
+                 "__channel_emotes",
+                 "__sets",
+                 "__updated",
+                 "__tasks",
+                 "__background")
+
+    def __init__(self,
+                 helix: HelixClient,
+                 cache_path: str = EMOTE_CACHE_PATH,
+                 refresh_interval: float = 3600.0,
+                 third_party_urls: Mapping[str, str] = THIRD_PARTY_EMOTE_URLS
+                 ) -> None:
+        """
+        Create an emote registry, loading any emotes in the cache file.
+
+        Parameters
+        ----------
+        `helix: HelixClient` - The client Twitch emotes and channel ids are fetched through, whose connection pool all providers share.
+
+        `cache_path: str = EMOTE_CACHE_PATH` - The file emotes are cached in between runs, which no other registry may write.
+
+        `refresh_interval: float = 3600.0` - The age in seconds at which a set of emotes is fetched again.
+
+        `third_party_urls: Mapping[str, str] = THIRD_PARTY_EMOTE_URLS` - The APIs of the third-party providers to include, by provider.
+        """
+        self.__helix: HelixClient = helix
+        self.__cache_path: str = cache_path
+        self.__refresh_interval: float = refresh_interval
+        self.__third_party_urls: dict[str, str] = dict(third_party_urls)
+
+        self.__channels: set[str] = set()
+        ## The global emotes, the emotes of only each channel, and their union for each channel, which is all lookups read.
+        self.__global: frozenset[str] = frozenset()
+        self.__channel_emotes: dict[str, frozenset[str]] = {}
+        self.__sets: dict[str, frozenset[str]] = {}
+        ## Maps channel names, and the empty string for the global emotes, to the epoch time their emotes were fetched.
+        self.__updated: dict[str, float] = {}
+
+        self.__tasks: list[asyncio.Task] = []
+        ## Refreshes made in the background, referenced until they finish.
+        self.__background: set[asyncio.Task] = set()
+        self.__load()
+        REGISTRY.gauge("olliebot_emote_channels", "Channels with a known emote set.", function=lambda: len(self.__sets))
+
+    def get(self, channel_name: str) -> Optional[frozenset[str]]:
+        "Get the emotes usable in a channel, or None if the channel's emotes are not known."
+        return self.__sets.get(channel_name)
+
+    @property
+    def channels(self) -> frozenset[str]:
+        "The channels being tracked."
+        return frozenset(self.__channels)
+
+    def track(self, channel_names: Iterable[str]) -> None:
+        "Start tracking channels, their emotes are fetched in the background once started if they are not cached or are stale."
+        new: list[str] = [channel_name.lower() for channel_name in channel_names
+                          if channel_name.lower() not in self.__channels]
+        if not new:
+            return
+        self.__channels.update(new)
+        if self.__tasks and (stale := self.__stale(new)):
+            self.__run_in_background(self.refresh(stale))
+
+    def untrack(self, channel_names: Iterable[str]) -> None:
+        "Stop tracking channels, their emotes stay cached in case they are tracked again."
+        for channel_name in channel_names:
+            self.__channels.discard(channel_name.lower())
+
+    async def start(self) -> None:
+        "Start refreshing emotes in the background."
+        if self.__tasks:
+            return
+        self.__tasks = [asyncio.get_running_loop().create_task(self.__refresh_periodically())]
+
+    async def close(self) -> None:
+        for task in [*self.__tasks, *self.__background]:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, *self.__background, return_exceptions=True)
+        self.__tasks = []
+
+    async def refresh(self, channel_names: Optional[Iterable[str]] = None) -> None:
+        """
+        Fetch the emotes of the given channels, or of every tracked channel, and the global emotes if they are stale,
+        then write the cache file.
+        """
+        logins: list[str] = list(dict.fromkeys(channel_names)) if channel_names is not None else list(self.__channels)
+        time_now: float = time.time()
+        if time_now - self.__updated.get("", 0.0) >= self.__refresh_interval:
+            global_emotes: Optional[frozenset[str]] = await self.__fetch(self.__global_sources(),
+                                                                         self.__global if "" in self.__updated else None)
+            if global_emotes is not None:
+                self.__global = global_emotes
+                self.__updated[""] = time_now
+                for channel_name, emotes in self.__channel_emotes.items():
+                    self.__sets[channel_name] = global_emotes | emotes
+
+        if logins:
+            try:
+                user_ids: dict[str, str] = await self.__helix.get_user_ids(logins)
+            except HelixError as error:
+                print(f"Failed to look up channels to fetch the emotes of: {error}")
+                user_ids = {}
+            await asyncio.gather(*(self.__refresh_channel(channel_name, user_id)
+                                   for channel_name, user_id in user_ids.items()))
+        try:
+            await asyncio.to_thread(self.__write, self.__snapshot())
+        except OSError as error:
+            print(f"Failed to write the emote cache: {error}")
+
+    def __run_in_background(self, coroutine: Any) -> None:
+        task: asyncio.Task = asyncio.get_running_loop().create_task(coroutine)
+        self.__background.add(task)
+        task.add_done_callback(self.__background.discard)
+
+    def __stale(self, channel_names: Iterable[str]) -> list[str]:
+        "Get those of the given channels whose emotes were never fetched or are older than the refresh interval."
+        time_now: float = time.time()
+        return [channel_name for channel_name in channel_names
+                if time_now - self.__updated.get(channel_name, 0.0) >= self.__refresh_interval]
+
+    async def __refresh_periodically(self) -> None:
+        while True:
+            if stale := self.__stale(self.__channels):
+                await self.refresh(stale)
+            elif time.time() - self.__updated.get("", 0.0) >= self.__refresh_interval:
+                await self.refresh([])
+            ## Sets fetched at different times go stale at different times, so this checks far more often than the interval.
+            await asyncio.sleep(min(self.__refresh_interval / 10.0, 300.0))
+
+    async def __refresh_channel(self, channel_name: str, user_id: str) -> None:
+        emotes: Optional[frozenset[str]] = await self.__fetch(self.__channel_sources(user_id), self.__channel_emotes.get(channel_name))
+        if emotes is None:
+            return
+        self.__channel_emotes[channel_name] = emotes
+        self.__updated[channel_name] = time.time()
+        ## A channel has no set until the global emotes are known too.
+        if "" in self.__updated:
+            self.__sets[channel_name] = self.__global | emotes
+
+    ##################################################
+    #### Providers
+
+    async def __fetch(self,
+                      sources: list[Callable[[], Awaitable[set[str]]]],
+                      previous: Optional[frozenset[str]]
+                      ) -> Optional[frozenset[str]]:
+        """
+        Fetch a set of emotes from every provider at once, keeping the previous emotes if any provider fails.
+
+        Returns None if a provider failed and there are no previous emotes, as a set missing a provider's emotes would reject them.
+        """
+        _REFRESHES.inc()
+        results: list[Any] = await asyncio.gather(*(source() for source in sources), return_exceptions=True)
+        emotes: set[str] = set()
+        failed: bool = False
+        for result in results:
+            if isinstance(result, BaseException):
+                ## A response missing the expected fields is a failure of that provider alone.
+                if not isinstance(result, (HelixError, _ProviderError, KeyError, TypeError)):
+                    raise result
+                _REFRESH_ERRORS.inc()
+                print(f"Failed to fetch emotes: {type(result).__name__}: {result}")
+                failed = True
+            else: emotes.update(result)
+        if not failed:
+            return frozenset(emotes)
+        ## The emotes a failed provider gave before cannot be told apart from those removed from the others, so all are kept.
+        return frozenset(emotes | previous) if previous is not None else None
+
+    def __global_sources(self) -> list[Callable[[], Awaitable[set[str]]]]:
+        async def twitch() -> set[str]:
+            return {emote["name"] for emote in (await self.__helix.request("GET", "chat/emotes/global"))["data"]}
+        async def bttv(url: str) -> set[str]:
+            return {emote["code"] for emote in await self.__get_json(f"{url}/cached/emotes/global") or ()}
+        async def ffz(url: str) -> set[str]:
+            response: dict[str, Any] = await self.__get_json(f"{url}/set/global") or {}
+            return {emote["name"] for set_id in response.get("default_sets", ())
+                    for emote in response["sets"][str(set_id)]["emoticons"]}
+        async def seventv(url: str) -> set[str]:
+            return {emote["name"] for emote in (await self.__get_json(f"{url}/emote-sets/global") or {}).get("emotes") or ()}
+        return [twitch] + self.__third_party({"bttv" : bttv, "ffz" : ffz, "7tv" : seventv})
+
+    def __channel_sources(self, user_id: str) -> list[Callable[[], Awaitable[set[str]]]]:
+        async def twitch() -> set[str]:
+            return {emote["name"] for emote in (await self.__helix.request("GET", "chat/emotes", [("broadcaster_id", user_id)]))["data"]}
+        async def bttv(url: str) -> set[str]:
+            response: dict[str, Any] = await self.__get_json(f"{url}/cached/users/twitch/{user_id}") or {}
+            return {emote["code"] for emote in [*response.get("channelEmotes", ()), *response.get("sharedEmotes", ())]}
+        async def ffz(url: str) -> set[str]:
+            response: dict[str, Any] = await self.__get_json(f"{url}/room/id/{user_id}") or {}
+            return {emote["name"] for emote_set in response.get("sets", {}).values() for emote in emote_set["emoticons"]}
+        async def seventv(url: str) -> set[str]:
+            response: dict[str, Any] = await self.__get_json(f"{url}/users/twitch/{user_id}") or {}
+            return {emote["name"] for emote in (response.get("emote_set") or {}).get("emotes") or ()}
+        return [twitch] + self.__third_party({"bttv" : bttv, "ffz" : ffz, "7tv" : seventv})
+
+    def __third_party(self, sources: dict[str, Callable[[str], Awaitable[set[str]]]]) -> list[Callable[[], Awaitable[set[str]]]]:
+        "Bind the sources of the third-party providers that have a url."
+        return [partial(source, url)
+                for provider, source in sources.items()
+                if (url := self.__third_party_urls.get(provider))]
+
+    async def __get_json(self, url: str) -> Any:
+        "Get a third-party provider's JSON response, or None if it has nothing for the channel."
+        try:
+            async with self.__helix.session.get(url) as response:
+                ## Providers give a 404 for channels that have never used them.
+                if response.status == 404:
+                    return None
+                if response.status != 200:
+                    raise _ProviderError(f"{url} ({response.status})")
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            raise _ProviderError(f"{url} : {error or type(error).__name__}") from error
+
+    ##################################################
+    #### Cache file
+
+    def __load(self) -> None:
+        "Load the emotes in the cache file, if there is one."
+        try:
+            global_emotes, channel_emotes = read_emote_cache(self.__cache_path)
+            ## The global emotes are missing if they had never been fetched when the cache was written.
+            if global_emotes is not None:
+                self.__updated[""], self.__global = global_emotes
+            for channel_name, (updated, emotes) in channel_emotes.items():
+                self.__channel_emotes[channel_name] = emotes
+                self.__updated[channel_name] = updated
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print(f"Failed to read the emote cache, emotes will be fetched again: {error}")
+            self.__global = frozenset()
+            self.__channel_emotes.clear()
+            self.__updated.clear()
+            return
+        if "" in self.__updated:
+            for channel_name, emotes in self.__channel_emotes.items():
+                self.__sets[channel_name] = self.__global | emotes
+
+    def __snapshot(self) -> dict[str, Any]:
+        "Get every known emote as the contents of the cache file."
+        return {"global" : {"updated" : self.__updated[""], "emotes" : sorted(self.__global)} if "" in self.__updated else None,
+                "channels" : {channel_name : {"updated" : self.__updated[channel_name], "emotes" : sorted(emotes)}
+                              for channel_name, emotes in self.__channel_emotes.items()}}
+
+    def __write(self, cache: dict[str, Any]) -> None:
+        "Write the cache file, replacing it whole so a crash never leaves it half written."
+        temporary_path: str = f"{self.__cache_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temporary_path, self.__cache_path)
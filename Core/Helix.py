@@ -0,0 +1,221 @@
+import asyncio
+import os
+import time
+from typing import Any, Iterable, Optional
+import aiohttp
+
+from Core.Metrics import REGISTRY, Counter, Histogram
+
+__all__ = ("HelixClient", "HelixError")
+
+HELIX_URL: str = "https://api.twitch.tv/helix"
+
+## Helix accepts at most this many `user_login` or `user_id` query parameters per request.
+HELIX_MAX_BATCH: int = 100
+
+_HELIX_ERRORS: Counter = REGISTRY.counter("olliebot_helix_errors_total", "Helix requests that failed or returned an error.")
+
+## Maps each endpoint, as requested, to its latency histogram, so it is looked up in the registry only on its first request.
+_REQUEST_SECONDS: dict[str, Histogram] = {}
+
+class HelixError(RuntimeError):
+    "Raised when the Helix API returns an error response."
+
+    def __init__(self, error: str, status: int, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(f"{error} ({status}) : {message}")
+        self.error: str = error
+        self.status: int = status
+        self.message: str = message
+        ## The seconds until a rate limited request can be retried, if the response said.
+        self.retry_after: Optional[float] = retry_after
+
+class HelixClient:
+    """
+    Asynchronous client for the Twitch Helix API.
+
+    All requests share a single keep-alive connection pool.
+    Concurrent stream lookups are coalesced, so that all lookups made in the same
+    event loop iteration are sent as one batched `/streams` request, and lookups for a
+    channel that already has a request in flight wait on that request instead of making another.
+    """
+
+    __slots__ = ("__base_url",
+                 "__client_id",
+                 "__token",
+                 "__connection_limit",
+                 "__session",
+                 "__pending_streams",
+                 "__in_flight_streams",
+                 "__flush_scheduled",
+                 "__fetch_tasks")
+
+    def __init__(self,
+                 client_id: Optional[str] = None,
+                 token: Optional[str] = None,
+                 base_url: str = HELIX_URL,
+                 connection_limit: int = 10
+                 ) -> None:
+        """
+        Create a Helix client.
+
+        The client id and app token default to the `CLIENT_ID` and `APP_TOKEN` environment variables.
+        The base url can be pointed at a local stand-in server for testing.
+        """
+        self.__base_url: str = base_url.rstrip("/")
+        self.__client_id: Optional[str] = client_id if client_id is not None else os.getenv("CLIENT_ID")
+        self.__token: Optional[str] = token if token is not None else os.getenv("APP_TOKEN")
+        self.__connection_limit: int = connection_limit
+
+        ## The session must be created inside a running event loop, so it is created on first use.
+        self.__session: Optional[aiohttp.ClientSession] = None
+
+        ## Stream lookups waiting to be sent, and those that have been sent but not answered.
+        self.__pending_streams: dict[str, asyncio.Future] = {}
+        self.__in_flight_streams: dict[str, asyncio.Future] = {}
+        self.__flush_scheduled: bool = False
+        self.__fetch_tasks: set[asyncio.Task] = set()
+
+    @property
+    def client_id(self) -> Optional[str]:
+        return self.__client_id
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        "The pooled HTTP session used for all requests made by this client."
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.__connection_limit,
+                                             keepalive_timeout=60)
+            self.__session = aiohttp.ClientSession(connector=connector,
+                                                   timeout=aiohttp.ClientTimeout(total=10))
+        return self.__session
+
+    async def close(self) -> None:
+        "Close the connection pool."
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+
+    ##################################################
+    #### Requests
+
+    async def request(self,
+                      method: str,
+                      endpoint: str,
+                      params: Optional[Iterable[tuple[str, str]]] = None,
+                      json: Optional[Any] = None,
+                      token: Optional[str] = None
+                      ) -> dict[str, Any]:
+        """
+        Make a request to a Helix endpoint and return the decoded JSON response.
+
+        Requests are made with the client's app token, unless a user token is given, such as a channel owner's.
+        """
+        headers: dict[str, str] = {"Authorization" : f"Bearer {token if token is not None else self.__token}",
+                                   "Client-Id" : str(self.__client_id)}
+        start: float = time.perf_counter()
+        try:
+            async with self.session.request(method,
+                                            f"{self.__base_url}/{endpoint.lstrip('/')}",
+                                            params=list(params) if params is not None else None,
+                                            json=json,
+                                            headers=headers) as response:
+                if response.status == 204:
+                    return {}
+                data: dict[str, Any] = await response.json(content_type=None)
+                ## Rate limited responses give the epoch time the rate limit bucket refills at.
+                reset: Optional[str] = response.headers.get("Ratelimit-Reset") if response.status == 429 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            _HELIX_ERRORS.inc()
+            raise HelixError("Connection Error", 0, str(error) or type(error).__name__) from error
+        finally:
+            histogram: Optional[Histogram] = _REQUEST_SECONDS.get(endpoint)
+            if histogram is None:
+                histogram = _REQUEST_SECONDS[endpoint] = REGISTRY.histogram("olliebot_helix_request_seconds", "Helix request latency by endpoint.",
+                                                                            {"endpoint" : endpoint.strip("/")})
+            histogram.observe(time.perf_counter() - start)
+
+        if "error" in data:
+            _HELIX_ERRORS.inc()
+            raise HelixError(data["error"], data.get("status", response.status), data.get("message", ""),
+                             max(0.0, float(reset) - time.time()) if reset is not None and reset.isdigit() else None)
+        return data
+
+    async def get_streams(self, user_logins: Iterable[str]) -> dict[str, bool]:
+        """
+        Get whether each of the given channels is currently live.
+
+        Logins are sent in batches of up to one hundred per request.
+        """
+        logins: list[str] = list(dict.fromkeys(login.lower() for login in user_logins))
+        online: dict[str, bool] = dict.fromkeys(logins, False)
+        for index in range(0, len(logins), HELIX_MAX_BATCH):
+            response = await self.request("GET", "streams",
+                                          [("first", str(HELIX_MAX_BATCH))]
+                                          + [("user_login", login) for login in logins[index:index + HELIX_MAX_BATCH]])
+            for stream in response["data"]:
+                online[stream["user_login"].lower()] = True
+        return online
+
+    async def get_user_ids(self, user_logins: Iterable[str]) -> dict[str, str]:
+        """
+        Get the user ids of the given logins, logins that do not exist are omitted.
+
+        Logins are sent in batches of up to one hundred per request.
+        """
+        logins: list[str] = list(dict.fromkeys(login.lower() for login in user_logins))
+        user_ids: dict[str, str] = {}
+        for index in range(0, len(logins), HELIX_MAX_BATCH):
+            response = await self.request("GET", "users",
+                                          [("login", login) for login in logins[index:index + HELIX_MAX_BATCH]])
+            for user in response["data"]:
+                user_ids[user["login"].lower()] = user["id"]
+        return user_ids
+
+    ##################################################
+    #### Coalesced lookups
+
+    async def is_online(self, user_login: str) -> bool:
+        """
+        Check whether a channel is currently live.
+
+        Lookups made in the same event loop iteration are merged into a single request,
+        and lookups for a channel that already has a request in flight share its result.
+        """
+        login: str = user_login.lower()
+        future: Optional[asyncio.Future] = (self.__in_flight_streams.get(login)
+                                            or self.__pending_streams.get(login))
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.__pending_streams[login] = future
+            if not self.__flush_scheduled:
+                self.__flush_scheduled = True
+                loop.call_soon(self.__flush_streams)
+        return await asyncio.shield(future)
+
+    def __flush_streams(self) -> None:
+        "Send all pending stream lookups as one batched request."
+        self.__flush_scheduled = False
+        batch: dict[str, asyncio.Future] = self.__pending_streams
+        self.__pending_streams = {}
+        self.__in_flight_streams.update(batch)
+        task: asyncio.Task = asyncio.get_running_loop().create_task(self.__fetch_streams(batch))
+        self.__fetch_tasks.add(task)
+        task.add_done_callback(self.__fetch_tasks.discard)
+
+    async def __fetch_streams(self, batch: dict[str, asyncio.Future]) -> None:
+        try:
+            online: dict[str, bool] = await self.get_streams(batch)
+        except Exception as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+                    ## Mark the exception as retrieved in case every waiter was cancelled.
+                    future.exception()
+        else:
+            for login, future in batch.items():
+                if not future.done():
+                    future.set_result(online[login])
+        finally:
+            for login, future in batch.items():
+                if self.__in_flight_streams.get(login) is future:
+                    del self.__in_flight_streams[login]
@@ -0,0 +1,160 @@
+import asyncio
+from collections import deque
+import time
+from typing import Optional
+import twitchio
+
+from Core.MessagePipeline import MessageKind, MessagePipeline
+from Core.Metrics import REGISTRY, Counter, Histogram
+
+__all__ = ("IngestQueue",)
+
+## The reasons messages are shed, each counted separately.
+_SHED_REASONS: tuple[str, ...] = ("passive_full", "coalesced", "commands_full")
+
+class _ChannelIngest:
+    "The queued messages and worker of a single channel."
+
+    __slots__ = ("commands",
+                 "passive",
+                 "last_passive",
+                 "worker")
+
+    def __init__(self) -> None:
+        ## Each lane holds (message, kind, arrival time) tuples.
+        self.commands: deque[tuple[twitchio.Message, MessageKind, float]] = deque()
+        self.passive: deque[tuple[twitchio.Message, MessageKind, float]] = deque()
+        ## The text of the passive message most recently queued, for coalescing.
+        self.last_passive: str = ""
+        self.worker: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.commands) + len(self.passive)
+
+class IngestQueue:
+    """
+    Bounded per-channel queues of received chat messages, drained by a worker task per channel.
+
+    Receiving a message only classifies and queues it, so a burst in one channel never delays reading chat.
+    Each channel's messages are handled in order by that channel's worker, which exists only while the
+    channel has messages queued. Commands are handled before passive work, so replies stay prompt during
+    raids and emote walls, and the passive part of a command, such as pyramid tracking, is queued as passive work.
+
+    Passive work is shed rather than queued without bound;
+        - Passive work arriving while the channel already has the maximum queued is dropped,
+        - If coalescing is enabled, passive work identical to the passive message queued just before it is dropped,
+          this only applies while the channel is backlogged, so no message is dropped from a channel that keeps up.
+          Only messages that can affect nothing but a count are coalesced, messages that match a trigger phrase or that the
+          pipeline classified as pyramid candidates never are, which includes every message in channels whose emotes are not known.
+    Commands arriving while the channel already has the maximum number of commands queued are also dropped.
+    """
+
+    __slots__ = ("__pipeline",
+                 "__max_commands",
+                 "__max_passive",
+                 "__coalesce",
+                 "__channels",
+                 "__shed",
+                 "__wait_histograms")
+
+    def __init__(self,
+                 pipeline: MessagePipeline,
+                 max_commands: int = 50,
+                 max_passive: int = 200,
+                 coalesce: bool = True
+                 ) -> None:
+        """
+        Create an ingest queue dispatching messages through the given pipeline.
+
+        Parameters
+        ----------
+        `pipeline: MessagePipeline` - The pipeline messages are classified by and dispatched through.
+
+        `max_commands: int = 50` - The number of commands a channel may have queued before further commands are shed.
+
+        `max_passive: int = 200` - The number of passive messages a channel may have queued before further passive work is shed.
+
+        `coalesce: bool = True` - Whether to shed passive work identical to the passive message queued just before it.
+        """
+        self.__pipeline: MessagePipeline = pipeline
+        self.__max_commands: int = max_commands
+        self.__max_passive: int = max_passive
+        self.__coalesce: bool = coalesce
+        self.__channels: dict[str, _ChannelIngest] = {}
+        self.__shed: dict[str, Counter] = {reason : REGISTRY.counter("olliebot_messages_shed_total",
+                                                                     "Received messages, or their passive work, shed under load, by reason.",
+                                                                     {"reason" : reason})
+                                           for reason in _SHED_REASONS}
+        self.__wait_histograms: dict[bool, Histogram] = {is_command : REGISTRY.histogram("olliebot_ingest_wait_seconds",
+                                                                                         "Time received messages spent queued, by lane.",
+                                                                                         {"lane" : "command" if is_command else "passive"})
+                                                         for is_command in (True, False)}
+        REGISTRY.gauge("olliebot_ingest_depth", "Received messages queued across all channels.", function=lambda: self.depth)
+
+    @property
+    def depth(self) -> int:
+        "The number of messages queued across all channels."
+        return sum(len(channel) for channel in self.__channels.values())
+
+    @property
+    def shed(self) -> int:
+        "The number of messages, or their passive work, shed for any reason."
+        return int(sum(counter.get() for counter in self.__shed.values()))
+
+    def submit(self, message: twitchio.Message) -> None:
+        "Queue a received message for its channel's worker, shedding it if the channel is over its limits."
+        channel_name: str = message.channel.name
+        channel: Optional[_ChannelIngest] = self.__channels.get(channel_name)
+        if channel is None:
+            channel = self.__channels[channel_name] = _ChannelIngest()
+        kind: MessageKind = self.__pipeline.classify(message)
+        time_now: float = time.perf_counter()
+
+        if kind & MessageKind.COMMAND:
+            if len(channel.commands) >= self.__max_commands:
+                self.__shed["commands_full"].inc()
+            else: channel.commands.append((message, MessageKind.COMMAND, time_now))
+            kind &= ~MessageKind.COMMAND
+
+        content: str = str(message.content)
+        ## A repeat that could be a level of a pyramid, or matches a trigger phrase, would change more than a count if dropped.
+        if (channel.passive and self.__coalesce and content == channel.last_passive
+            and not kind & (MessageKind.TRIGGER | MessageKind.PYRAMID_CANDIDATE)):
+            self.__shed["coalesced"].inc()
+        elif len(channel.passive) >= self.__max_passive:
+            self.__shed["passive_full"].inc()
+        else:
+            channel.passive.append((message, kind, time_now))
+            channel.last_passive = content
+
+        if channel.worker is None and channel:
+            channel.worker = asyncio.get_running_loop().create_task(self.__drain(channel_name, channel))
+
+    async def __drain(self, channel_name: str, channel: _ChannelIngest) -> None:
+        "Handle a channel's queued messages, commands first, until it has none left."
+        try:
+            while channel:
+                is_command: bool = bool(channel.commands)
+                message, kind, arrived = channel.commands.popleft() if is_command else channel.passive.popleft()
+                self.__wait_histograms[is_command].observe(time.perf_counter() - arrived)
+                try:
+                    await self.__pipeline.dispatch(message, kind)
+                except Exception as error:
+                    print(f"Failed to handle a message in {channel_name}: {type(error).__name__}: {error}")
+        finally:
+            channel.worker = None
+            if not channel:
+                self.__channels.pop(channel_name, None)
+
+    async def join(self) -> None:
+        "Wait until every queued message has been handled."
+        while workers := [channel.worker for channel in self.__channels.values() if channel.worker is not None]:
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def close(self) -> None:
+        "Stop every worker, discarding the messages still queued."
+        workers: list[asyncio.Task] = [channel.worker for channel in self.__channels.values() if channel.worker is not None]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self.__channels.clear()
@@ -1,18 +1,33 @@
+import asyncio
 import re
-from time import sleep
 from typing import Optional, Union
 from urllib.parse import SplitResult
 from twitchio.ext import commands
 import twitchio
 
+from Core.CommandString import CommandString, parse_command_string
+from Core.SendScheduler import Priority
+
+def send_message(context: commands.Context,
+                 message: str,
+                 priority: Priority = Priority.REPLY
+                 ) -> bool:
+    """
+    Queue a message to be sent to the context's channel through the bot's send scheduler.
+    
+    Returns False if the message was merged or dropped by the scheduler under backpressure.
+    """
+    return context.bot.send_scheduler.submit(context.channel.name, message, priority)
+
 async def multi_send_messages(context: commands.Context,
                               messages: list[str],
-                              delay: Optional[float] = None
+                              delay: Optional[float] = None,
+                              priority: Priority = Priority.REPLY
                               ) -> None:
     for message in messages:
-        await context.send(message)
+        send_message(context, message, priority)
         if delay is not None:
-            sleep(delay)
+            await asyncio.sleep(delay)
 
 def get_message(message_or_context: Union[twitchio.Message, commands.Context]) -> twitchio.Message:
     if isinstance(message_or_context, commands.Context):
@@ -21,24 +36,17 @@ def get_message(message_or_context: Union[twitchio.Message, commands.Context]) -
 
 def get_command_string(message_or_context: Union[twitchio.Message, commands.Context],
                        split: bool = False) -> Union[str, list[str]]:
-    ## TODO We could decompose into a CommandString:
-    ##      - Command header: str
-    ##      - Command name: str = header.removeprefix("?")
-    ##      - Command string: list[str]
-    ## Could use an argument parser to split the command string into parameter-argument pairs.
-    ## Could use something like: command_string: CommandString = self.get_command_string("method_name", context)
-    ## where the command string getter is a predefined dictionary from command names to argument parsers for those commands
-    ## so that command strings are pre-parsed and have their parameter-argument mappings generated already.
-    ## Could we re-wrap command functions to do this?
-    message: twitchio.Message = get_message(message_or_context)
-    message_string: str = str(message.content)
-    
-    if message_string.startswith("?") and " " in message_string:
-        message_string = message_string.split(" ", 1)[1]
+    """
+    Get the text of a message that follows its command header, or the whole message if it has no arguments.
     
+    The message is parsed into a `CommandString` once, and cached on the context if one is given.
+    """
+    command_string: CommandString = parse_command_string(message_or_context)
     if split:
-        return message_string.split(" ")
-    return message_string
+        return command_string.arguments or [command_string.text]
+    return command_string.text
+
+_COMMAND_HEADER_PATTERN: re.Pattern = re.compile(r"\?[a-zA-Z-]+")
 
 def is_command_header(message_content: str) -> bool:
     """
@@ -46,18 +54,18 @@ def is_command_header(message_content: str) -> bool:
     
     A command header is a (possibly hyphenated) alphabetic string prefixed by a question mark.
     """
-    return re.fullmatch("\?[a-zA-Z-]+", message_content) is not None
+    return _COMMAND_HEADER_PATTERN.fullmatch(message_content) is not None
 
 def get_user(message_or_context: Union[twitchio.Message, commands.Context]) -> str:
     "Get the name of the user the message was sent to if the message is non-empty, otherwise get the sender."
     
     message: twitchio.Message = get_message(message_or_context)
-    split_message: list[str] = str(message.content).split(" ")
+    command_string: CommandString = parse_command_string(message_or_context)
     
-    if is_command_header(split_message[0]):
-        if len(split_message) == 1:
-            return message.author.name
-        else: return split_message[1]
-    if len(split_message) == 0:
-        return message.author.name
-    else: return split_message[0]
\ No newline at end of file
+    if command_string.is_command:
+        if is_command_header(command_string.header):
+            if not command_string.arguments:
+                return message.author.name
+            else: return command_string.arguments[0]
+        return command_string.header
+    return command_string.arguments[0]
\ No newline at end of file
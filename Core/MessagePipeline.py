@@ -0,0 +1,160 @@
+from enum import IntFlag
+import re
+import time
+from typing import Awaitable, Callable, Optional
+import twitchio
+
+from Core.Emotes import EmoteRegistry
+from Core.Metrics import REGISTRY, Counter, Histogram
+from Core.PyramidDetector import starts_with_emote
+
+__all__ = ("MessageKind", "MessagePipeline")
+
+class MessageKind(IntFlag):
+    "The kinds a chat message can be classified as, a message may be of several kinds."
+
+    ## Every message is passive, and is seen by handlers that observe all of chat, such as pyramid tracking.
+    PASSIVE = 1
+
+    ## The message matches at least one registered trigger phrase.
+    TRIGGER = 2
+
+    ## The message starts with the command prefix.
+    COMMAND = 4
+
+    ## The message could be a level of a pyramid, as it starts with an emote, or its channel's emotes are not known.
+    ## Other messages still end a pyramid attempt, so pyramid tracking is passive, and rejects them from their first word.
+    PYRAMID_CANDIDATE = 8
+
+class MessagePipeline:
+    """
+    Staged dispatch pipeline for chat messages.
+
+    Stage one classifies each message with a prefix check, a single search of a
+    precompiled pattern combining every registered trigger phrase, and a lookup of its first word in its channel's emotes.
+    Stage two calls only the handlers registered for the kinds the message was classified as,
+    so that handlers which only care about commands or trigger phrases add no cost to other messages.
+    Handlers are called in the order; passive handlers, trigger handlers, command handlers.
+    The latency of every handler is recorded in its own histogram.
+    """
+
+    __slots__ = ("__prefix",
+                 "__emotes",
+                 "__passive_handlers",
+                 "__command_handlers",
+                 "__triggers",
+                 "__trigger_pattern",
+                 "__received",
+                 "__kind_counters")
+
+    def __init__(self, prefix: str = "?", emotes: Optional[EmoteRegistry] = None) -> None:
+        """
+        Create a pipeline for commands with the given prefix.
+
+        The emotes of each channel tell which messages are pyramid candidates, if not given no channel's emotes are known,
+        and every message is a candidate.
+        """
+        self.__prefix: str = prefix
+        self.__emotes: Optional[EmoteRegistry] = emotes
+        self.__passive_handlers: list[tuple[Callable[[twitchio.Message], Awaitable[None]], Histogram]] = []
+        self.__command_handlers: list[tuple[Callable[[twitchio.Message], Awaitable[None]], Histogram]] = []
+        self.__triggers: list[tuple[re.Pattern, Callable[[twitchio.Message, re.Match], Awaitable[None]], Histogram]] = []
+        self.__trigger_pattern: Optional[re.Pattern] = None
+        ## Every message is classified once as it is received, so it is counted there, before any of its work can be shed.
+        self.__received: Counter = REGISTRY.counter("olliebot_messages_total", "Chat messages received, including those whose work was shed.")
+        self.__kind_counters: dict[MessageKind, Counter] = {kind : REGISTRY.counter("olliebot_messages_received_total",
+                                                                                    "Chat messages received, by kind.",
+                                                                                    {"kind" : kind.name.lower()})
+                                                           for kind in MessageKind}
+
+    @property
+    def received(self) -> int:
+        "The number of messages received, counted as each is classified."
+        return int(self.__received.get())
+
+    ##################################################
+    #### Registration
+
+    def add_passive_handler(self, handler: Callable[[twitchio.Message], Awaitable[None]]) -> None:
+        "Register a handler called for every message."
+        self.__passive_handlers.append((handler, _handler_histogram(handler)))
+
+    def add_command_handler(self, handler: Callable[[twitchio.Message], Awaitable[None]]) -> None:
+        "Register a handler called for messages that start with the command prefix."
+        self.__command_handlers.append((handler, _handler_histogram(handler)))
+
+    def add_trigger(self,
+                    pattern: str,
+                    handler: Callable[[twitchio.Message, re.Match], Awaitable[None]],
+                    flags: int = 0
+                    ) -> None:
+        "Register a handler called with the match object for messages that contain a match of the given pattern."
+        self.__triggers.append((re.compile(pattern, flags), handler, _handler_histogram(handler)))
+        ## Recompile the combined pattern used to reject messages that match no trigger with a single search.
+        self.__trigger_pattern = re.compile("|".join(f"(?{_inline_flags(trigger.flags)}:{trigger.pattern})"
+                                                     for trigger, _, _ in self.__triggers))
+
+    ##################################################
+    #### Dispatching
+
+    def classify(self, message: twitchio.Message) -> MessageKind:
+        "Classify a message by the kinds of handlers that want it."
+        self.__received.inc()
+        content: str = str(message.content)
+        kind: MessageKind = MessageKind.PASSIVE
+        if self.__trigger_pattern is not None and self.__trigger_pattern.search(content) is not None:
+            kind |= MessageKind.TRIGGER
+        ## Replies are prefixed with the @name of the chatter being replied to.
+        if message.tags and "reply-parent-msg-id" in message.tags:
+            content = content.partition(" ")[2]
+        if content.startswith(self.__prefix):
+            kind |= MessageKind.COMMAND
+        ## In a channel whose emotes are not known, any repeated word can build a pyramid.
+        emotes: Optional[frozenset[str]] = self.__emotes.get(message.channel.name) if self.__emotes is not None else None
+        if emotes is None or starts_with_emote(str(message.content), emotes, (message.tags or {}).get("emotes") or ""):
+            kind |= MessageKind.PYRAMID_CANDIDATE
+        return kind
+
+    async def dispatch(self, message: twitchio.Message, kind: Optional[MessageKind] = None) -> None:
+        """
+        Dispatch a message to the handlers registered for its kinds, classifying it first if its kind is not given.
+
+        A kind without the passive flag skips the passive handlers, so a message's command can be dispatched apart from its passive work.
+        """
+        if kind is None:
+            kind = self.classify(message)
+
+        if kind & MessageKind.PASSIVE:
+            self.__kind_counters[MessageKind.PASSIVE].inc()
+            if kind & MessageKind.PYRAMID_CANDIDATE:
+                self.__kind_counters[MessageKind.PYRAMID_CANDIDATE].inc()
+            for handler, histogram in self.__passive_handlers:
+                start: float = time.perf_counter()
+                await handler(message)
+                histogram.observe(time.perf_counter() - start)
+
+        if kind & MessageKind.TRIGGER:
+            self.__kind_counters[MessageKind.TRIGGER].inc()
+            content: str = str(message.content)
+            for pattern, trigger_handler, histogram in self.__triggers:
+                if (match := pattern.search(content)) is not None:
+                    start = time.perf_counter()
+                    await trigger_handler(message, match)
+                    histogram.observe(time.perf_counter() - start)
+
+        if kind & MessageKind.COMMAND:
+            self.__kind_counters[MessageKind.COMMAND].inc()
+            for handler, histogram in self.__command_handlers:
+                start = time.perf_counter()
+                await handler(message)
+                histogram.observe(time.perf_counter() - start)
+
+def _handler_histogram(handler: Callable) -> Histogram:
+    "Get the latency histogram of a handler, labelled with its name."
+    return REGISTRY.histogram("olliebot_handler_seconds", "Chat message handler latency, by handler.",
+                              {"handler" : handler.__name__.strip("_")})
+
+def _inline_flags(flags: int) -> str:
+    "Convert the flags of a compiled pattern to inline flag letters, so they can be scoped to a group."
+    return "".join(letter for flag, letter in ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+                   if flags & flag)
@@ -0,0 +1,227 @@
+from bisect import bisect_left
+import time
+from typing import Callable, Optional, Union
+from aiohttp import web
+
+__all__ = ("Counter",
+           "Gauge",
+           "Histogram",
+           "MetricsRegistry",
+           "MetricsServer",
+           "REGISTRY")
+
+## Latency histogram bucket upper bounds in seconds, doubling from 10 microseconds to about 20 seconds.
+LATENCY_BUCKETS: tuple[float, ...] = tuple(0.00001 * (2 ** exponent) for exponent in range(22))
+
+class Counter:
+    "A monotonically increasing count, or a read of a count kept elsewhere if given a function."
+
+    __slots__ = ("name",
+                 "labels",
+                 "value",
+                 "function")
+
+    kind: str = "counter"
+
+    def __init__(self, name: str, labels: str = "", function: Optional[Callable[[], float]] = None) -> None:
+        self.name: str = name
+        self.labels: str = labels
+        self.value: float = 0
+        ## Reads the value from elsewhere, such as a count an object already keeps, instead of storing it.
+        self.function: Optional[Callable[[], float]] = function
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{self.labels} {self.get()}"]
+
+class Gauge(Counter):
+    "A value that can go up and down, or a read of a value kept elsewhere if given a function."
+
+    __slots__ = ()
+
+    kind: str = "gauge"
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class Histogram:
+    """
+    A latency histogram with fixed exponential buckets.
+
+    Observing a value is a single binary search and two additions, so histograms are cheap enough to leave on.
+    """
+
+    __slots__ = ("name",
+                 "labels",
+                 "buckets",
+                 "counts",
+                 "count",
+                 "sum")
+
+    kind: str = "histogram"
+
+    def __init__(self, name: str, labels: str = "", buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name: str = name
+        self.labels: str = labels
+        self.buckets: tuple[float, ...] = buckets
+        ## The count of each bucket, the last counts observations larger than every bucket bound.
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self) -> "_Timer":
+        "Get a context manager that observes the time spent inside it."
+        return _Timer(self)
+
+    def quantile(self, quantile: float) -> float:
+        "Estimate a quantile as the upper bound of the bucket it falls in, or zero if nothing has been observed."
+        if not self.count:
+            return 0.0
+        rank: float = quantile * self.count
+        cumulative: int = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render(self) -> list[str]:
+        ## Bucket labels are merged with the histogram's own labels.
+        label_prefix: str = f"{self.labels[1:-1]}," if self.labels else ""
+        lines: list[str] = []
+        cumulative: int = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{{{label_prefix}le=\"{bound:g}\"}} {cumulative}")
+        lines.append(f"{self.name}_bucket{{{label_prefix}le=\"+Inf\"}} {self.count}")
+        lines.append(f"{self.name}_sum{self.labels} {self.sum}")
+        lines.append(f"{self.name}_count{self.labels} {self.count}")
+        return lines
+
+class _Timer:
+    "Observes the time spent inside a with block on a histogram."
+
+    __slots__ = ("__histogram",
+                 "__start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.__histogram: Histogram = histogram
+        self.__start: float = 0.0
+
+    def __enter__(self) -> None:
+        self.__start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.__histogram.observe(time.perf_counter() - self.__start)
+
+Metric = Union[Counter, Gauge, Histogram]
+
+class MetricsRegistry:
+    """
+    A collection of named metrics.
+
+    Metrics are created once, when the module or object that updates them is created,
+    so updating a metric on the hot path never touches the registry.
+    Getting a metric that already exists returns the existing one.
+    """
+
+    __slots__ = ("__metrics",
+                 "__help")
+
+    def __init__(self) -> None:
+        ## Maps metric names to their metrics by label string, metrics without labels have an empty label string.
+        self.__metrics: dict[str, dict[str, Metric]] = {}
+        self.__help: dict[str, str] = {}
+
+    def counter(self, name: str, help: str, labels: Optional[dict[str, str]] = None,
+                function: Optional[Callable[[], float]] = None) -> Counter:
+        return self.__get(Counter, name, help, labels, function)
+
+    def gauge(self, name: str, help: str, labels: Optional[dict[str, str]] = None,
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.__get(Gauge, name, help, labels, function)
+
+    def histogram(self, name: str, help: str, labels: Optional[dict[str, str]] = None) -> Histogram:
+        return self.__get(Histogram, name, help, labels)
+
+    def get(self, name: str, labels: Optional[dict[str, str]] = None) -> Optional[Metric]:
+        "Get an existing metric, or None if it does not exist."
+        return self.__metrics.get(name, {}).get(_format_labels(labels))
+
+    def __get(self, kind: type, name: str, help: str, labels: Optional[dict[str, str]], *args) -> Metric:
+        label_string: str = _format_labels(labels)
+        family: dict[str, Metric] = self.__metrics.setdefault(name, {})
+        metric: Optional[Metric] = family.get(label_string)
+        if metric is None:
+            metric = family[label_string] = kind(name, label_string, *args)
+            self.__help[name] = help
+        elif not isinstance(metric, kind) or (kind is Counter and isinstance(metric, Gauge)):
+            raise ValueError(f"Metric {name} already exists as a {metric.kind}.")
+        elif args and args[0] is not None:
+            ## Functions are replaced, so that a metric reading from an object follows the newest one.
+            metric.function = args[0]
+        return metric
+
+    def render(self) -> str:
+        "Render every metric in the Prometheus text exposition format."
+        lines: list[str] = []
+        for name, family in self.__metrics.items():
+            lines.append(f"# HELP {name} {self.__help[name]}")
+            lines.append(f"# TYPE {name} {next(iter(family.values())).kind}")
+            for metric in family.values():
+                lines.extend(metric.render())
+        lines.append("")
+        return "\n".join(lines)
+
+def _format_labels(labels: Optional[dict[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f"{key}=\"{value}\"" for key, value in sorted(labels.items())) + "}"
+
+## The registry shared by the whole bot.
+REGISTRY: MetricsRegistry = MetricsRegistry()
+
+class MetricsServer:
+    """
+    A HTTP server serving the metrics of a registry at `/metrics` in the Prometheus text format.
+
+    Binds to localhost by default, the metrics are not meant to be public.
+    """
+
+    __slots__ = ("__registry",
+                 "__host",
+                 "__port",
+                 "__runner")
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY) -> None:
+        self.__registry: MetricsRegistry = registry
+        self.__host: str = host
+        self.__port: int = port
+        self.__runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        if self.__runner is not None:
+            return
+        application: web.Application = web.Application()
+        application.router.add_get("/metrics", self.__handle_metrics)
+        self.__runner = web.AppRunner(application, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.__host, self.__port).start()
+
+    async def close(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    async def __handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.__registry.render(), content_type="text/plain", charset="utf-8")
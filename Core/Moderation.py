@@ -0,0 +1,273 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from Core.Chatters import ChatterCache
+from Core.Helix import HelixClient, HelixError
+from Core.Metrics import REGISTRY, Counter, Histogram
+
+__all__ = ("TIMEOUT_DURATIONS",
+           "ModerationAction",
+           "Moderation")
+
+## The shortest and longest timeouts Twitch accepts, in seconds, the longest is two weeks.
+TIMEOUT_DURATIONS: tuple[int, int] = (1, 1209600)
+
+_ACTIONS: dict[str, Counter] = {result : REGISTRY.counter("olliebot_moderation_actions_total",
+                                                          "Timeouts and bans requested, by result.",
+                                                          {"result" : result})
+                                for result in ("applied", "deduplicated", "failed")}
+_RETRIES: Counter = REGISTRY.counter("olliebot_moderation_retries_total", "Timeouts and bans retried after being rate limited or failing to connect.")
+_LATENCY: Histogram = REGISTRY.histogram("olliebot_moderation_latency_seconds", "Time from requesting a timeout or ban to it being applied.")
+
+class ModerationAction(NamedTuple):
+    "A timeout or ban waiting to be applied."
+    channel_name: str
+    chatter_name: str
+    ## The length of a timeout in seconds, or None for a ban.
+    duration: Optional[int]
+    reason: str
+    ## The chatter's user id, if the caller knows it.
+    user_id: Optional[int]
+    requested: float
+
+class Moderation:
+    """
+    Applies timeouts and bans through the Helix `/moderation/bans` endpoint, rather than as chat commands.
+
+    Actions do not use the chat rate limit, and each is confirmed or reported as failed.
+    Actions requested in the same event loop iteration are sent together, the names of every channel and
+    chatter among them whose ids are not cached are looked up in one batched Helix `/users` request, then
+    the actions are sent concurrently over the Helix client's connection pool, up to a limit at a time.
+    Actions that are rate limited, or fail to connect, are retried with exponential backoff,
+    waiting until the rate limit resets if the response says when.
+    A timeout of a chatter in a channel where they were already timed out for at least as long,
+    or banned, within the deduplication window is dropped, so a burst of failures times a chatter out once.
+    In channels whose owners have authorized the bot, actions are applied as the owner, who is always a moderator
+    of their own channel, and as the bot if the owner's token is rejected.
+    """
+
+    __slots__ = ("__helix",
+                 "__chatters",
+                 "__token",
+                 "__moderator_name",
+                 "__broadcaster_tokens",
+                 "__dedupe_window",
+                 "__max_retries",
+                 "__backoff",
+                 "__limit",
+                 "__recent",
+                 "__pending",
+                 "__flush_scheduled",
+                 "__tasks")
+
+    def __init__(self,
+                 helix: HelixClient,
+                 chatters: ChatterCache,
+                 token: Optional[str],
+                 moderator_name: str,
+                 dedupe_window: float = 10.0,
+                 max_concurrency: int = 8,
+                 max_retries: int = 4,
+                 backoff: float = 0.5,
+                 broadcaster_tokens: Optional[Callable[[str], Optional[tuple[int, str]]]] = None
+                 ) -> None:
+        """
+        Create a moderation dispatcher.
+
+        Parameters
+        ----------
+        `helix: HelixClient` - The client actions are sent through.
+
+        `chatters: ChatterCache` - The cache channel and chatter names are resolved to user ids through.
+
+        `token: Optional[str]` - The moderator's user access token, with the `moderator:manage:banned_users` scope.
+
+        `moderator_name: str` - The name of the account the token belongs to, which must be a moderator in each channel.
+
+        `dedupe_window: float = 10.0` - The time in seconds a timeout or ban of a chatter in a channel suppresses repeats.
+
+        `max_concurrency: int = 8` - The number of actions sent at a time, across all channels.
+
+        `max_retries: int = 4` - The number of times an action is retried before it is reported as failed.
+
+        `backoff: float = 0.5` - The time in seconds before the first retry, doubling with each retry.
+
+        `broadcaster_tokens: Optional[Callable[[str], Optional[tuple[int, str]]]] = None` - Gives the user id and access token
+        of a channel's owner, or None if they have not authorized the bot.
+        """
+        self.__helix: HelixClient = helix
+        self.__chatters: ChatterCache = chatters
+        self.__token: Optional[str] = token
+        self.__moderator_name: str = moderator_name.lower()
+        self.__broadcaster_tokens: Optional[Callable[[str], Optional[tuple[int, str]]]] = broadcaster_tokens
+        self.__dedupe_window: float = dedupe_window
+        self.__max_retries: int = max_retries
+        self.__backoff: float = backoff
+        self.__limit: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+
+        ## Maps (channel name, chatter name) to the monotonic time and duration of their most recent action, oldest first.
+        self.__recent: dict[tuple[str, str], tuple[float, Optional[int]]] = {}
+        ## Actions waiting to be sent, and the tasks sending them, referenced until they finish.
+        self.__pending: list[ModerationAction] = []
+        self.__flush_scheduled: bool = False
+        self.__tasks: set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        "The number of actions requested but not yet sent."
+        return len(self.__pending)
+
+    def timeout(self,
+                channel_name: str,
+                chatter_name: str,
+                duration: int,
+                reason: str = "",
+                user_id: Optional[int] = None
+                ) -> bool:
+        "Time a chatter out of a channel for the given number of seconds, returns False if the timeout was deduplicated."
+        return self.__request(channel_name, chatter_name, duration, reason, user_id)
+
+    def ban(self,
+            channel_name: str,
+            chatter_name: str,
+            reason: str = "",
+            user_id: Optional[int] = None
+            ) -> bool:
+        "Ban a chatter from a channel, returns False if the ban was deduplicated."
+        return self.__request(channel_name, chatter_name, None, reason, user_id)
+
+    async def join(self) -> None:
+        "Wait until every action requested so far has been applied or has failed."
+        while self.__pending or self.__tasks:
+            if self.__tasks:
+                await asyncio.wait(self.__tasks)
+            else: await asyncio.sleep(0)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        "Wait up to the given timeout for requested actions to be applied, then cancel the rest."
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            for task in self.__tasks:
+                task.cancel()
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__pending.clear()
+
+    ##################################################
+    #### Dispatching
+
+    def __request(self,
+                  channel_name: str,
+                  chatter_name: str,
+                  duration: Optional[int],
+                  reason: str,
+                  user_id: Optional[int]
+                  ) -> bool:
+        "Queue an action unless an equal or stronger one was requested within the deduplication window."
+        channel_name, chatter_name = channel_name.lower(), chatter_name.lower()
+        time_now: float = time.monotonic()
+        while self.__recent:
+            key, (requested, _) = next(iter(self.__recent.items()))
+            if time_now - requested < self.__dedupe_window:
+                break
+            del self.__recent[key]
+
+        key = (channel_name, chatter_name)
+        if (recent := self.__recent.get(key)) is not None:
+            ## A ban outlasts any timeout, and a longer timeout than the recent one replaces it.
+            recent_duration: Optional[int] = recent[1]
+            if recent_duration is None or (duration is not None and duration <= recent_duration):
+                _ACTIONS["deduplicated"].inc()
+                return False
+            del self.__recent[key]
+        self.__recent[key] = (time_now, duration)
+
+        self.__pending.append(ModerationAction(channel_name, chatter_name, duration, reason,
+                                               user_id if user_id is not None and user_id > 0 else None,
+                                               time.perf_counter()))
+        if not self.__flush_scheduled:
+            self.__flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.__flush)
+        return True
+
+    def __flush(self) -> None:
+        "Send every pending action as one batch."
+        self.__flush_scheduled = False
+        batch: list[ModerationAction] = self.__pending
+        self.__pending = []
+        task: asyncio.Task = asyncio.get_running_loop().create_task(self.__send_batch(batch))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __send_batch(self, batch: list[ModerationAction]) -> None:
+        "Resolve the ids a batch of actions needs, then send them concurrently."
+        ## Surrogate ids of chatters never seen in chat are not real ids, so those chatters are looked up by name.
+        names: set[str] = {self.__moderator_name}
+        for action in batch:
+            names.add(action.channel_name)
+            if action.user_id is None:
+                names.add(action.chatter_name)
+        user_ids: dict[str, int] = await self.__chatters.resolve(names)
+
+        bot_id: Optional[int] = user_ids.get(self.__moderator_name)
+        sends: list[Awaitable[None]] = []
+        for action in batch:
+            broadcaster_id: Optional[int] = user_ids.get(action.channel_name)
+            user_id: Optional[int] = action.user_id if action.user_id is not None else user_ids.get(action.chatter_name)
+            ## The (moderator id, token) pairs to apply the action as, in order.
+            moderators: list[tuple[int, Optional[str]]] = []
+            if self.__broadcaster_tokens is not None and (owner := self.__broadcaster_tokens(action.channel_name)) is not None:
+                moderators.append(owner)
+                broadcaster_id = owner[0]
+            if bot_id is not None:
+                moderators.append((bot_id, self.__token))
+            if not moderators or broadcaster_id is None or user_id is None:
+                _ACTIONS["failed"].inc()
+                print(f"Failed to {self.__verb(action)} {action.chatter_name} in {action.channel_name}: could not find their user id")
+                continue
+            sends.append(self.__send(action, broadcaster_id, user_id, moderators))
+        await asyncio.gather(*sends)
+
+    async def __send(self, action: ModerationAction, broadcaster_id: int, user_id: int, moderators: list[tuple[int, Optional[str]]]) -> None:
+        """
+        Send a single action, retrying it while it is rate limited or cannot connect.
+
+        The action is applied as the first of the moderators, and as the next if a moderator's token is rejected.
+        """
+        data: dict[str, object] = {"user_id" : str(user_id), "reason" : action.reason}
+        if action.duration is not None:
+            data["duration"] = action.duration
+        moderator: int = 0
+        attempt: int = 0
+        while True:
+            moderator_id, token = moderators[moderator]
+            try:
+                async with self.__limit:
+                    await self.__helix.request("POST", "moderation/bans",
+                                               [("broadcaster_id", str(broadcaster_id)), ("moderator_id", str(moderator_id))],
+                                               json={"data" : data},
+                                               token=token)
+            except HelixError as error:
+                ## Rate limits, connection errors and server errors are temporary, anything else will fail again.
+                if (error.status == 429 or error.status == 0 or error.status >= 500) and attempt < self.__max_retries:
+                    _RETRIES.inc()
+                    backoff: float = self.__backoff * (2 ** attempt) * (1.0 + (random.random() / 2.0))
+                    attempt += 1
+                    await asyncio.sleep(max(backoff, error.retry_after or 0.0))
+                    continue
+                ## The owner's token may have expired, been revoked or not have the scope, so the action is applied as the bot instead.
+                if error.status in (401, 403) and moderator + 1 < len(moderators):
+                    moderator += 1
+                    continue
+                _ACTIONS["failed"].inc()
+                print(f"Failed to {self.__verb(action)} {action.chatter_name} in {action.channel_name}: {error}")
+                return
+            _ACTIONS["applied"].inc()
+            _LATENCY.observe(time.perf_counter() - action.requested)
+            return
+
+    @staticmethod
+    def __verb(action: ModerationAction) -> str:
+        return "ban" if action.duration is None else "time out"
@@ -0,0 +1,234 @@
+from enum import IntEnum
+from typing import AbstractSet, Mapping, Optional, Sequence, Union
+
+__all__ = ("PyramidEventKind",
+           "PyramidEvent",
+           "DetectorState",
+           "PyramidDetector",
+           "advance",
+           "pre_reject",
+           "starts_with_emote")
+
+class PyramidEventKind(IntEnum):
+    "The kinds of events a pyramid attempt can produce."
+
+    ## A pyramid has reached a width of three on its way up, the chance to destroy it.
+    REACHED_THREE = 0
+
+    ## A pyramid is one level from completion on its way down, the chance to steal it.
+    ONE_FROM_COMPLETE = 1
+
+    ## A moderator or VIP completed a pyramid of only three, which is not counted.
+    DOES_NOT_COUNT = 2
+
+    ## A pyramid was completed.
+    SUCCESS = 3
+
+    ## A pyramid was failed, either by its builder or by being stolen.
+    FAILED = 4
+
+    ## A pyramid was blocked by another chatter.
+    BLOCKED = 5
+
+class PyramidEvent:
+    "An event produced by a chat message in a pyramid attempt."
+
+    __slots__ = ("kind",
+                 "chatter_name",
+                 "stolen",
+                 "size",
+                 "other")
+
+    def __init__(self,
+                 kind: PyramidEventKind,
+                 chatter_name: str,
+                 stolen: bool = False,
+                 size: int = 0,
+                 other: str = ""
+                 ) -> None:
+        self.kind: PyramidEventKind = kind
+        ## The chatter the event is about, the builder of a successful or failed pyramid, or the chatter who blocked it.
+        self.chatter_name: str = chatter_name
+        self.stolen: bool = stolen
+        ## The maximum width of a successful pyramid.
+        self.size: int = size
+        ## The chatter a successful pyramid was stolen from, or the emote of a pyramid one from completion.
+        self.other: str = other
+
+    def __repr__(self) -> str:
+        return f"PyramidEvent({self.kind.name}, {self.chatter_name!r}, stolen={self.stolen}, size={self.size}, other={self.other!r})"
+
+class DetectorState:
+    "The progress of the pyramid attempt in a single channel."
+
+    __slots__ = ("last_sender_name",
+                 "pyramid_emote",
+                 "pyramid_progress",
+                 "pyramid_max_height")
+
+    def __init__(self) -> None:
+        self.last_sender_name: str = ""
+        self.pyramid_emote: str = ""
+        self.pyramid_progress: int = 0
+        self.pyramid_max_height: int = 0
+
+## Messages that do not complete, fail or threaten a pyramid produce no events, and allocate no list.
+_NO_EVENTS: tuple[PyramidEvent, ...] = ()
+
+def _is_vip_or_moderator(badges: Union[Mapping[str, str], str]) -> bool:
+    "Check whether a chatter's badges, given as a mapping or as a raw `name/version,...` tag, include a VIP or moderator badge."
+    if isinstance(badges, str):
+        return any(badge in ("vip/1", "moderator/1") for badge in badges.split(","))
+    return any((user_type in badges and badges[user_type] == "1")
+               for user_type in ["vip", "moderator"])
+
+def _tagged_as_emote(emote_tag: str, word: str) -> bool:
+    """
+    Check whether a message's IRC `emotes` tag, `id:start-end,start-end/id:start-end`, marks the first word of the message as an emote.
+
+    Twitch tags every emote the sender can use, including subscriber emotes of channels other than the one they are chatting in.
+    """
+    if not emote_tag:
+        return False
+    first_word: str = f"0-{len(word) - 1}"
+    return any(position == first_word
+               for emote in emote_tag.split("/")
+               for position in emote.partition(":")[2].split(","))
+
+def starts_with_emote(text: str, emotes: AbstractSet[str], emote_tag: str = "") -> bool:
+    "Check whether a chat message starts with an emote, one of the channel's or one the message's IRC `emotes` tag marks, reading only its first word."
+    first_word: str = text.partition(" ")[0]
+    return first_word in emotes or _tagged_as_emote(emote_tag, first_word)
+
+def advance(state: DetectorState,
+            sender_name: str,
+            badges: Union[Mapping[str, str], str],
+            text: str,
+            emotes: Optional[AbstractSet[str]] = None,
+            emote_tag: str = ""
+            ) -> Sequence[PyramidEvent]:
+    """
+    Advance a channel's pyramid attempt with a chat message, and return the events it produced in order.
+
+    If the channel's emotes are given, only emotes can build pyramids, otherwise any repeated word can.
+    A word is also an emote if the message's IRC `emotes` tag marks it as one, such as another channel's subscriber emote.
+    This is the whole pyramid state machine, it has no side effects other than on the given state.
+    """
+    split_message: list[str] = text.split(" ")
+    events: Optional[list[PyramidEvent]] = None
+    is_stolen: bool = False
+
+    ## The pyramid has been progressed correctly iff;
+    ##      - All the words in the message are the same,
+    ##      - The number of messages is one greater or one smaller than the number in the previous level.
+    pyramid_level: int = len(split_message)
+    if valid := ((pyramid_level == state.pyramid_progress + 1
+                  or pyramid_level == state.pyramid_progress - 1)
+                 and all(emote == state.pyramid_emote
+                         for emote in split_message)):
+
+        ## Check whether we are going down or up the pyramid
+        on_downwards: bool = pyramid_level == (state.pyramid_progress - 1)
+
+        ## Update the progres of the pyramid
+        state.pyramid_max_height = max(state.pyramid_max_height, pyramid_level)
+        state.pyramid_progress = pyramid_level
+
+        if not on_downwards and pyramid_level == 3:
+            events = [PyramidEvent(PyramidEventKind.REACHED_THREE, sender_name)]
+
+        if on_downwards and pyramid_level == 2:
+            events = [PyramidEvent(PyramidEventKind.ONE_FROM_COMPLETE, sender_name, other=state.pyramid_emote)]
+
+        ## Declare success if the pyramid is complete
+        if (on_downwards and pyramid_level == 1
+            and state.pyramid_max_height >= 3):
+
+            ## The pyramid was stolen iff the current sender is not the same as the last
+            is_stolen = sender_name != state.last_sender_name
+
+            ## A moderator or VIP completing a pyramid of three is ignored entirely, the last sender is not even updated.
+            if (state.pyramid_max_height == 3
+                and not is_stolen
+                and _is_vip_or_moderator(badges)):
+                return [PyramidEvent(PyramidEventKind.DOES_NOT_COUNT, sender_name)]
+
+            events = [PyramidEvent(PyramidEventKind.SUCCESS, sender_name, is_stolen, state.pyramid_max_height, state.last_sender_name)]
+
+    ## This is a failed pyramid iff;
+    ##      - It is invalid but has progressed beyond its base size,
+    ##      - Or it was stolen.
+    if (not valid and state.pyramid_progress >= 2) or is_stolen:
+        if events is None:
+            events = []
+        events.append(PyramidEvent(PyramidEventKind.FAILED, state.last_sender_name))
+
+        ## If the pyramid was blocked
+        if not is_stolen and sender_name != state.last_sender_name:
+            events.append(PyramidEvent(PyramidEventKind.BLOCKED, sender_name))
+
+    ## Reset the pyramid if it is no longer valid (it was not progressed correctly).
+    if not valid:
+        ## A message that does not start with an emote cannot be the first level of a pyramid.
+        if emotes is not None and split_message[0] not in emotes and not _tagged_as_emote(emote_tag, split_message[0]):
+            state.pyramid_emote = ""
+            state.pyramid_max_height = 0
+            state.pyramid_progress = 0
+        else:
+            state.pyramid_emote = split_message[0]
+            state.pyramid_max_height = 1
+            state.pyramid_progress = 1
+
+    ## Keep track to sent the most recent valid level in the pyramid
+    state.last_sender_name = sender_name
+
+    return events if events is not None else _NO_EVENTS
+
+def pre_reject(state: DetectorState,
+               sender_name: str,
+               text: str,
+               emotes: AbstractSet[str],
+               emote_tag: str = ""
+               ) -> bool:
+    """
+    Advance a channel's pyramid attempt with a chat message that cannot take part in a pyramid, and return True,
+    or return False without changing the state if the message must go through `advance`.
+
+    Only the first word of the message is read, and the message is not split, a message whose first word is not
+    an emote produces no events and only resets the attempt, unless a pyramid of two or more levels is in progress,
+    which the message fails. The state is left exactly as `advance` would leave it given the same emotes.
+    """
+    if state.pyramid_progress >= 2 or starts_with_emote(text, emotes, emote_tag):
+        return False
+    state.pyramid_emote = ""
+    state.pyramid_max_height = 0
+    state.pyramid_progress = 0
+    state.last_sender_name = sender_name
+    return True
+
+class PyramidDetector:
+    "Detects pyramids in the chat of any number of channels, keeping a separate state for each channel."
+
+    __slots__ = ("__states",)
+
+    def __init__(self) -> None:
+        self.__states: dict[str, DetectorState] = {}
+
+    def feed(self,
+             channel_name: str,
+             sender_name: str,
+             badges: Union[Mapping[str, str], str],
+             text: str,
+             emotes: Optional[AbstractSet[str]] = None,
+             emote_tag: str = ""
+             ) -> Sequence[PyramidEvent]:
+        """
+        Feed a chat message to the detector, and return the events it produced in order.
+
+        If the channel's emotes are given, only emotes can build pyramids, as in the live handler,
+        where emotes the message's IRC `emotes` tag marks also count.
+        """
+        state: Optional[DetectorState] = self.__states.get(channel_name)
+        if state is None:
+            state = self.__states[channel_name] = DetectorState()
+        return advance(state, sender_name, badges, text, emotes, emote_tag)
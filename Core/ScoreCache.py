@@ -0,0 +1,248 @@
+from bisect import insort
+from collections import OrderedDict
+import sqlite3
+from typing import Literal, Optional
+
+from Core.Chatters import surrogate_id
+from Core.ScoreWriter import SCORE_FIELDS, ScoreWriter, merge_deltas
+
+__all__ = ("ScoreCache",)
+
+class ScoreCache:
+    """
+    In-memory cache of pyramid score rows, with a live top-k leaderboard index for each score type.
+
+    Chatter rows are keyed by user id, loaded from the database on first use, updated in place whenever a result
+    is recorded, and evicted least-recently-used first once the cache is full.
+    Rows with results still waiting on the score writer are never evicted, so a row read back
+    from the database after eviction always includes every result recorded for that chatter.
+    The leaderboard index is kept separately from the rows, so evicting inactive chatters never affects it.
+    Because every score only ever increases, a chatter outside the top-k can only enter it when
+    their own score is updated, so the index is kept exact by checking each updated chatter against it.
+    A chatter's scores that are still under a surrogate id, from before scores were keyed by user id,
+    are merged into their real id the first time their row is loaded. The merge is queued on the score writer,
+    and until it is committed the surrogate's scores are held in memory as the chatter's row, which is not evicted meanwhile.
+    Results recorded under a surrogate id while a chatter's real id could not be looked up are claimed the same way,
+    added to their real id's row. If that takes a leader's place from the index, the next chatter is not known,
+    so only chatters ahead of the last leader enter it until it is full again, and pages beyond it are read from the database.
+    """
+
+    __slots__ = ("__connection",
+                 "__writer",
+                 "__capacity",
+                 "__top_k",
+                 "__rows",
+                 "__leaders",
+                 "__truncated",
+                 "__hits",
+                 "__misses")
+
+    def __init__(self,
+                 connection: sqlite3.Connection,
+                 writer: ScoreWriter,
+                 capacity: int = 4096,
+                 top_k: int = 25
+                 ) -> None:
+        """
+        Create a score cache reading from the given connection and writing through the given writer.
+
+        Parameters
+        ----------
+        `connection: sqlite3.Connection` - The connection rows are read from on a cache miss.
+
+        `writer: ScoreWriter` - The writer recorded results are queued on.
+
+        `capacity: int = 4096` - The maximum number of chatter rows to hold in memory.
+
+        `top_k: int = 25` - The number of leaders to index for each score type.
+        """
+        self.__connection: sqlite3.Connection = connection
+        self.__writer: ScoreWriter = writer
+        self.__capacity: int = capacity
+        self.__top_k: int = top_k
+
+        ## Maps user ids to their scores in the order of `SCORE_FIELDS`, or None if they have no row.
+        self.__rows: OrderedDict[int, Optional[list[int]]] = OrderedDict()
+
+        ## Maps each score type to its leaders as (negated score, chatter name, user id) tuples in ascending order,
+        ## the same total order as the high score queries, ties broken by chatter name then user id.
+        self.__leaders: dict[str, list[tuple[int, str, int]]] = {}
+        for score in SCORE_FIELDS:
+            rows: list[tuple[int, str, int]] = self.__connection.execute(f"""
+                                                                         SELECT user_id, chatter_name, {score}
+                                                                         FROM pyramid_scores
+                                                                         ORDER BY {score} DESC, chatter_name, user_id
+                                                                         LIMIT :limit
+                                                                         """,
+                                                                         {"limit" : top_k}).fetchall()
+            self.__leaders[score] = sorted((-value, chatter_name, user_id) for user_id, chatter_name, value in rows)
+        ## The score types whose index lost a leader while full, so the chatters just outside it are not known.
+        self.__truncated: set[str] = set()
+
+        self.__hits: int = 0
+        self.__misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        "The number of row lookups answered from memory."
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        "The number of row lookups that had to read the database."
+        return self.__misses
+
+    def get(self, user_id: int, chatter_name: Optional[str] = None) -> Optional[list[int]]:
+        """
+        Get a chatter's scores in the order of `SCORE_FIELDS`, or None if they have never been recorded.
+
+        If the chatter has no row and their name is given, any scores recorded under a surrogate id for that name are adopted.
+        """
+        if user_id in self.__rows:
+            self.__hits += 1
+            self.__rows.move_to_end(user_id)
+            return self.__rows[user_id]
+
+        self.__misses += 1
+        result: Optional[tuple[int, ...]] = self.__connection.execute("""
+                                                                      SELECT success, failed, blocked, stolen, biggest
+                                                                      FROM pyramid_scores
+                                                                      WHERE user_id = :user_id
+                                                                      """,
+                                                                      {"user_id" : user_id}).fetchone()
+        row: Optional[list[int]] = list(result) if result is not None else None
+        if row is None and chatter_name is not None and user_id >= 0:
+            row = self.__adopt(user_id, chatter_name)
+
+        self.__rows[user_id] = row
+        if len(self.__rows) > self.__capacity:
+            self.__evict(user_id)
+        return row
+
+    def get_score(self,
+                  user_id: int,
+                  score: Literal["success", "failed", "blocked", "stolen", "biggest"],
+                  chatter_name: Optional[str] = None
+                  ) -> Optional[int]:
+        "Get one of a chatter's scores, or None if they have never been recorded."
+        row: Optional[list[int]] = self.get(user_id, chatter_name)
+        if row is None:
+            return None
+        return row[SCORE_FIELDS.index(score)]
+
+    def get_high_scores(self,
+                        score: Literal["success", "failed", "blocked", "stolen", "biggest"],
+                        top_scores: int,
+                        offset: int = 0
+                        ) -> Optional[list[tuple[str, int]]]:
+        """
+        Get the leaders for a score type from the index, skipping the given number of leaders first,
+        or None if leaders beyond those indexed are requested.
+        """
+        if offset + top_scores > (len(self.__leaders[score]) if score in self.__truncated else self.__top_k):
+            return None
+        return [(chatter_name, -value) for value, chatter_name, _ in self.__leaders[score][offset:offset + top_scores]]
+
+    def record(self,
+               user_id: int,
+               chatter_name: str,
+               result: Literal["success", "failed", "blocked", "stolen"],
+               stolen: bool = False,
+               size: int = 0,
+               channel_name: Optional[str] = None,
+               stolen_from: str = ""
+               ) -> None:
+        "Record a pyramid result, updating the cached row and leaderboards and queueing it on the writer."
+        ## The row must be loaded before the result is queued, otherwise it would be counted twice.
+        row: Optional[list[int]] = self.get(user_id, chatter_name)
+        self.__writer.increment(user_id, chatter_name, result, stolen, size, channel_name, stolen_from)
+        if row is None:
+            row = self.__rows[user_id] = [0, 0, 0, 0, 0]
+
+        updated: list[int] = [SCORE_FIELDS.index(result)]
+        row[updated[0]] += 1
+        if stolen:
+            row[3] += 1
+            updated.append(3)
+        if size > row[4]:
+            row[4] = size
+            updated.append(4)
+
+        for index in updated:
+            self.__update_leaders(SCORE_FIELDS[index], user_id, chatter_name, row[index])
+
+    def claim(self, user_id: int, chatter_name: str) -> None:
+        """
+        Queue a merge of the scores recorded under the surrogate id of a chatter's name into their real id,
+        such as results recorded while their id could not be looked up, and add them to the chatter's row.
+        """
+        surrogate: int = surrogate_id(chatter_name)
+        surrogate_row: Optional[list[int]] = self.get(surrogate)
+        if surrogate_row is None:
+            return
+        row: Optional[list[int]] = self.get(user_id)
+        self.__writer.merge(surrogate, user_id, chatter_name)
+        ## Until the merge is committed the database still has the surrogate's row, so it is held as having none.
+        self.__rows[surrogate] = None
+        if row is None:
+            row = self.__rows[user_id] = [0, 0, 0, 0, 0]
+        merge_deltas(row, surrogate_row)
+
+        for index, score in enumerate(SCORE_FIELDS):
+            leaders: list[tuple[int, str, int]] = self.__leaders[score]
+            position: int = next((position for position, leader in enumerate(leaders) if leader[2] == surrogate), -1)
+            if position >= 0:
+                value: int = leaders.pop(position)[0]
+                ## The chatter's merged score is at least the surrogate's, so the surrogate's place passes to them if they have none.
+                if all(leader[2] != user_id for leader in leaders):
+                    insort(leaders, (value, chatter_name, user_id))
+                elif len(leaders) == self.__top_k - 1:
+                    self.__truncated.add(score)
+            self.__update_leaders(score, user_id, chatter_name, row[index])
+
+    def __adopt(self, user_id: int, chatter_name: str) -> Optional[list[int]]:
+        "Queue a merge of the scores recorded under a surrogate id for a chatter's name into their real id, and return them."
+        result: Optional[tuple[int, ...]] = self.__connection.execute("""
+                                                                      SELECT user_id, success, failed, blocked, stolen, biggest
+                                                                      FROM pyramid_scores
+                                                                      WHERE chatter_name = :name AND user_id < 0
+                                                                      """,
+                                                                      {"name" : chatter_name}).fetchone()
+        if result is None:
+            return None
+        surrogate: int = result[0]
+        self.__writer.merge(surrogate, user_id, chatter_name)
+        row: list[int] = list(result[1:])
+        ## The chatter had no row under their real id, so their surrogate's place in each leaderboard passes straight to it.
+        for leaders in self.__leaders.values():
+            for position, leader in enumerate(leaders):
+                if leader[2] == surrogate:
+                    leaders[position] = (leader[0], chatter_name, user_id)
+                    leaders.sort()
+                    break
+        return row
+
+    def __evict(self, keep: int) -> None:
+        "Evict the least recently used row, other than the given chatter's, that has no results waiting on the score writer."
+        for user_id in self.__rows:
+            if user_id != keep and not self.__writer.has_pending(user_id):
+                del self.__rows[user_id]
+                return
+
+    def __update_leaders(self, score: str, user_id: int, chatter_name: str, value: int) -> None:
+        "Update the leaderboard index for a score type after one of a chatter's scores increased."
+        leaders: list[tuple[int, str, int]] = self.__leaders[score]
+        leader: tuple[int, str, int] = (-value, chatter_name, user_id)
+        ## A chatter already leading is always updated, as their name may have changed as well as their score.
+        for position, (_, _, leader_id) in enumerate(leaders):
+            if leader_id == user_id:
+                del leaders[position]
+                break
+        else:
+            ## A chatter tied with the last leader enters only if they also come before them by name.
+            if (len(leaders) >= self.__top_k or score in self.__truncated) and (not leaders or leader > leaders[-1]):
+                return
+        insort(leaders, leader)
+        del leaders[self.__top_k:]
+        if len(leaders) == self.__top_k:
+            self.__truncated.discard(score)
@@ -0,0 +1,914 @@
+import itertools
+import json
+from multiprocessing.connection import Connection, wait
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Literal, Optional
+
+from Core.Chatters import surrogate_id
+from Core.Metrics import REGISTRY, Counter, Histogram
+
+__all__ = ("ScoreWriter",
+           "SharedScoreWriter",
+           "ScoreWriterService",
+           "SCORE_FIELDS",
+           "merge_deltas",
+           "add_result",
+           "connect_writer",
+           "create_score_table",
+           "create_history_tables",
+           "migrate_history",
+           "migrate_scores",
+           "merge_scores",
+           "write_scores",
+           "ROLLUP_TABLES",
+           "period_start",
+           "prune_events",
+           "dead_letter_file",
+           "write_dead_letter",
+           "replay_dead_letters")
+
+## The score columns of the `pyramid_scores` table, in table order, after the user id and chatter name.
+SCORE_FIELDS: tuple[str, ...] = ("success", "failed", "blocked", "stolen", "biggest")
+
+## The score columns that can be incremented by declaring a pyramid result.
+_RESULT_INDICES: dict[str, int] = {"success" : 0, "failed" : 1, "blocked" : 2, "stolen" : 3}
+
+## The rollup tables of pyramid results per chatter, by user id, per channel, for each period.
+ROLLUP_TABLES: dict[str, str] = {"day" : "pyramid_daily_scores", "week" : "pyramid_weekly_scores"}
+
+## A pyramid event is (time, channel name, user id, chatter name, result, size, stolen from), stolen from is empty unless stolen.
+PyramidEventRow = tuple[float, str, int, str, str, int, str]
+
+## A merge of the scores of one user id into another is (from id, into id, chatter name).
+ScoreMerge = tuple[int, int, str]
+
+## The time in seconds between prunes of the pyramid event log.
+_PRUNE_INTERVAL: float = 3600.0
+
+## Upserts score deltas into a table of scores, given its key columns, their placeholders and any other columns to set.
+_UPSERT_SCORES: str = """
+                      INSERT INTO {table}
+                      VALUES ({columns}, ?, ?, ?, ?, ?)
+                      ON CONFLICT ({key}) DO UPDATE
+                      SET {update}
+                          success = success + excluded.success,
+                          failed = failed + excluded.failed,
+                          blocked = blocked + excluded.blocked,
+                          stolen = stolen + excluded.stolen,
+                          biggest = MAX(biggest, excluded.biggest)
+                      """
+
+_COMMIT_SECONDS: Histogram = REGISTRY.histogram("olliebot_db_commit_seconds", "Time taken to commit a batch of pyramid scores.")
+_ROWS_WRITTEN: Counter = REGISTRY.counter("olliebot_db_rows_written_total", "Pyramid score rows upserted by the score writer.")
+_EVENTS_WRITTEN: Counter = REGISTRY.counter("olliebot_db_events_written_total", "Pyramid events appended to the event log.")
+_EVENTS_PRUNED: Counter = REGISTRY.counter("olliebot_db_events_pruned_total", "Pyramid events pruned from the event log after the retention period.")
+_WRITE_FAILURES: Counter = REGISTRY.counter("olliebot_db_write_failures_total", "Failed attempts to commit a batch of pyramid scores.")
+_BATCHES_ABANDONED: Counter = REGISTRY.counter("olliebot_db_batches_abandoned_total",
+                                               "Batches of pyramid scores given up on after failing to write too many times.")
+_BATCHES_LOST: Counter = REGISTRY.counter("olliebot_db_batches_lost_total",
+                                          "Batches of pyramid scores given up on that could not be saved to a dead letter file either.")
+
+class ScoreWriter(threading.Thread):
+    """
+    Write-behind queue for pyramid scores, backed by a dedicated writer thread.
+
+    Score increments are merged per chatter, by user id, in memory and group-committed to the
+    database in a single transaction, either when the number of chatters waiting to be
+    written reaches the batch size or when the flush interval elapses, whichever comes first.
+    Callers never wait on disk I/O, they only take a lock held for the time it takes to update a dictionary.
+
+    Results declared in a channel are also appended to the pyramid event log, and added to the
+    daily and weekly rollups of that channel, in the same transaction as the lifetime scores.
+    Events older than the retention period are pruned by the writer thread, the rollups are kept.
+
+    Merges of the scores of one user id into another, such as of a surrogate id into a chatter's real id,
+    are queued the same way, and written in the same transaction as the increments queued with them.
+
+    A batch that fails to write is retried whole, before any increments queued after it, after a backoff that doubles with each failure.
+    Once it has failed more than the retry limit, or fails while the writer is closing, it is given up on and appended to
+    a dead letter file, from which `replay_dead_letters` can write it later, so that the writer never stalls behind it.
+    """
+
+    __slots__ = ("__database_path",
+                 "__batch_size",
+                 "__flush_interval",
+                 "__retention",
+                 "__max_retries",
+                 "__max_backoff",
+                 "__dead_letter_path",
+                 "__lock",
+                 "__wake",
+                 "__pending",
+                 "__flushing",
+                 "__names",
+                 "__flushing_names",
+                 "__pending_events",
+                 "__flushing_events",
+                 "__pending_merges",
+                 "__flushing_merges",
+                 "__flush_requested",
+                 "__closing",
+                 "__commits",
+                 "__abandoned")
+
+    def __init__(self,
+                 database_path: str,
+                 batch_size: int = 256,
+                 flush_interval: float = 1.0,
+                 retention: Optional[float] = 90 * 86400.0,
+                 max_retries: int = 8,
+                 max_backoff: float = 60.0,
+                 dead_letter_path: Optional[str] = None
+                 ) -> None:
+        """
+        Create and start a score writer for the given database.
+
+        Parameters
+        ----------
+        `database_path: str` - The path to the pyramid scores database.
+
+        `batch_size: int = 256` - The number of chatters with pending increments that triggers an early flush.
+
+        `flush_interval: float = 1.0` - The maximum time in seconds an increment waits before it is committed.
+
+        `retention: Optional[float] = 90 days` - The time in seconds pyramid events are kept for, or None to keep them forever.
+
+        `max_retries: int = 8` - The number of times a batch that failed to write is retried before it is given up on.
+
+        `max_backoff: float = 60.0` - The longest time in seconds between retries, which start one flush interval apart.
+
+        `dead_letter_path: Optional[str] = None` - The file batches given up on are appended to, None for one beside the database.
+        """
+        super().__init__(name="ScoreWriter", daemon=True)
+        self.__database_path: str = database_path
+        self.__batch_size: int = batch_size
+        self.__flush_interval: float = flush_interval
+        self.__retention: Optional[float] = retention
+        self.__max_retries: int = max_retries
+        self.__max_backoff: float = max_backoff
+        ## A shared score writer has no database, so its batches are only counted as lost unless it is given a file.
+        if dead_letter_path is None and database_path:
+            dead_letter_path = dead_letter_file(database_path)
+        self.__dead_letter_path: Optional[str] = dead_letter_path
+
+        ## Merged increments waiting to be written, and those currently being written.
+        ## Each maps a user id to a list of deltas in the order of `SCORE_FIELDS`,
+        ## except that the `biggest` entry is a maximum rather than a delta.
+        self.__lock: threading.Lock = threading.Lock()
+        self.__wake: threading.Condition = threading.Condition(self.__lock)
+        self.__pending: dict[int, list[int]] = {}
+        self.__flushing: dict[int, list[int]] = {}
+
+        ## The latest names of the chatters with pending and flushing increments, written with their scores.
+        self.__names: dict[int, str] = {}
+        self.__flushing_names: dict[int, str] = {}
+
+        ## Pyramid events waiting to be appended to the event log, and those currently being written.
+        self.__pending_events: list[PyramidEventRow] = []
+        self.__flushing_events: list[PyramidEventRow] = []
+
+        ## Merges of one user id's scores into another's waiting to be written, and those currently being written.
+        self.__pending_merges: list[ScoreMerge] = []
+        self.__flushing_merges: list[ScoreMerge] = []
+        self.__flush_requested: bool = False
+        self.__closing: bool = False
+        self.__commits: int = 0
+        self.__abandoned: int = 0
+
+        self.start()
+
+    @property
+    def commits(self) -> int:
+        "The number of transactions committed by this writer."
+        return self.__commits
+
+    @property
+    def abandoned(self) -> int:
+        "The number of batches this writer gave up on after they failed to write."
+        return self.__abandoned
+
+    def increment(self,
+                  user_id: int,
+                  chatter_name: str,
+                  result: Literal["success", "failed", "blocked"],
+                  stolen: bool = False,
+                  size: int = 0,
+                  channel_name: Optional[str] = None,
+                  stolen_from: str = ""
+                  ) -> None:
+        """
+        Queue a pyramid result for the given chatter, this never blocks on the database.
+
+        If the channel the result was declared in is given, it is also logged as a pyramid event.
+        """
+        if result not in _RESULT_INDICES:
+            raise ValueError(f"Unknown pyramid result: {result}")
+        with self.__lock:
+            if self.__closing:
+                raise RuntimeError("Cannot queue scores on a closed score writer.")
+            deltas: Optional[list[int]] = self.__pending.get(user_id)
+            if deltas is None:
+                deltas = self.__pending[user_id] = [0, 0, 0, 0, 0]
+            add_result(deltas, result, stolen, size)
+            self.__names[user_id] = chatter_name
+            if channel_name is not None:
+                self.__pending_events.append((time.time(), channel_name, user_id, chatter_name, result, size, stolen_from))
+            if len(self.__pending) >= self.__batch_size:
+                self.__wake.notify_all()
+
+    def merge(self, from_id: int, into_id: int, chatter_name: str) -> None:
+        "Queue a merge of the scores of one user id into another, such as a surrogate id into a chatter's real id, this never blocks on the database."
+        with self.__lock:
+            if self.__closing:
+                raise RuntimeError("Cannot queue scores on a closed score writer.")
+            self.__pending_merges.append((from_id, into_id, chatter_name))
+
+    def has_pending(self, user_id: int) -> bool:
+        "Check whether the given chatter has increments, or scores being merged into or out of them, that have not yet been committed."
+        with self.__lock:
+            return (user_id in self.__pending or user_id in self.__flushing
+                    or any(user_id in (from_id, into_id) for from_id, into_id, _ in self.__pending_merges)
+                    or any(user_id in (from_id, into_id) for from_id, into_id, _ in self.__flushing_merges))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Commit all queued increments now, and wait until they are committed or given up on.
+
+        Returns False if they were not committed within the timeout, such as if the write failed and is being retried,
+        or if a batch was given up on while waiting. Without a timeout this waits at most until the retries of every batch are exhausted.
+        """
+        deadline: Optional[float] = time.monotonic() + timeout if timeout is not None else None
+        with self.__lock:
+            abandoned: int = self.__abandoned
+            self.__flush_requested = True
+            ## The writer thread and flushing callers share the condition, so every waiter is woken.
+            self.__wake.notify_all()
+            while (self.__pending or self.__flushing or self.__pending_events or self.__flushing_events
+                   or self.__pending_merges or self.__flushing_merges):
+                remaining: Optional[float] = deadline - time.monotonic() if deadline is not None else None
+                if (remaining is not None and remaining <= 0.0) or not self.is_alive():
+                    return False
+                self.__wake.wait(remaining)
+            return self.__abandoned == abandoned
+
+    def close(self) -> None:
+        "Commit all queued increments and stop the writer thread, giving up on any that fail to write."
+        with self.__lock:
+            self.__closing = True
+            self.__wake.notify_all()
+        if self.is_alive():
+            self.join()
+
+    ##################################################
+    #### Writer thread
+
+    def run(self) -> None:
+        connection: Optional[sqlite3.Connection] = self._connect(self.__database_path)
+        ## Events are first pruned one interval after the writer starts.
+        last_prune: float = time.monotonic()
+        ## The number of times in a row the flushing batch has failed to write.
+        failures: int = 0
+        try:
+            while True:
+                with self.__lock:
+                    ## A batch that failed to write is still flushing, and is retried unchanged after a backoff,
+                    ## which neither a full batch nor a flush request cuts short.
+                    retrying: bool = bool(self.__flushing or self.__flushing_events or self.__flushing_merges)
+                    wait_time: float = (min(self.__flush_interval * 2 ** (failures - 1), self.__max_backoff) if retrying
+                                        else self.__flush_interval)
+                    deadline: float = time.monotonic() + wait_time
+                    while (not self.__closing
+                           and (retrying or (not self.__flush_requested and len(self.__pending) < self.__batch_size))
+                           and (remaining := deadline - time.monotonic()) > 0.0):
+                        self.__wake.wait(remaining)
+                    if not retrying:
+                        self.__flush_requested = False
+                        self.__flushing, self.__pending = self.__pending, {}
+                        self.__flushing_names, self.__names = self.__names, {}
+                        self.__flushing_events, self.__pending_events = self.__pending_events, []
+                        self.__flushing_merges, self.__pending_merges = self.__pending_merges, []
+                    closing: bool = self.__closing
+
+                if self.__flushing or self.__flushing_events or self.__flushing_merges:
+                    try:
+                        self._write(connection, self.__flushing, self.__flushing_names, self.__flushing_events, self.__flushing_merges)
+                        self.__commits += 1
+                        failures = 0
+                    except (sqlite3.Error, TimeoutError) as error:
+                        failures += 1
+                        _WRITE_FAILURES.inc()
+                        print(f"Failed to write pyramid scores: {error}")
+                        ## The batch is kept as it is rather than merged into later increments, as a batch whose
+                        ## acknowledgement was lost may have been committed, and must be recognisable when sent again.
+                        if not closing and failures <= self.__max_retries:
+                            continue
+                        self.__abandon_batch()
+                        failures = 0
+                    with self.__lock:
+                        self.__flushing = {}
+                        self.__flushing_names = {}
+                        self.__flushing_events = []
+                        self.__flushing_merges = []
+                        self.__wake.notify_all()
+
+                if (self.__retention is not None
+                    and time.monotonic() - last_prune >= _PRUNE_INTERVAL):
+                    last_prune = time.monotonic()
+                    try:
+                        self._prune(connection, time.time() - self.__retention)
+                    except (sqlite3.Error, TimeoutError) as error:
+                        print(f"Failed to prune pyramid events: {error}")
+
+                if closing:
+                    with self.__lock:
+                        if not self.__pending and not self.__pending_events and not self.__pending_merges:
+                            return
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def __abandon_batch(self) -> None:
+        "Give up on the flushing batch, saving it to the dead letter file if there is one."
+        _BATCHES_ABANDONED.inc()
+        self.__abandoned += 1
+        self._abandon()
+        if self.__dead_letter_path is None:
+            _BATCHES_LOST.inc()
+            print("Gave up on writing a batch of pyramid scores, with no dead letter file to save it to.")
+            return
+        try:
+            write_dead_letter(self.__dead_letter_path, self.__flushing, self.__flushing_names, self.__flushing_events, self.__flushing_merges)
+            print(f"Gave up on writing a batch of pyramid scores, it was saved to {self.__dead_letter_path}.")
+        except (OSError, TypeError, ValueError) as error:
+            _BATCHES_LOST.inc()
+            print(f"Failed to save a batch of pyramid scores that could not be written: {error}")
+
+    def _connect(self, database_path: str) -> Optional[sqlite3.Connection]:
+        "Open the writer thread's connection."
+        return connect_writer(database_path)
+
+    def _abandon(self) -> None:
+        "Forget the batch that is being given up on, the next batch is a new one."
+        pass
+
+    def _write(self,
+               connection: Optional[sqlite3.Connection],
+               batch: dict[int, list[int]],
+               names: dict[int, str],
+               events: list[PyramidEventRow],
+               merges: list[ScoreMerge]
+               ) -> None:
+        "Write a batch of merged increments, with the names of their chatters, pyramid events and merges of scores in a single transaction."
+        write_scores(connection, batch, names, events, merges)
+
+    def _prune(self, connection: Optional[sqlite3.Connection], before: float) -> None:
+        "Prune the pyramid events logged before the given time."
+        prune_events(connection, before)
+
+class SharedScoreWriter(ScoreWriter):
+    """
+    Write-behind queue for pyramid scores that commits through a score writer service shared by several bot processes.
+
+    Increments are merged and batched exactly as by a `ScoreWriter`, but each batch is sent to the
+    service over a pipe, and is only considered committed once the service acknowledges it.
+    Batches that fail or are not acknowledged within the reply timeout are retried under the same batch id,
+    so a batch the service committed but whose acknowledgement came too late is acknowledged again rather than committed twice.
+    A batch given up on may therefore have been committed already, if only its acknowledgements were lost.
+    """
+
+    __slots__ = ("__connection",
+                 "__reply_timeout",
+                 "__batch_ids",
+                 "__unacknowledged_id")
+
+    def __init__(self,
+                 connection: Connection,
+                 batch_size: int = 256,
+                 flush_interval: float = 1.0,
+                 reply_timeout: float = 30.0,
+                 dead_letter_path: Optional[str] = None
+                 ) -> None:
+        """
+        Create and start a shared score writer sending its batches over the given end of a pipe to a `ScoreWriterService`.
+
+        Batches given up on are appended to the dead letter file, or only counted as lost if there is none.
+        """
+        self.__connection: Connection = connection
+        self.__reply_timeout: float = reply_timeout
+        self.__batch_ids: itertools.count = itertools.count()
+        ## The id of the batch being sent until it is acknowledged, retries of the batch reuse it.
+        self.__unacknowledged_id: Optional[int] = None
+        super().__init__("", batch_size, flush_interval, dead_letter_path=dead_letter_path)
+
+    def _connect(self, database_path: str) -> Optional[sqlite3.Connection]:
+        return None
+
+    def _abandon(self) -> None:
+        ## The next batch must not reuse the id, or the service may take it for the abandoned batch and only acknowledge it.
+        self.__unacknowledged_id = None
+
+    def _write(self,
+               connection: Optional[sqlite3.Connection],
+               batch: dict[int, list[int]],
+               names: dict[int, str],
+               events: list[PyramidEventRow],
+               merges: list[ScoreMerge]
+               ) -> None:
+        ## The writer thread retries a failed batch unchanged, so it is sent under the id it was first sent under.
+        if self.__unacknowledged_id is None:
+            self.__unacknowledged_id = next(self.__batch_ids)
+        batch_id: int = self.__unacknowledged_id
+        try:
+            self.__connection.send((batch_id, batch, names, events, merges))
+            deadline: float = time.monotonic() + self.__reply_timeout
+            while self.__connection.poll(max(0.0, deadline - time.monotonic())):
+                reply_id, error = self.__connection.recv()
+                ## Replies to earlier batches are ignored, a late reply to an earlier attempt at this batch is its acknowledgement.
+                if reply_id != batch_id:
+                    continue
+                if error is not None:
+                    raise sqlite3.OperationalError(error)
+                self.__unacknowledged_id = None
+                return
+        except (EOFError, OSError) as error:
+            raise TimeoutError(f"Lost the connection to the score writer service: {error}") from error
+        raise TimeoutError(f"The score writer service did not acknowledge batch {batch_id}.")
+
+    def _prune(self, connection: Optional[sqlite3.Connection], before: float) -> None:
+        ## Events are pruned by the score writer service.
+        pass
+
+class ScoreWriterService(threading.Thread):
+    """
+    Commits the batches of the shared score writers of several bot processes, on a dedicated thread.
+
+    Each process has its own pipe, so a process dying never affects the others.
+    Every batch waiting on any pipe is merged and committed in one transaction, then each is acknowledged.
+    The id of the last batch committed from each pipe is kept, and a batch sent again under that id is acknowledged without being written.
+    Events older than the retention period are pruned by the service, rather than by each process.
+    """
+
+    __slots__ = ("__database_path",
+                 "__retention",
+                 "__lock",
+                 "__connections",
+                 "__closing",
+                 "__commits")
+
+    def __init__(self, database_path: str, retention: Optional[float] = 90 * 86400.0) -> None:
+        super().__init__(name="ScoreWriterService", daemon=True)
+        self.__database_path: str = database_path
+        self.__retention: Optional[float] = retention
+        self.__lock: threading.Lock = threading.Lock()
+        self.__connections: list[Connection] = []
+        self.__closing: bool = False
+        self.__commits: int = 0
+        self.start()
+
+    @property
+    def commits(self) -> int:
+        "The number of transactions committed by this service."
+        return self.__commits
+
+    def add_connection(self, connection: Connection) -> None:
+        "Start serving a shared score writer on the given end of a pipe."
+        with self.__lock:
+            self.__connections.append(connection)
+
+    def close(self) -> None:
+        "Commit any batches already sent, then stop the service."
+        with self.__lock:
+            self.__closing = True
+        if self.is_alive():
+            self.join()
+
+    def run(self) -> None:
+        connection: sqlite3.Connection = connect_writer(self.__database_path)
+        last_prune: float = time.monotonic()
+        ## Maps each pipe to the id of the last batch committed from it.
+        committed: dict[Connection, int] = {}
+        try:
+            while True:
+                if (self.__retention is not None
+                    and time.monotonic() - last_prune >= _PRUNE_INTERVAL):
+                    last_prune = time.monotonic()
+                    try:
+                        prune_events(connection, time.time() - self.__retention)
+                    except sqlite3.Error as error:
+                        print(f"Failed to prune pyramid events: {error}")
+
+                with self.__lock:
+                    connections: list[Connection] = list(self.__connections)
+                    closing: bool = self.__closing
+                ## New connections are picked up within the wait timeout.
+                ready: list[Connection] = wait(connections, 0.0 if closing else 0.5) if connections else []
+                if not ready:
+                    if closing:
+                        return
+                    if not connections:
+                        time.sleep(0.5)
+                    continue
+
+                ## Each request is the pipe, the batch id, and whether the batch was already committed in an earlier transaction.
+                requests: list[tuple[Connection, int, bool]] = []
+                received: dict[Connection, int] = {}
+                merged: dict[int, list[int]] = {}
+                names: dict[int, str] = {}
+                events: list[PyramidEventRow] = []
+                merges: list[ScoreMerge] = []
+                for pipe in ready:
+                    try:
+                        while pipe.poll():
+                            batch_id, batch, batch_names, batch_events, batch_merges = pipe.recv()
+                            ## A batch sent again because its acknowledgement was late is only acknowledged.
+                            if batch_id == committed.get(pipe) or batch_id == received.get(pipe):
+                                requests.append((pipe, batch_id, batch_id == committed.get(pipe)))
+                                continue
+                            requests.append((pipe, batch_id, False))
+                            received[pipe] = batch_id
+                            for user_id, deltas in batch.items():
+                                merge_deltas(merged.setdefault(user_id, [0, 0, 0, 0, 0]), deltas)
+                            names.update(batch_names)
+                            events.extend(batch_events)
+                            merges.extend(batch_merges)
+                    except (EOFError, OSError):
+                        ## The process on the other end has exited.
+                        with self.__lock:
+                            self.__connections.remove(pipe)
+                        committed.pop(pipe, None)
+                        received.pop(pipe, None)
+                        pipe.close()
+
+                error: Optional[str] = None
+                if merged or events or merges:
+                    try:
+                        write_scores(connection, merged, names, events, merges)
+                        self.__commits += 1
+                    except sqlite3.Error as write_error:
+                        error = str(write_error)
+                        print(f"Failed to write pyramid scores: {error}")
+                if error is None:
+                    committed.update(received)
+                for pipe, batch_id, already_committed in requests:
+                    try:
+                        pipe.send((batch_id, None if already_committed else error))
+                    except (EOFError, OSError):
+                        pass
+        finally:
+            connection.close()
+
+##################################################
+#### Writing
+
+def connect_writer(database_path: str) -> sqlite3.Connection:
+    "Open a connection for writing scores, in write-ahead logging mode so readers are never blocked."
+    connection: sqlite3.Connection = sqlite3.connect(database_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    create_score_table(connection)
+    create_history_tables(connection)
+    return connection
+
+def create_score_table(connection: sqlite3.Connection) -> None:
+    """
+    Create the `pyramid_scores` table if it does not exist, or migrate it if it is still keyed by chatter name.
+
+    Fields are:
+        - user_id: INTEGER PRIMARY KEY, the chatter's Twitch user id, or a negative surrogate id if it is not known,
+        - chatter_name: varchar(255), the chatter's most recent name,
+        - success: int,
+        - failed: int,
+        - blocked: int,
+        - stolen: int,
+        - biggest: int.
+    """
+    if not _has_user_ids(connection):
+        ## Schema changes do not begin a transaction implicitly, so the migration's transaction is begun explicitly,
+        ## and the table is checked again once the write lock is held, in case another process migrated it first.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if not _has_user_ids(connection):
+                migrate_scores(connection)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+    with connection:
+        connection.execute("""
+                           CREATE TABLE IF NOT EXISTS pyramid_scores (user_id INTEGER PRIMARY KEY,
+                                                                      chatter_name varchar(255) NOT NULL,
+                                                                      success int, failed int, blocked int, stolen int, biggest int)
+                           """)
+        connection.execute("CREATE INDEX IF NOT EXISTS pyramid_scores_chatter_name ON pyramid_scores (chatter_name)")
+
+def _has_user_ids(connection: sqlite3.Connection) -> bool:
+    "Check whether the `pyramid_scores` table is keyed by user id, or does not exist yet."
+    columns: list[str] = [column[1] for column in connection.execute("PRAGMA table_info(pyramid_scores)")]
+    return not columns or "user_id" in columns
+
+def migrate_scores(connection: sqlite3.Connection) -> int:
+    """
+    Migrate a `pyramid_scores` table keyed by chatter name to one keyed by user id, and return the number of chatters migrated.
+
+    Rows whose names differ only by case are merged. The real ids of the chatters are not known offline,
+    so every chatter is given a surrogate id, which is replaced by their real id when they are next seen
+    or when `Tools.MigrateScores` resolves every surrogate id at once. The old table is kept as `pyramid_scores_by_name`.
+    Must be called inside a transaction, so that the migration either completes or has no effect.
+    """
+    connection.execute("ALTER TABLE pyramid_scores RENAME TO pyramid_scores_by_name")
+    ## Indexes keep their names when their table is renamed, so they would stop the new table's from being created.
+    for (index_name,) in connection.execute("""
+                                            SELECT name FROM sqlite_master
+                                            WHERE type = 'index' AND tbl_name = 'pyramid_scores_by_name' AND sql IS NOT NULL
+                                            """).fetchall():
+        connection.execute(f"DROP INDEX \"{index_name}\"")
+    connection.execute("""
+                       CREATE TABLE pyramid_scores (user_id INTEGER PRIMARY KEY,
+                                                    chatter_name varchar(255) NOT NULL,
+                                                    success int, failed int, blocked int, stolen int, biggest int)
+                       """)
+    rows: list[tuple] = connection.execute("""
+                                           SELECT lower(chatter_name), SUM(success), SUM(failed), SUM(blocked), SUM(stolen), MAX(biggest)
+                                           FROM pyramid_scores_by_name
+                                           GROUP BY lower(chatter_name)
+                                           """).fetchall()
+    connection.executemany("INSERT INTO pyramid_scores VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(surrogate_id(chatter_name), chatter_name, *scores) for chatter_name, *scores in rows])
+    print(f"Migrated the pyramid scores of {len(rows)} chatters to surrogate user ids.")
+    return len(rows)
+
+def merge_scores(connection: sqlite3.Connection, from_id: int, into_id: int, chatter_name: str) -> bool:
+    """
+    Merge the scores of one user id into another, such as a surrogate id into a chatter's real id, in a single transaction.
+
+    Returns whether there were any scores to merge.
+    """
+    with connection:
+        return _merge_scores(connection, from_id, into_id, chatter_name)
+
+def _merge_scores(connection: sqlite3.Connection, from_id: int, into_id: int, chatter_name: str) -> bool:
+    """
+    Merge the scores of one user id into another within the current transaction, and return whether there were any.
+
+    The user id's pyramid events and rollups are moved to the other id too.
+    """
+    merged: int = connection.execute("""
+                                     INSERT INTO pyramid_scores
+                                     SELECT :into_id, :chatter_name, success, failed, blocked, stolen, biggest
+                                     FROM pyramid_scores
+                                     WHERE user_id = :from_id
+                                     ON CONFLICT (user_id) DO UPDATE
+                                     SET success = success + excluded.success,
+                                         failed = failed + excluded.failed,
+                                         blocked = blocked + excluded.blocked,
+                                         stolen = stolen + excluded.stolen,
+                                         biggest = MAX(biggest, excluded.biggest)
+                                     """,
+                                     {"from_id" : from_id, "into_id" : into_id, "chatter_name" : chatter_name}).rowcount
+    connection.execute("DELETE FROM pyramid_scores WHERE user_id = :from_id", {"from_id" : from_id})
+    ## The event log and rollups are missing while the score table is migrated, before they are created.
+    if _has_table(connection, "pyramid_events"):
+        connection.execute("UPDATE pyramid_events SET user_id = :into_id WHERE user_id = :from_id", {"from_id" : from_id, "into_id" : into_id})
+        for table in ROLLUP_TABLES.values():
+            connection.execute(f"""
+                               INSERT INTO {table}
+                               SELECT period_start, channel_name, :into_id, :chatter_name, success, failed, blocked, stolen, biggest
+                               FROM {table}
+                               WHERE user_id = :from_id
+                               ON CONFLICT (channel_name, period_start, user_id) DO UPDATE
+                               SET success = success + excluded.success,
+                                   failed = failed + excluded.failed,
+                                   blocked = blocked + excluded.blocked,
+                                   stolen = stolen + excluded.stolen,
+                                   biggest = MAX(biggest, excluded.biggest)
+                               """,
+                               {"from_id" : from_id, "into_id" : into_id, "chatter_name" : chatter_name})
+            connection.execute(f"DELETE FROM {table} WHERE user_id = :from_id", {"from_id" : from_id})
+    return merged > 0
+
+def _has_table(connection: sqlite3.Connection, table: str) -> bool:
+    "Check whether a table exists."
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+def create_history_tables(connection: sqlite3.Connection) -> None:
+    """
+    Create the pyramid event log and rollup tables if they do not exist, or migrate them if they are still keyed by chatter name.
+
+    Chatters are keyed by user id in both, as in `pyramid_scores`, their names are kept for display.
+    """
+    if not _has_history_user_ids(connection):
+        ## As for the score table, the migration's transaction is begun explicitly, and the tables checked again once it holds the write lock.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if not _has_history_user_ids(connection):
+                migrate_history(connection)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+    with connection:
+        _create_history_tables(connection)
+
+def _create_history_tables(connection: sqlite3.Connection) -> None:
+    "Create the pyramid event log and rollup tables within the current transaction, if they do not exist."
+    connection.execute("""
+                       CREATE TABLE IF NOT EXISTS pyramid_events (time real NOT NULL,
+                                                                  channel_name varchar(255) NOT NULL,
+                                                                  user_id INTEGER NOT NULL,
+                                                                  chatter_name varchar(255) NOT NULL,
+                                                                  result varchar(8) NOT NULL,
+                                                                  size int NOT NULL,
+                                                                  stolen_from varchar(255) NOT NULL)
+                       """)
+    connection.execute("CREATE INDEX IF NOT EXISTS pyramid_events_time ON pyramid_events (time)")
+    connection.execute("CREATE INDEX IF NOT EXISTS pyramid_events_user_id ON pyramid_events (user_id)")
+    for table in ROLLUP_TABLES.values():
+        connection.execute(f"""
+                           CREATE TABLE IF NOT EXISTS {table} (period_start int NOT NULL,
+                                                               channel_name varchar(255) NOT NULL,
+                                                               user_id INTEGER NOT NULL,
+                                                               chatter_name varchar(255) NOT NULL,
+                                                               success int, failed int, blocked int, stolen int, biggest int,
+                                                               PRIMARY KEY (channel_name, period_start, user_id))
+                           """)
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_user_id ON {table} (user_id)")
+
+def _has_history_user_ids(connection: sqlite3.Connection) -> bool:
+    "Check whether the pyramid event log is keyed by user id, or does not exist yet."
+    columns: list[str] = [column[1] for column in connection.execute("PRAGMA table_info(pyramid_events)")]
+    return not columns or "user_id" in columns
+
+def migrate_history(connection: sqlite3.Connection) -> int:
+    """
+    Migrate a pyramid event log and rollups keyed by chatter name to ones keyed by user id, and return the number of events migrated.
+
+    Each name is given the user id of the chatter with that name in `pyramid_scores`, preferring a real id,
+    or its surrogate id if there is none, which is replaced with the real id when the chatter's scores are merged into it.
+    Rollup rows of names given the same id are merged. The old tables are kept with a `_by_name` suffix.
+    Must be called inside a transaction, after the score table is keyed by user id, so that the migration either completes or has no effect.
+    """
+    connection.create_function("surrogate_id", 1, surrogate_id, deterministic=True)
+    tables: list[str] = [table for table in ("pyramid_events", *ROLLUP_TABLES.values()) if _has_table(connection, table)]
+    for table in tables:
+        connection.execute(f"ALTER TABLE {table} RENAME TO {table}_by_name")
+        ## Indexes keep their names when their table is renamed, so they would stop the new tables' from being created.
+        for (index_name,) in connection.execute("""
+                                                SELECT name FROM sqlite_master
+                                                WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+                                                """, (f"{table}_by_name",)).fetchall():
+            connection.execute(f"DROP INDEX \"{index_name}\"")
+    _create_history_tables(connection)
+
+    ## The real id of a name is positive, so the largest id of the name is preferred.
+    user_id: str = """
+                   COALESCE((SELECT MAX(user_id) FROM pyramid_scores WHERE chatter_name = lower(old.chatter_name)),
+                            surrogate_id(old.chatter_name))
+                   """
+    migrated: int = 0
+    if "pyramid_events" in tables:
+        migrated = connection.execute(f"""
+                                      INSERT INTO pyramid_events
+                                      SELECT time, channel_name, {user_id}, lower(chatter_name), result, size, stolen_from
+                                      FROM pyramid_events_by_name AS old
+                                      """).rowcount
+    for table in ROLLUP_TABLES.values():
+        if table in tables:
+            connection.execute(f"""
+                               INSERT INTO {table}
+                               SELECT period_start, channel_name, {user_id}, MAX(lower(chatter_name)),
+                                      SUM(success), SUM(failed), SUM(blocked), SUM(stolen), MAX(biggest)
+                               FROM {table}_by_name AS old
+                               GROUP BY channel_name, period_start, 3
+                               """)
+    print(f"Migrated {migrated} pyramid events and their rollups to user ids.")
+    return migrated
+
+def period_start(timestamp: float, period: Literal["day", "week"]) -> int:
+    "Get the start of the UTC day, or of the UTC week starting on Monday, containing a Unix timestamp, as a Unix timestamp."
+    day: int = int(timestamp // 86400)
+    if period == "week":
+        ## The Unix epoch was a Thursday.
+        day -= (day + 3) % 7
+    return day * 86400
+
+def write_scores(connection: sqlite3.Connection,
+                 batch: dict[int, list[int]],
+                 names: dict[int, str],
+                 events: Iterable[PyramidEventRow] = (),
+                 merges: Iterable[ScoreMerge] = ()
+                 ) -> None:
+    """
+    Write a batch of merged increments keyed by user id, updating the names of their chatters,
+    append a batch of pyramid events and add them to the rollups, and merge the scores of user ids into others, in a single transaction.
+
+    Merges are written last, so increments and events queued for a user id before it was merged into another are moved with it.
+    """
+    start: float = time.perf_counter()
+
+    ## Events are merged per period, channel and chatter in memory, so each rollup row is upserted once, with the chatter's latest name.
+    rollups: dict[str, dict[tuple[int, str, int], list[int]]] = {period : {} for period in ROLLUP_TABLES}
+    event_names: dict[int, str] = {}
+    event_rows: list[PyramidEventRow] = []
+    for event in events:
+        event_rows.append(event)
+        event_time, channel_name, user_id, chatter_name, result, size, stolen_from = event
+        event_names[user_id] = chatter_name
+        for period, rows in rollups.items():
+            key: tuple[int, str, int] = (period_start(event_time, period), channel_name, user_id)
+            deltas: Optional[list[int]] = rows.get(key)
+            if deltas is None:
+                deltas = rows[key] = [0, 0, 0, 0, 0]
+            add_result(deltas, result, bool(stolen_from), size)
+
+    with connection:
+        connection.executemany(_UPSERT_SCORES.format(table="pyramid_scores", key="user_id", columns="?, ?",
+                                                     update="chatter_name = excluded.chatter_name,"),
+                               [(user_id, names[user_id], *deltas) for user_id, deltas in batch.items()])
+        if event_rows:
+            connection.executemany("INSERT INTO pyramid_events VALUES (?, ?, ?, ?, ?, ?, ?)", event_rows)
+            for period, rows in rollups.items():
+                connection.executemany(_UPSERT_SCORES.format(table=ROLLUP_TABLES[period],
+                                                             key="channel_name, period_start, user_id",
+                                                             columns="?, ?, ?, ?",
+                                                             update="chatter_name = excluded.chatter_name,"),
+                                       [(period_key, channel_name, user_id, event_names[user_id], *deltas)
+                                        for (period_key, channel_name, user_id), deltas in rows.items()])
+        for from_id, into_id, chatter_name in merges:
+            _merge_scores(connection, from_id, into_id, chatter_name)
+    _COMMIT_SECONDS.observe(time.perf_counter() - start)
+    _ROWS_WRITTEN.inc(len(batch))
+    _EVENTS_WRITTEN.inc(len(event_rows))
+
+def prune_events(connection: sqlite3.Connection, before: float) -> int:
+    "Delete the pyramid events logged before the given time, and return the number deleted."
+    with connection:
+        pruned: int = connection.execute("DELETE FROM pyramid_events WHERE time < ?", (before,)).rowcount
+    _EVENTS_PRUNED.inc(pruned)
+    return pruned
+
+def dead_letter_file(database_path: str) -> str:
+    "The dead letter file of batches given up on beside a scores database, such as `pyramids.failed.jsonl`."
+    return f"{os.path.splitext(database_path)[0]}.failed.jsonl"
+
+def write_dead_letter(path: str,
+                      batch: dict[int, list[int]],
+                      names: dict[int, str],
+                      events: Iterable[PyramidEventRow] = (),
+                      merges: Iterable[ScoreMerge] = ()
+                      ) -> None:
+    "Append a batch that could not be written to a dead letter file, as one line of JSON."
+    line: str = json.dumps({"time" : time.time(),
+                            "scores" : [[user_id, names[user_id], *deltas] for user_id, deltas in batch.items()],
+                            "events" : list(events),
+                            "merges" : list(merges)})
+    with open(path, "a", encoding="utf-8") as dead_letters:
+        dead_letters.write(line + "\n")
+
+def replay_dead_letters(connection: sqlite3.Connection, path: str) -> int:
+    """
+    Write every batch in a dead letter file in a single transaction, then delete the file, and return the number of batches written.
+
+    Batches are written in the order they were given up on, so the latest name of each chatter is kept.
+    Raises an `OSError` if the file cannot be read, or a `ValueError`, `KeyError` or `TypeError` if it is not a dead letter file.
+    """
+    batch: dict[int, list[int]] = {}
+    names: dict[int, str] = {}
+    events: list[PyramidEventRow] = []
+    merges: list[ScoreMerge] = []
+    batches: int = 0
+    with open(path, encoding="utf-8") as dead_letters:
+        for line in dead_letters:
+            if not line.strip():
+                continue
+            dead_letter: dict[str, Any] = json.loads(line)
+            for user_id, chatter_name, *deltas in dead_letter["scores"]:
+                merge_deltas(batch.setdefault(int(user_id), [0, 0, 0, 0, 0]), [int(delta) for delta in deltas])
+                names[int(user_id)] = str(chatter_name)
+            events.extend((float(event_time), str(channel_name), int(user_id), str(chatter_name), str(result), int(size), str(stolen_from))
+                          for event_time, channel_name, user_id, chatter_name, result, size, stolen_from in dead_letter["events"])
+            merges.extend((int(from_id), int(into_id), str(chatter_name)) for from_id, into_id, chatter_name in dead_letter["merges"])
+            batches += 1
+    write_scores(connection, batch, names, events, merges)
+    os.remove(path)
+    return batches
+
+def merge_deltas(into: list[int], deltas: list[int]) -> list[int]:
+    "Merge a list of score deltas into another in place, and return it."
+    into[0] += deltas[0]
+    into[1] += deltas[1]
+    into[2] += deltas[2]
+    into[3] += deltas[3]
+    into[4] = max(into[4], deltas[4])
+    return into
+
+def add_result(deltas: list[int], result: str, stolen: bool = False, size: int = 0) -> list[int]:
+    "Add a pyramid result to a list of score deltas in place, and return it."
+    deltas[_RESULT_INDICES[result]] += 1
+    if stolen:
+        deltas[3] += 1
+    if size > deltas[4]:
+        deltas[4] = size
+    return deltas
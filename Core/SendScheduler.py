@@ -0,0 +1,358 @@
+import asyncio
+from collections import deque
+from enum import IntEnum
+import itertools
+import time
+from typing import Optional, Protocol
+
+from twitchio.ext import commands
+
+from Core.Metrics import REGISTRY, Histogram
+
+__all__ = ("Priority",
+           "TokenBucket",
+           "Transport",
+           "TwitchTransport",
+           "FakeTransport",
+           "SendScheduler")
+
+class Priority(IntEnum):
+    "The priority lanes of outbound messages, lower values are sent first."
+
+    ## Moderation messages, timeouts and bans are applied through `Core.Moderation` instead.
+    MODERATION = 0
+
+    ## Replies to chatters, such as command responses and pyramid announcements.
+    REPLY = 1
+
+    ## Messages nobody is waiting on, which may be merged or dropped under backpressure.
+    PASSIVE = 2
+
+class TokenBucket:
+    "A token bucket allowing bursts of up to `capacity` messages, refilled at `capacity` tokens per `period` seconds."
+
+    __slots__ = ("capacity",
+                 "rate",
+                 "tokens",
+                 "updated")
+
+    def __init__(self, capacity: int, period: float) -> None:
+        self.capacity: float = float(capacity)
+        self.rate: float = capacity / period
+        self.tokens: float = float(capacity)
+        self.updated: float = time.monotonic()
+
+    def refill(self, time_now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + ((time_now - self.updated) * self.rate))
+        self.updated = time_now
+
+    def wait_time(self, time_now: float) -> float:
+        "The time in seconds until a token is available."
+        self.refill(time_now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1.0
+
+class Transport(Protocol):
+    "Delivers messages to chat."
+
+    async def send(self, channel_name: str, message: str) -> None:
+        ...
+
+class TwitchTransport:
+    "Delivers messages to the channels a bot has joined."
+
+    __slots__ = ("__bot",)
+
+    def __init__(self, bot: commands.Bot) -> None:
+        self.__bot: commands.Bot = bot
+
+    async def send(self, channel_name: str, message: str) -> None:
+        channel = self.__bot.get_channel(channel_name)
+        if channel is None:
+            raise RuntimeError(f"Cannot send to channel \"{channel_name}\", it has not been joined.")
+        await channel.send(message)
+
+class FakeTransport:
+    "Records messages instead of sending them, for testing and benchmarking without a network."
+
+    __slots__ = ("sent",
+                 "record")
+
+    def __init__(self, record: bool = True) -> None:
+        ## The (send time, channel name, message) of each message sent, if recording.
+        self.sent: list[tuple[float, str, str]] = []
+        self.record: bool = record
+
+    async def send(self, channel_name: str, message: str) -> None:
+        if self.record:
+            self.sent.append((time.monotonic(), channel_name, message))
+
+class _ChannelQueue:
+    "The queued messages and rate limit of a single channel."
+
+    __slots__ = ("lanes",
+                 "bucket",
+                 "is_moderator")
+
+    def __init__(self, bucket: TokenBucket, is_moderator: bool) -> None:
+        ## One lane per priority, each holding (sequence number, message, submission time) tuples.
+        self.lanes: tuple[deque[tuple[int, str, float]], ...] = tuple(deque() for _ in Priority)
+        self.bucket: TokenBucket = bucket
+        self.is_moderator: bool = is_moderator
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes)
+
+    def head(self) -> Optional[tuple[int, int]]:
+        "Get the (priority, sequence number) of the next message to send from this channel."
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                return (priority, lane[0][0])
+        return None
+
+class SendScheduler:
+    """
+    Central scheduler for outbound chat messages.
+
+    Every channel has its own token bucket, and all channels share global token buckets,
+    with Twitch's higher limits applied in channels where the bot is a moderator.
+    Messages are sent highest priority first, and in submission order within a priority.
+    When a channel's queue is full, passive messages identical to one already queued are
+    merged into it, and otherwise the oldest message of the lowest priority is dropped.
+    Moderation messages are never dropped.
+    A channel's queue is forgotten once it is empty and its bucket has refilled, so it holds no rate limit state.
+    """
+
+    __slots__ = ("__transport",
+                 "__max_queue_length",
+                 "__user_limit",
+                 "__moderator_limit",
+                 "__global_user_bucket",
+                 "__global_bucket",
+                 "__channels",
+                 "__moderator_channels",
+                 "__ready",
+                 "__idle",
+                 "__sequence",
+                 "__wake",
+                 "__task",
+                 "__closing",
+                 "__sent",
+                 "__dropped",
+                 "__merged",
+                 "__send_latency")
+
+    def __init__(self,
+                 transport: Transport,
+                 max_queue_length: int = 20,
+                 user_limit: tuple[int, float] = (1, 1.1),
+                 moderator_limit: tuple[int, float] = (100, 30.0),
+                 global_user_limit: tuple[int, float] = (20, 30.0),
+                 global_moderator_limit: tuple[int, float] = (100, 30.0)
+                 ) -> None:
+        """
+        Create a send scheduler.
+
+        Limits are given as (messages, period in seconds) pairs.
+
+        Parameters
+        ----------
+        `transport: Transport` - The transport messages are delivered with.
+
+        `max_queue_length: int = 20` - The number of messages a channel may have queued before messages are merged or dropped.
+
+        `user_limit: tuple[int, float] = (1, 1.1)` - The per-channel limit in channels where the bot is not a moderator.
+
+        `moderator_limit: tuple[int, float] = (100, 30.0)` - The per-channel limit in channels where the bot is a moderator.
+
+        `global_user_limit: tuple[int, float] = (20, 30.0)` - The limit across all channels where the bot is not a moderator.
+
+        `global_moderator_limit: tuple[int, float] = (100, 30.0)` - The limit across all channels.
+        """
+        self.__transport: Transport = transport
+        self.__max_queue_length: int = max_queue_length
+        self.__user_limit: tuple[int, float] = user_limit
+        self.__moderator_limit: tuple[int, float] = moderator_limit
+        self.__global_user_bucket: TokenBucket = TokenBucket(*global_user_limit)
+        self.__global_bucket: TokenBucket = TokenBucket(*global_moderator_limit)
+
+        self.__channels: dict[str, _ChannelQueue] = {}
+        self.__moderator_channels: set[str] = set()
+        self.__ready: set[str] = set()
+        ## Channels whose queues have been emptied, and are forgotten once their buckets are full.
+        self.__idle: set[str] = set()
+        self.__sequence: itertools.count = itertools.count()
+        self.__wake: Optional[asyncio.Event] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__closing: bool = False
+
+        self.__sent: int = 0
+        self.__dropped: int = 0
+        self.__merged: int = 0
+
+        ## Metrics read the counts above when scraped, so sending only pays for the latency histograms.
+        REGISTRY.counter("olliebot_messages_sent_total", "Outbound chat messages sent.", function=lambda: self.__sent)
+        REGISTRY.counter("olliebot_messages_dropped_total", "Outbound chat messages dropped under backpressure.", function=lambda: self.__dropped)
+        REGISTRY.counter("olliebot_messages_merged_total", "Outbound chat messages merged into an identical queued message.", function=lambda: self.__merged)
+        REGISTRY.gauge("olliebot_send_queue_depth", "Outbound chat messages queued across all channels.", function=lambda: self.depth)
+        self.__send_latency: tuple[Histogram, ...] = tuple(REGISTRY.histogram("olliebot_send_latency_seconds",
+                                                                              "Time from submitting an outbound message to it being sent, by priority.",
+                                                                              {"priority" : priority.name.lower()})
+                                                           for priority in Priority)
+
+    @property
+    def sent(self) -> int:
+        "The number of messages sent."
+        return self.__sent
+
+    @property
+    def dropped(self) -> int:
+        "The number of messages dropped under backpressure."
+        return self.__dropped
+
+    @property
+    def merged(self) -> int:
+        "The number of messages merged into an identical queued message under backpressure."
+        return self.__merged
+
+    @property
+    def depth(self) -> int:
+        "The number of messages currently queued across all channels."
+        return sum(len(self.__channels[channel_name]) for channel_name in self.__ready)
+
+    def set_moderator(self, channel_name: str, is_moderator: bool) -> None:
+        "Set whether the bot is a moderator in the given channel, which determines the limits applied to it."
+        channel_name = channel_name.lower()
+        if is_moderator:
+            self.__moderator_channels.add(channel_name)
+        else: self.__moderator_channels.discard(channel_name)
+        queue: Optional[_ChannelQueue] = self.__channels.get(channel_name)
+        if queue is not None and queue.is_moderator != is_moderator:
+            queue.bucket = TokenBucket(*(self.__moderator_limit if is_moderator else self.__user_limit))
+            queue.is_moderator = is_moderator
+
+    def submit(self, channel_name: str, message: str, priority: Priority = Priority.REPLY) -> bool:
+        """
+        Queue a message to be sent to the given channel.
+
+        Returns False if the message was merged or dropped instead of being queued.
+        """
+        channel_name = channel_name.lower()
+        queue: Optional[_ChannelQueue] = self.__channels.get(channel_name)
+        if queue is None:
+            is_moderator: bool = channel_name in self.__moderator_channels
+            queue = self.__channels[channel_name] = _ChannelQueue(TokenBucket(*(self.__moderator_limit if is_moderator else self.__user_limit)),
+                                                                  is_moderator)
+
+        if len(queue) >= self.__max_queue_length and priority != Priority.MODERATION:
+            if priority == Priority.PASSIVE and any(queued == message for _, queued, _ in queue.lanes[priority]):
+                self.__merged += 1
+                return False
+            lowest: int = max(lane_priority for lane_priority, lane in enumerate(queue.lanes) if lane)
+            if lowest < priority:
+                self.__dropped += 1
+                return False
+            queue.lanes[lowest].popleft()
+            self.__dropped += 1
+
+        queue.lanes[priority].append((next(self.__sequence), message, time.perf_counter()))
+        self.__ready.add(channel_name)
+        self.__start()
+        return True
+
+    async def close(self, timeout: float = 5.0) -> None:
+        "Wait up to the given timeout for queued messages to be sent, then stop the scheduler."
+        if self.__task is None:
+            return
+        deadline: float = time.monotonic() + timeout
+        while self.__ready and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.__closing = True
+        self.__wake.set()
+        await self.__task
+        self.__task = None
+        self.__closing = False
+
+    ##################################################
+    #### Dispatching
+
+    def __start(self) -> None:
+        if self.__task is None or self.__task.done():
+            self.__wake = asyncio.Event()
+            self.__task = asyncio.get_running_loop().create_task(self.__dispatch())
+        else: self.__wake.set()
+
+    def __forget_idle(self, time_now: float) -> float:
+        "Forget the queues of idle channels whose buckets are full, and return the time in seconds until the next one is full."
+        next_full: float = float("inf")
+        for channel_name in tuple(self.__idle):
+            if channel_name in self.__ready:
+                self.__idle.discard(channel_name)
+                continue
+            bucket: TokenBucket = self.__channels[channel_name].bucket
+            bucket.refill(time_now)
+            if bucket.tokens >= bucket.capacity:
+                del self.__channels[channel_name]
+                self.__idle.discard(channel_name)
+            else: next_full = min(next_full, (bucket.capacity - bucket.tokens) / bucket.rate)
+        return next_full
+
+    async def __dispatch(self) -> None:
+        while not self.__closing:
+            if not self.__ready:
+                next_full: float = self.__forget_idle(time.monotonic())
+                self.__wake.clear()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), None if next_full == float("inf") else next_full)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            ## Find the highest priority, oldest message whose rate limits allow it to be sent now,
+            ## or otherwise the shortest time until a queued message can be sent.
+            time_now: float = time.monotonic()
+            global_wait: float = self.__global_bucket.wait_time(time_now)
+            global_user_wait: float = self.__global_user_bucket.wait_time(time_now)
+            best: Optional[tuple[int, int]] = None
+            best_channel: Optional[str] = None
+            shortest_wait: float = float("inf")
+            for channel_name in self.__ready:
+                queue: _ChannelQueue = self.__channels[channel_name]
+                wait: float = max(queue.bucket.wait_time(time_now), global_wait,
+                                  0.0 if queue.is_moderator else global_user_wait)
+                if wait > 0.0:
+                    shortest_wait = min(shortest_wait, wait)
+                    continue
+                head: Optional[tuple[int, int]] = queue.head()
+                if head is not None and (best is None or head < best):
+                    best, best_channel = head, channel_name
+
+            if best_channel is None:
+                self.__forget_idle(time_now)
+                self.__wake.clear()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), shortest_wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            queue = self.__channels[best_channel]
+            _, message, submitted = queue.lanes[best[0]].popleft()
+            if not len(queue):
+                self.__ready.discard(best_channel)
+                self.__idle.add(best_channel)
+            queue.bucket.take()
+            self.__global_bucket.take()
+            if not queue.is_moderator:
+                self.__global_user_bucket.take()
+
+            try:
+                await self.__transport.send(best_channel, message)
+                self.__sent += 1
+                self.__send_latency[best[0]].observe(time.perf_counter() - submitted)
+            except Exception as error:
+                print(f"Failed to send message to {best_channel}: {error}")
@@ -0,0 +1,306 @@
+from array import array
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Callable, NamedTuple, Optional
+import zlib
+
+from Core.Metrics import REGISTRY, Counter, Gauge, Histogram
+
+__all__ = ("WARM_STATE_PATH",
+           "SavedPyramid",
+           "WarmState",
+           "write_snapshot",
+           "read_snapshot",
+           "Snapshotter")
+
+WARM_STATE_PATH: str = "SQL/warm_state.bin"
+
+## The file starts with a header, followed by sections each holding one kind of state, all little-endian.
+## Header: magic, format version, number of sections, epoch time the snapshot was taken.
+## Section: tag, number of entries, length in bytes of the entries, CRC-32 of the entries.
+_MAGIC: bytes = b"OLLS"
+_VERSION: int = 1
+_HEADER: struct.Struct = struct.Struct("<4sHHd")
+_SECTION: struct.Struct = struct.Struct("<4sIII")
+
+## Strings are UTF-8 prefixed by their length in bytes.
+_STRING_LENGTH: struct.Struct = struct.Struct("<H")
+
+## Pyramid entries are the channel, last sender and emote strings, then the progress, maximum height and epoch time last active.
+_PYRAMIDS: bytes = b"PYRS"
+_PYRAMID: struct.Struct = struct.Struct("<HHd")
+
+## Stream status entries are the channel string, then whether it was live.
+_STREAMS: bytes = b"LIVE"
+_ONLINE: struct.Struct = struct.Struct("<?")
+
+## Chatter entries are every user id as a signed 64-bit integer, then every name joined by newlines, least recently seen first.
+_CHATTERS: bytes = b"CHAT"
+
+_WRITES: Counter = REGISTRY.counter("olliebot_snapshot_writes_total", "Warm state snapshots written.")
+_WRITE_SECONDS: Histogram = REGISTRY.histogram("olliebot_snapshot_write_seconds", "Time taken to encode and write a warm state snapshot.")
+_SNAPSHOT_BYTES: Gauge = REGISTRY.gauge("olliebot_snapshot_bytes", "Size of the most recent warm state snapshot written.")
+_RESTORE_SECONDS: Gauge = REGISTRY.gauge("olliebot_snapshot_restore_seconds", "Time taken to read the warm state snapshot on start.")
+
+class SavedPyramid(NamedTuple):
+    "The progress of a channel's pyramid attempt, as saved in a snapshot."
+    last_sender_name: str
+    pyramid_emote: str
+    pyramid_progress: int
+    pyramid_max_height: int
+    ## The epoch time the channel last had a message, rather than a monotonic time, which does not survive a restart.
+    last_active: float
+
+class WarmState:
+    "The in-memory state of a bot saved in a snapshot, which would otherwise take a restart to rebuild."
+
+    __slots__ = ("created",
+                 "pyramids",
+                 "online",
+                 "chatters")
+
+    def __init__(self,
+                 created: float,
+                 pyramids: dict[str, SavedPyramid],
+                 online: dict[str, bool],
+                 chatters: list[tuple[str, int]]
+                 ) -> None:
+        ## The epoch time the snapshot was taken.
+        self.created: float = created
+        ## The pyramid attempts in progress, by channel name.
+        self.pyramids: dict[str, SavedPyramid] = pyramids
+        ## Whether each channel was live, by channel name.
+        self.online: dict[str, bool] = online
+        ## The names and user ids of cached chatters, least recently seen first.
+        self.chatters: list[tuple[str, int]] = chatters
+
+##################################################
+#### Writing
+
+def _pack_string(parts: list[bytes], string: str) -> None:
+    ## A character is at most four bytes, so the string is cut short rather than its encoding, which could split a character.
+    encoded: bytes = string[:0x3FFF].encode()
+    parts.append(_STRING_LENGTH.pack(len(encoded)))
+    parts.append(encoded)
+
+def _pack_section(parts: list[bytes], tag: bytes, count: int, entries: bytes) -> None:
+    parts.append(_SECTION.pack(tag, count, len(entries), zlib.crc32(entries)))
+    parts.append(entries)
+
+def write_snapshot(path: str, state: WarmState) -> int:
+    """
+    Write a warm state snapshot, replacing the file whole so a crash never leaves it half written, and return its size in bytes.
+
+    Raises an `OSError` if the file cannot be written.
+    """
+    start: float = time.perf_counter()
+    entries: list[bytes] = []
+    for channel_name, pyramid in state.pyramids.items():
+        _pack_string(entries, channel_name)
+        _pack_string(entries, pyramid.last_sender_name)
+        _pack_string(entries, pyramid.pyramid_emote)
+        entries.append(_PYRAMID.pack(min(pyramid.pyramid_progress, 0xFFFF), min(pyramid.pyramid_max_height, 0xFFFF), pyramid.last_active))
+    parts: list[bytes] = [_HEADER.pack(_MAGIC, _VERSION, 3, state.created)]
+    _pack_section(parts, _PYRAMIDS, len(state.pyramids), b"".join(entries))
+
+    entries = []
+    for channel_name, is_online in state.online.items():
+        _pack_string(entries, channel_name)
+        entries.append(_ONLINE.pack(is_online))
+    _pack_section(parts, _STREAMS, len(state.online), b"".join(entries))
+
+    user_ids: array = array("q", (user_id for _, user_id in state.chatters))
+    if sys.byteorder == "big":
+        user_ids.byteswap()
+    _pack_section(parts, _CHATTERS, len(state.chatters),
+                  user_ids.tobytes() + "\n".join(chatter_name for chatter_name, _ in state.chatters).encode())
+
+    temporary_path: str = f"{path}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        size: int = snapshot_file.write(b"".join(parts))
+    os.replace(temporary_path, path)
+    _WRITES.inc()
+    _WRITE_SECONDS.observe(time.perf_counter() - start)
+    _SNAPSHOT_BYTES.set(size)
+    return size
+
+##################################################
+#### Reading
+
+def _unpack_string(buffer: mmap.mmap, offset: int) -> tuple[str, int]:
+    (length,) = _STRING_LENGTH.unpack_from(buffer, offset)
+    offset += _STRING_LENGTH.size
+    return (buffer[offset:offset + length].decode(), offset + length)
+
+def _decode(buffer: mmap.mmap,
+            time_now: float,
+            max_pyramid_age: float,
+            max_status_age: float,
+            max_chatter_age: float
+            ) -> Optional[WarmState]:
+    "Decode a mapped snapshot, or return None if it is not a snapshot of this version, or is corrupt."
+    magic, version, section_count, created = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC or version != _VERSION:
+        return None
+    age: float = max(0.0, time_now - created)
+    state: WarmState = WarmState(created, {}, {}, [])
+    offset: int = _HEADER.size
+    for _ in range(section_count):
+        tag, count, length, checksum = _SECTION.unpack_from(buffer, offset)
+        start: int = offset + _SECTION.size
+        offset = start + length
+        if offset > len(buffer):
+            return None
+        ## Stale sections are skipped without being read, so their pages are never loaded from disk.
+        if ((tag == _PYRAMIDS and age > max_pyramid_age)
+            or (tag == _STREAMS and age > max_status_age)
+            or (tag == _CHATTERS and age > max_chatter_age)
+            or tag not in (_PYRAMIDS, _STREAMS, _CHATTERS)):
+            continue
+        if zlib.crc32(buffer[start:offset]) != checksum:
+            return None
+
+        position: int = start
+        if tag == _PYRAMIDS:
+            for _ in range(count):
+                channel_name, position = _unpack_string(buffer, position)
+                last_sender_name, position = _unpack_string(buffer, position)
+                pyramid_emote, position = _unpack_string(buffer, position)
+                progress, max_height, last_active = _PYRAMID.unpack_from(buffer, position)
+                position += _PYRAMID.size
+                ## Each attempt is only as fresh as the channel's last message.
+                if time_now - last_active <= max_pyramid_age:
+                    state.pyramids[channel_name] = SavedPyramid(last_sender_name, pyramid_emote, progress, max_height, last_active)
+
+        elif tag == _STREAMS:
+            for _ in range(count):
+                channel_name, position = _unpack_string(buffer, position)
+                (state.online[channel_name],) = _ONLINE.unpack_from(buffer, position)
+                position += _ONLINE.size
+
+        elif count:
+            user_ids: array = array("q")
+            user_ids.frombytes(buffer[start:start + (count * user_ids.itemsize)])
+            if sys.byteorder == "big":
+                user_ids.byteswap()
+            chatter_names: list[str] = buffer[start + (count * user_ids.itemsize):offset].decode().split("\n")
+            if len(chatter_names) != count:
+                return None
+            state.chatters = list(zip(chatter_names, user_ids.tolist()))
+    return state
+
+def read_snapshot(path: str,
+                  max_pyramid_age: float = 300.0,
+                  max_status_age: float = 600.0,
+                  max_chatter_age: float = 604800.0
+                  ) -> Optional[WarmState]:
+    """
+    Read a warm state snapshot through a memory map, leaving out any state too old to still be true.
+
+    Returns None if there is no snapshot, or it cannot be read, is corrupt or is from another version of the format.
+
+    Parameters
+    ----------
+    `max_pyramid_age: float = 300.0` - The most seconds since a channel's last message its pyramid attempt is restored after.
+
+    `max_status_age: float = 600.0` - The most seconds since the snapshot was taken that stream statuses are restored after.
+
+    `max_chatter_age: float = 604800.0` - The most seconds since the snapshot was taken that chatter ids are restored after.
+    """
+    start: float = time.perf_counter()
+    try:
+        with open(path, "rb") as snapshot_file:
+            ## An empty file cannot be mapped.
+            if os.fstat(snapshot_file.fileno()).st_size < _HEADER.size:
+                state: Optional[WarmState] = None
+            else:
+                with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    state = _decode(buffer, time.time(), max_pyramid_age, max_status_age, max_chatter_age)
+    except FileNotFoundError:
+        return None
+    except OSError as error:
+        print(f"Failed to read the warm state snapshot: {error}")
+        return None
+    except (struct.error, UnicodeDecodeError):
+        state = None
+    if state is None:
+        print(f"Ignoring the warm state snapshot {path}, it is corrupt or from another version")
+    _RESTORE_SECONDS.set(time.perf_counter() - start)
+    return state
+
+##################################################
+#### Snapshotting
+
+class Snapshotter:
+    """
+    Writes snapshots of a bot's warm state every interval, and once more when closed.
+
+    The state is collected in the event loop, so it is consistent, and then encoded and written in a thread.
+    A write is never abandoned part way, closing waits for any write in progress before writing the final snapshot.
+    """
+
+    __slots__ = ("__path",
+                 "__collect",
+                 "__interval",
+                 "__task",
+                 "__writing")
+
+    def __init__(self, path: str, collect: Callable[[], WarmState], interval: float = 60.0) -> None:
+        """
+        Create a snapshotter.
+
+        Parameters
+        ----------
+        `path: str` - The file snapshots are written to.
+
+        `collect: Callable[[], WarmState]` - Called in the event loop to collect the state to write.
+
+        `interval: float = 60.0` - The time in seconds between snapshots.
+        """
+        self.__path: str = path
+        self.__collect: Callable[[], WarmState] = collect
+        self.__interval: float = interval
+        self.__task: Optional[asyncio.Task] = None
+        self.__writing: Optional[asyncio.Future] = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    async def start(self) -> None:
+        "Start writing snapshots every interval."
+        if self.__task is None:
+            self.__task = asyncio.get_running_loop().create_task(self.__snapshot_periodically())
+
+    async def close(self) -> None:
+        "Stop writing snapshots every interval, and write a final snapshot."
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+        await self.save()
+
+    async def save(self) -> int:
+        "Write a snapshot of the current state, and return its size in bytes, or zero if it could not be written."
+        if self.__writing is not None and not self.__writing.done():
+            await asyncio.wait([self.__writing])
+        state: WarmState = self.__collect()
+        self.__writing = asyncio.ensure_future(asyncio.to_thread(self.__write, state))
+        ## The write finishes even if the caller is cancelled, and the next save waits for it.
+        return await asyncio.shield(self.__writing)
+
+    def __write(self, state: WarmState) -> int:
+        try:
+            return write_snapshot(self.__path, state)
+        except OSError as error:
+            print(f"Failed to write the warm state snapshot: {error}")
+            return 0
+
+    async def __snapshot_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.__interval)
+            await self.save()
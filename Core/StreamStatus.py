@@ -0,0 +1,301 @@
+import asyncio
+import json
+import time
+from typing import Any, Iterable, Mapping, Optional
+import aiohttp
+
+from Core.Helix import HelixClient, HelixError
+from Core.Metrics import REGISTRY, Counter
+
+__all__ = ("EVENTSUB_URL",
+           "StreamStatus")
+
+EVENTSUB_URL: str = "wss://eventsub.wss.twitch.tv/ws"
+
+## The stream events subscribed to for each channel.
+_STREAM_EVENTS: tuple[str, ...] = ("stream.online", "stream.offline")
+
+_NOTIFICATIONS: Counter = REGISTRY.counter("olliebot_stream_notifications_total", "Stream online and offline notifications received over EventSub.")
+_POLLS: Counter = REGISTRY.counter("olliebot_stream_polls_total", "Bulk stream status polls made.")
+_POLL_ERRORS: Counter = REGISTRY.counter("olliebot_stream_poll_errors_total", "Bulk stream status polls that failed.")
+_EVENTSUB_CONNECTIONS: Counter = REGISTRY.counter("olliebot_eventsub_connections_total", "EventSub websocket sessions started.")
+
+class StreamStatus:
+    """
+    Tracks whether the bot's channels are live, so handlers can check from memory without any I/O.
+
+    Status changes are pushed by EventSub `stream.online` and `stream.offline` notifications over a websocket.
+    Every tracked channel is also polled in bulk through Helix `/streams`, on start, whenever channels
+    are tracked, whenever an EventSub session starts, and then every poll interval as a fallback for
+    channels without subscriptions and for notifications missed while the websocket was disconnected.
+    A poll that fails leaves every channel's last known status in place.
+    A poll never overwrites a notification received after the poll was sent.
+    """
+
+    __slots__ = ("__helix",
+                 "__token",
+                 "__eventsub_url",
+                 "__poll_interval",
+                 "__max_subscriptions",
+                 "__channels",
+                 "__online",
+                 "__notified",
+                 "__user_ids",
+                 "__subscriptions",
+                 "__session_id",
+                 "__tasks",
+                 "__background")
+
+    def __init__(self,
+                 helix: HelixClient,
+                 token: Optional[str] = None,
+                 eventsub_url: str = EVENTSUB_URL,
+                 poll_interval: float = 60.0,
+                 max_subscriptions: int = 300
+                 ) -> None:
+        """
+        Create a stream status tracker.
+
+        Parameters
+        ----------
+        `helix: HelixClient` - The client streams are polled and subscriptions are created through.
+
+        `token: Optional[str] = None` - The user access token subscriptions are created with,
+        EventSub websockets only accept subscriptions made with a user token. If not given, the client's token is used.
+
+        `eventsub_url: str = EVENTSUB_URL` - The EventSub websocket, which can be pointed at a local stand-in.
+
+        `poll_interval: float = 60.0` - The time in seconds between bulk polls of every tracked channel.
+
+        `max_subscriptions: int = 300` - The most subscriptions a single websocket session may hold,
+        channels beyond this are tracked by polling alone.
+        """
+        self.__helix: HelixClient = helix
+        self.__token: Optional[str] = token
+        self.__eventsub_url: str = eventsub_url
+        self.__poll_interval: float = poll_interval
+        self.__max_subscriptions: int = max_subscriptions
+
+        self.__channels: set[str] = set()
+        self.__online: dict[str, bool] = {}
+        ## Maps channel names to the monotonic time of their most recent notification.
+        self.__notified: dict[str, float] = {}
+
+        ## Broadcaster user ids, and the ids of the subscriptions of each channel in the current session.
+        self.__user_ids: dict[str, str] = {}
+        self.__subscriptions: dict[str, list[str]] = {}
+        self.__session_id: Optional[str] = None
+
+        self.__tasks: list[asyncio.Task] = []
+        ## Polls and subscription requests made in the background, referenced until they finish.
+        self.__background: set[asyncio.Task] = set()
+        REGISTRY.gauge("olliebot_streams_online", "Tracked channels that are live.", function=lambda: sum(self.__online.values()))
+
+    def is_online(self, channel_name: str) -> bool:
+        "Check whether a channel is live, channels whose status is not yet known are not."
+        return self.__online.get(channel_name, False)
+
+    def statuses(self) -> dict[str, bool]:
+        "Get whether each tracked channel whose status is known is live."
+        return dict(self.__online)
+
+    def restore(self, online: Mapping[str, bool]) -> None:
+        """
+        Restore the statuses of tracked channels whose status is not yet known, such as from a snapshot of the bot's last run.
+
+        A restored status is only a stand-in until the first poll or notification replaces it.
+        """
+        for channel_name, is_online in online.items():
+            if channel_name in self.__channels and channel_name not in self.__online:
+                self.__online[channel_name] = is_online
+
+    @property
+    def channels(self) -> frozenset[str]:
+        "The channels being tracked."
+        return frozenset(self.__channels)
+
+    @property
+    def subscribed(self) -> int:
+        "The number of channels with EventSub subscriptions in the current session."
+        return len(self.__subscriptions)
+
+    def track(self, channel_names: Iterable[str]) -> None:
+        "Start tracking channels, their status is polled and they are subscribed to in the background once started."
+        new: list[str] = [channel_name.lower() for channel_name in channel_names
+                          if channel_name.lower() not in self.__channels]
+        if not new:
+            return
+        self.__channels.update(new)
+        if self.__tasks:
+            self.__run_in_background(self.refresh(new))
+            if self.__session_id is not None:
+                self.__run_in_background(self.__subscribe(new, self.__session_id))
+
+    def untrack(self, channel_names: Iterable[str]) -> None:
+        "Stop tracking channels, and delete their subscriptions in the background."
+        subscription_ids: list[str] = []
+        for channel_name in channel_names:
+            channel_name = channel_name.lower()
+            self.__channels.discard(channel_name)
+            self.__online.pop(channel_name, None)
+            self.__notified.pop(channel_name, None)
+            subscription_ids.extend(self.__subscriptions.pop(channel_name, ()))
+        if subscription_ids and self.__tasks:
+            self.__run_in_background(self.__unsubscribe(subscription_ids))
+
+    async def start(self) -> None:
+        "Start polling and listening for notifications."
+        if self.__tasks:
+            return
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self.__tasks = [loop.create_task(self.__poll()),
+                        loop.create_task(self.__listen())]
+
+    async def close(self) -> None:
+        for task in [*self.__tasks, *self.__background]:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, *self.__background, return_exceptions=True)
+        self.__tasks = []
+        self.__session_id = None
+
+    async def refresh(self, channel_names: Optional[Iterable[str]] = None) -> None:
+        "Poll the status of the given channels, or of every tracked channel, in bulk."
+        logins: list[str] = list(channel_names) if channel_names is not None else list(self.__channels)
+        if not logins:
+            return
+        sent: float = time.monotonic()
+        _POLLS.inc()
+        try:
+            online: dict[str, bool] = await self.__helix.get_streams(logins)
+        except HelixError as error:
+            _POLL_ERRORS.inc()
+            print(f"Failed to poll stream status: {error}")
+            return
+        for channel_name, is_online in online.items():
+            if (channel_name in self.__channels
+                and self.__notified.get(channel_name, 0.0) <= sent):
+                self.__online[channel_name] = is_online
+
+    def __run_in_background(self, coroutine: Any) -> None:
+        task: asyncio.Task = asyncio.get_running_loop().create_task(coroutine)
+        self.__background.add(task)
+        task.add_done_callback(self.__background.discard)
+
+    ##################################################
+    #### Polling
+
+    async def __poll(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.__poll_interval)
+
+    ##################################################
+    #### EventSub
+
+    async def __listen(self) -> None:
+        "Keep an EventSub session open, reconnecting with a backoff whenever it is lost."
+        url: str = self.__eventsub_url
+        delay: float = 1.0
+        while True:
+            reconnect_url: Optional[str] = None
+            try:
+                async with self.__helix.session.ws_connect(url, autoping=True) as websocket:
+                    reconnect_url = await self.__read(websocket, resumed=url != self.__eventsub_url)
+                    delay = 1.0
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as error:
+                print(f"EventSub connection failed: {error or type(error).__name__}")
+            if reconnect_url is not None:
+                ## The subscriptions of the session move to the new connection.
+                url = reconnect_url
+                continue
+            ## A new session has none of the previous session's subscriptions.
+            self.__session_id = None
+            self.__subscriptions.clear()
+            url = self.__eventsub_url
+            await asyncio.sleep(delay)
+            delay = min(delay * 2.0, 60.0)
+
+    async def __read(self, websocket: aiohttp.ClientWebSocketResponse, resumed: bool) -> Optional[str]:
+        """
+        Read the messages of an EventSub session until it ends.
+
+        Returns the url to reconnect to if Twitch asked for the session to move, otherwise None.
+        """
+        ## Twitch sends a message at least every keepalive timeout, the welcome message arrives immediately.
+        keepalive: float = 10.0
+        while True:
+            message: aiohttp.WSMessage = await websocket.receive(timeout=keepalive + 5.0)
+            if message.type != aiohttp.WSMsgType.TEXT:
+                return None
+            data: dict[str, Any] = json.loads(message.data)
+            message_type: str = data["metadata"]["message_type"]
+            payload: dict[str, Any] = data["payload"]
+
+            if message_type == "session_welcome":
+                _EVENTSUB_CONNECTIONS.inc()
+                keepalive = float(payload["session"].get("keepalive_timeout_seconds") or keepalive)
+                self.__session_id = payload["session"]["id"]
+                if not resumed:
+                    self.__run_in_background(self.__subscribe(list(self.__channels), self.__session_id))
+                ## Catch up on any changes missed while there was no session.
+                self.__run_in_background(self.refresh())
+
+            elif message_type == "notification":
+                _NOTIFICATIONS.inc()
+                channel_name: str = payload["event"]["broadcaster_user_login"].lower()
+                if channel_name in self.__channels:
+                    self.__online[channel_name] = payload["subscription"]["type"] == "stream.online"
+                    self.__notified[channel_name] = time.monotonic()
+
+            elif message_type == "session_reconnect":
+                return payload["session"]["reconnect_url"]
+
+            elif message_type == "revocation":
+                ## The channel is tracked by polling alone from now on.
+                revoked_id: Optional[str] = payload["subscription"]["condition"].get("broadcaster_user_id")
+                for login, user_id in self.__user_ids.items():
+                    if user_id == revoked_id:
+                        self.__subscriptions.pop(login, None)
+
+    async def __subscribe(self, channel_names: list[str], session_id: str) -> None:
+        "Subscribe to the stream events of channels that are not yet subscribed to, up to the subscription limit."
+        pending: list[str] = [channel_name for channel_name in channel_names
+                              if channel_name not in self.__subscriptions]
+        capacity: int = (self.__max_subscriptions // len(_STREAM_EVENTS)) - len(self.__subscriptions)
+        if not pending or capacity <= 0:
+            return
+        pending = pending[:capacity]
+        try:
+            if missing := [channel_name for channel_name in pending if channel_name not in self.__user_ids]:
+                self.__user_ids.update(await self.__helix.get_user_ids(missing))
+        except HelixError as error:
+            print(f"Failed to look up channels to subscribe to: {error}")
+            return
+
+        for channel_name in pending:
+            user_id: Optional[str] = self.__user_ids.get(channel_name)
+            if user_id is None or channel_name not in self.__channels:
+                continue
+            subscription_ids: list[str] = []
+            try:
+                for event_type in _STREAM_EVENTS:
+                    response: dict[str, Any] = await self.__helix.request("POST", "eventsub/subscriptions",
+                                                                          json={"type" : event_type,
+                                                                                "version" : "1",
+                                                                                "condition" : {"broadcaster_user_id" : user_id},
+                                                                                "transport" : {"method" : "websocket",
+                                                                                               "session_id" : session_id}},
+                                                                          token=self.__token)
+                    subscription_ids.append(response["data"][0]["id"])
+            except HelixError as error:
+                print(f"Failed to subscribe to the stream events of {channel_name}: {error}")
+            ## Subscriptions belong to the session they were made in.
+            if subscription_ids and self.__session_id == session_id:
+                self.__subscriptions[channel_name] = subscription_ids
+
+    async def __unsubscribe(self, subscription_ids: list[str]) -> None:
+        for subscription_id in subscription_ids:
+            try:
+                await self.__helix.request("DELETE", "eventsub/subscriptions", [("id", subscription_id)], token=self.__token)
+            except HelixError as error:
+                print(f"Failed to delete subscription {subscription_id}: {error}")
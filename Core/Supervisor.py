@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+import os
+import signal
+import sqlite3
+import time
+from typing import Any, Callable, Iterable, Optional
+
+from Core.Emotes import EMOTE_CACHE_PATH
+from Core.ScoreWriter import ScoreWriterService, SharedScoreWriter, dead_letter_file
+from Core.Snapshot import WARM_STATE_PATH
+
+__all__ = ("load_channels",
+           "assign_channels",
+           "Supervisor")
+
+def load_channels(database_path: str = "SQL/twitch_channels.sqlite3") -> list[str]:
+    "Load the names of the enabled channels in the channel registry, or an empty list if there is no registry."
+    if not os.path.exists(database_path):
+        return []
+    connection: sqlite3.Connection = sqlite3.connect(database_path)
+    try:
+        return [channel_name.lower() for (channel_name,) in connection.execute("""
+                                                                                SELECT channel_name
+                                                                                FROM channels
+                                                                                WHERE enabled
+                                                                                """)]
+    except sqlite3.OperationalError as error:
+        print(f"Cannot read the channel registry: {error}")
+        return []
+    finally:
+        connection.close()
+
+def _weight(worker: int, channel_name: str) -> int:
+    "The rendezvous hashing weight of a channel for a worker, stable across processes and runs."
+    return int.from_bytes(hashlib.blake2b(f"{worker}:{channel_name}".encode(), digest_size=8).digest(), "big")
+
+def assign_channels(channel_names: Iterable[str], workers: Iterable[int]) -> dict[int, list[str]]:
+    """
+    Assign channels to workers by rendezvous hashing.
+
+    Each channel goes to the worker with the highest weight for it, so adding or removing a worker
+    only moves the channels that worker gains or loses, and every other channel stays where it is.
+    """
+    assignment: dict[int, list[str]] = {worker : [] for worker in workers}
+    if not assignment:
+        return assignment
+    for channel_name in channel_names:
+        assignment[max(assignment, key=lambda worker: _weight(worker, channel_name))].append(channel_name)
+    return assignment
+
+class _Worker:
+    "The process and control pipe of a worker slot."
+
+    __slots__ = ("slot",
+                 "process",
+                 "control",
+                 "channels",
+                 "restart_time")
+
+    def __init__(self, slot: int) -> None:
+        self.slot: int = slot
+        self.process: Optional[multiprocessing.Process] = None
+        ## The sending end of the pipe assignments are sent to the process on.
+        self.control: Optional[Connection] = None
+        self.channels: list[str] = []
+        ## The time after which a dead worker is restarted, or None if it is alive.
+        self.restart_time: Optional[float] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+class Supervisor:
+    """
+    Runs a bot across several worker processes, each with its own IRC connection and event loop.
+
+    Channels are loaded from the channel registry and split between the workers by rendezvous hashing.
+    All workers commit their pyramid scores through a single score writer service in the supervisor process.
+    Every worker has its own pipes, so that a worker dying can never leave a lock shared with other workers held.
+    When a worker dies its channels are moved to the remaining workers until it is restarted,
+    and when the registry changes only the channels that were added or removed are joined or parted.
+    If an `onboarding_port` bot option is given, the first worker onboards channels into the registry without joining them,
+    and they are assigned when the registry is next polled.
+    """
+
+    __slots__ = ("__bot_class",
+                 "__workers_count",
+                 "__token",
+                 "__client_id",
+                 "__registry_path",
+                 "__pyramids_database",
+                 "__poll_interval",
+                 "__restart_delay",
+                 "__bot_options",
+                 "__context",
+                 "__channels",
+                 "__workers",
+                 "__score_writer")
+
+    def __init__(self,
+                 bot_class: Callable[..., Any],
+                 workers: int,
+                 token: str,
+                 client_id: str,
+                 registry_path: str = "SQL/twitch_channels.sqlite3",
+                 pyramids_database: str = "SQL/pyramids.sqlite3",
+                 poll_interval: float = 60.0,
+                 restart_delay: float = 5.0,
+                 **bot_options: Any
+                 ) -> None:
+        """
+        Create a supervisor.
+
+        Parameters
+        ----------
+        `bot_class: Callable[..., Any]` - The bot class each worker runs, it must be importable by the worker processes.
+
+        `workers: int` - The number of worker processes.
+
+        `registry_path: str = "SQL/twitch_channels.sqlite3"` - The channel registry, re-read every poll interval.
+
+        `poll_interval: float = 60.0` - The time in seconds between checks of the channel registry.
+
+        `restart_delay: float = 5.0` - The time in seconds before a dead worker is restarted.
+
+        Any other keyword arguments are passed to the bot of every worker.
+        """
+        if workers < 1:
+            raise ValueError(f"A supervisor needs at least one worker, got {workers}.")
+        self.__bot_class: Callable[..., Any] = bot_class
+        self.__workers_count: int = workers
+        self.__token: str = token
+        self.__client_id: str = client_id
+        self.__registry_path: str = registry_path
+        self.__pyramids_database: str = pyramids_database
+        self.__poll_interval: float = poll_interval
+        self.__restart_delay: float = restart_delay
+        self.__bot_options: dict[str, Any] = bot_options
+
+        ## Workers are spawned rather than forked, so that they never inherit the supervisor's connections or threads.
+        self.__context = multiprocessing.get_context("spawn")
+        self.__channels: list[str] = []
+        self.__workers: list[_Worker] = [_Worker(slot) for slot in range(workers)]
+        self.__score_writer: Optional[ScoreWriterService] = None
+
+    def run(self) -> None:
+        "Run the workers until interrupted."
+        self.__channels = load_channels(self.__registry_path)
+        print(f"Supervising {self.__workers_count} workers for {len(self.__channels)} channels.")
+        self.__score_writer = ScoreWriterService(self.__pyramids_database)
+        assignment: dict[int, list[str]] = assign_channels(self.__channels, range(self.__workers_count))
+        for worker in self.__workers:
+            self.__start_worker(worker, assignment[worker.slot])
+
+        next_poll: float = time.monotonic() + self.__poll_interval
+        try:
+            while True:
+                restart_times: list[float] = [worker.restart_time for worker in self.__workers
+                                              if worker.restart_time is not None]
+                timeout: float = max(0.0, min([next_poll, *restart_times]) - time.monotonic())
+                wait([worker.process.sentinel for worker in self.__workers if worker.alive], timeout)
+                time_now: float = time.monotonic()
+                changed: bool = False
+
+                for worker in self.__workers:
+                    if worker.restart_time is None and not worker.alive:
+                        print(f"Worker {worker.slot} exited with code {worker.process.exitcode}, moving its channels.")
+                        worker.restart_time = time_now + self.__restart_delay
+                        worker.channels = []
+                        worker.control.close()
+                        changed = True
+                    elif worker.restart_time is not None and worker.restart_time <= time_now:
+                        print(f"Restarting worker {worker.slot}.")
+                        worker.restart_time = None
+                        self.__start_worker(worker, [])
+                        changed = True
+
+                if time_now >= next_poll:
+                    next_poll = time_now + self.__poll_interval
+                    channels: list[str] = load_channels(self.__registry_path)
+                    if channels != self.__channels:
+                        print(f"The channel registry changed, now {len(channels)} channels.")
+                        self.__channels = channels
+                        changed = True
+
+                if changed:
+                    self.__rebalance()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self, timeout: float = 30.0) -> None:
+        "Stop every worker, then stop the score writer once the workers have sent their last scores."
+        for worker in self.__workers:
+            if worker.alive:
+                worker.control.send(None)
+        for worker in self.__workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        if self.__score_writer is not None:
+            self.__score_writer.close()
+
+    def __rebalance(self) -> None:
+        "Reassign the channels between the live workers, and send each worker whose channels changed its new channels."
+        live: list[_Worker] = [worker for worker in self.__workers if worker.alive]
+        assignment: dict[int, list[str]] = assign_channels(self.__channels, (worker.slot for worker in live))
+        for worker in live:
+            if assignment[worker.slot] != worker.channels:
+                worker.channels = assignment[worker.slot]
+                worker.control.send(worker.channels)
+
+    def __start_worker(self, worker: _Worker, channels: list[str]) -> None:
+        ## Pipes are created for each process, so nothing sent to a previous process in the same slot reaches the new one.
+        control_receiver, worker.control = self.__context.Pipe(duplex=False)
+        score_connection, worker_score_connection = self.__context.Pipe()
+        self.__score_writer.add_connection(score_connection)
+        worker.channels = channels
+        worker.process = self.__context.Process(target=run_worker,
+                                                name=f"OllieBot-{worker.slot}",
+                                                args=(self.__bot_class, worker.slot, channels,
+                                                      self.__token, self.__client_id, self.__pyramids_database,
+                                                      control_receiver, worker_score_connection),
+                                                kwargs=self.__bot_options)
+        worker.process.start()
+        ## The worker's ends now belong to the worker process.
+        control_receiver.close()
+        worker_score_connection.close()
+
+def _worker_path(path: str, slot: int) -> str:
+    "The path of a worker's own copy of a file, beside the file a bot run alone uses, such as `emotes.0.json`."
+    root, extension = os.path.splitext(path)
+    return f"{root}.{slot}{extension}"
+
+def _ignore_interrupts() -> None:
+    "Leave handling interrupts to the supervisor, which stops the workers before the score writer."
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_worker(bot_class: Callable[..., Any],
+               slot: int,
+               channels: list[str],
+               token: str,
+               client_id: str,
+               pyramids_database: str,
+               control: Connection,
+               score_connection: Connection,
+               **bot_options: Any
+               ) -> None:
+    "Run a bot in a worker process, joining and parting channels as the supervisor assigns them."
+    _ignore_interrupts()
+    score_writer: SharedScoreWriter = SharedScoreWriter(score_connection, dead_letter_path=_worker_path(dead_letter_file(pyramids_database), slot))
+    if bot_options.get("metrics_port") is not None:
+        bot_options["metrics_port"] += slot
+    ## Only the first worker onboards channels and refreshes their owners' tokens, the others read the tokens from the registry.
+    if bot_options.get("onboarding_port") is not None:
+        if slot == 0:
+            bot_options["join_onboarded"] = False
+        else:
+            bot_options["onboarding_port"] = None
+            bot_options["load_channel_credentials"] = True
+    ## Each worker snapshots its own state and caches its own channels' emotes, which would otherwise overwrite every other worker's.
+    if (snapshot_path := bot_options.get("snapshot_path", WARM_STATE_PATH)) is not None:
+        bot_options["snapshot_path"] = _worker_path(snapshot_path, slot)
+    bot_options["emote_cache"] = _worker_path(bot_options.get("emote_cache", EMOTE_CACHE_PATH), slot)
+    bot = bot_class(token, client_id, channels,
+                    pyramids_database=pyramids_database,
+                    score_writer=score_writer,
+                    **bot_options)
+    bot.loop.create_task(_follow_assignments(bot, control, channels))
+    bot.run()
+
+async def _follow_assignments(bot: Any, control: Connection, channels: list[str]) -> None:
+    "Join and part channels as new assignments arrive from the supervisor, and close the bot when told to stop."
+    joined: set[str] = set(channels)
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    while True:
+        try:
+            assignment: Optional[list[str]] = await loop.run_in_executor(None, control.recv)
+        except EOFError:
+            ## The supervisor has exited.
+            assignment = None
+        if assignment is None:
+            await bot.close()
+            loop.stop()
+            return
+        assigned: set[str] = set(assignment)
+        if parted := joined - assigned:
+            await bot.part_channels(list(parted))
+        if new := assigned - joined:
+            await bot.join_channels(list(new))
+        joined = assigned
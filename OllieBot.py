@@ -1,15 +1,34 @@
-from datetime import datetime, timedelta
+import asyncio
 import os
 import random
 import re
 import sqlite3
-from typing import Union
-import requests
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Mapping, Optional, Union
 from twitchio.ext import commands # eventsub, pubsub
 import twitchio
-from Core.MessageFunctions import get_command_string, get_user
+from Core.ChannelConfig import ChannelConfigStore
+from Core.Chatters import ChatterCache
+from Core.CogLoader import CogLoader
+from Core.Emotes import EMOTE_CACHE_PATH, THIRD_PARTY_EMOTE_URLS, EmoteRegistry
+from Core.Helix import HELIX_URL, HelixClient
+from Core.IngestQueue import IngestQueue
+from Core.MessagePipeline import MessagePipeline
+from Core.Moderation import Moderation
+from Core.MessageFunctions import get_command_string, get_user, send_message
+from Core.Metrics import REGISTRY, Counter, Gauge, Histogram
+from Core.ScoreWriter import ScoreWriter, connect_writer
+from Core.SendScheduler import Priority, SendScheduler, Transport, TwitchTransport
+from Core.Snapshot import WARM_STATE_PATH, SavedPyramid, Snapshotter, WarmState, read_snapshot
+from Core.StreamStatus import EVENTSUB_URL, StreamStatus
 
-from Cogs.Pyramids import PyramidHandler
+## Optional services are imported where they are built, so a bot not using them never loads them.
+if TYPE_CHECKING:
+    from Core.ChannelJoiner import ChannelJoiner
+    from Core.Metrics import MetricsServer
+
+_STARTUP_SECONDS: Gauge = REGISTRY.gauge("olliebot_startup_seconds", "Seconds the bot took to construct, before connecting to chat.")
+_READY_SECONDS: Gauge = REGISTRY.gauge("olliebot_ready_seconds", "Seconds from the bot's construction until it had logged in and joined its initial channels.")
 
 class OllieBot(commands.Bot):
     """
@@ -19,7 +38,52 @@ class OllieBot(commands.Bot):
     def __init__(self,
                  token: str,
                  client_id: str,
-                 initial_channels: Union[str, list[str]]):
+                 initial_channels: Union[str, list[str]],
+                 helix_url: str = HELIX_URL,
+                 transport: Optional[Transport] = None,
+                 pyramids_database: str = "SQL/pyramids.sqlite3",
+                 metrics_port: Optional[int] = None,
+                 score_writer: Optional[ScoreWriter] = None,
+                 onboarding_port: Optional[int] = None,
+                 join_onboarded: bool = True,
+                 load_channel_credentials: bool = False,
+                 oauth_url: Optional[str] = None,
+                 channels_database: str = "SQL/twitch_channels.sqlite3",
+                 eventsub_url: str = EVENTSUB_URL,
+                 cog_manifest: str = "Cogs/manifest.json",
+                 ingest_max_commands: int = 50,
+                 ingest_max_passive: int = 200,
+                 ingest_coalesce: bool = True,
+                 emote_cache: str = EMOTE_CACHE_PATH,
+                 third_party_emote_urls: Mapping[str, str] = THIRD_PARTY_EMOTE_URLS,
+                 snapshot_path: Optional[str] = WARM_STATE_PATH,
+                 snapshot_interval: float = 60.0):
+        """
+        The Helix url, EventSub url, OAuth url, third-party emote urls, message transport and pyramids database can be replaced
+        to run the bot's handlers against local stand-ins, an OAuth url of None is Twitch's.
+        
+        A score writer can be given to commit pyramid scores through a writer shared with other bot processes.
+        
+        If a metrics port is given, metrics are served in the Prometheus text format at `http://127.0.0.1:<port>/metrics`.
+        
+        If an onboarding port is given, channel owners can add the bot to their channel by visiting `/authorize` on that port,
+        the client secret and the redirect uri registered for the client are read from the `CLIENT_SECRET` and `REDIRECT_URI`
+        environment variables. Onboarded channels are joined unless `join_onboarded` is False, which leaves them for a supervisor to assign.
+        If `load_channel_credentials` is set without an onboarding port, the owners' credentials are still read from the channel registry,
+        for workers of a supervisor whose channels are onboarded by another worker.
+        
+        Cogs are listed in the cog manifest, and each is only imported when first needed.
+        
+        Received messages are queued per channel and handled by a worker for each channel, commands before passive work.
+        The ingest limits give how many commands and passive messages a channel may have queued before more are shed,
+        and whether passive messages repeating the one queued before them are shed while the channel is backlogged,
+        which never sheds trigger phrases or messages starting with an emote.
+        
+        If a snapshot path is given, the pyramid attempts in progress, stream statuses and chatter ids are saved to it
+        every snapshot interval and on close, and restored from it on start, so a restart neither misses a pyramid nor has
+        to look every chatter up again. No snapshot is read or written if the path is None.
+        """
+        start: float = time.perf_counter()
         
         _initial_channels: list[str]
         if not isinstance(initial_channels, list):
@@ -33,15 +97,151 @@ class OllieBot(commands.Bot):
                          nick="DoggieKampo",
                          prefix='?')
         
-        self.__last_online_get_time: dict[str, datetime] = {}
-        self.__online: dict[str, bool] = {}
+        self.__helix: HelixClient = HelixClient(client_id, base_url=helix_url)
+        self.__send_scheduler: SendScheduler = SendScheduler(transport if transport is not None else TwitchTransport(self))
+        
+        ## The names and user ids of chatters, learnt from every message and looked up through Helix otherwise.
+        self.__chatters: ChatterCache = ChatterCache(self.__helix)
+        
+        ## Whether each joined channel is live, pushed by EventSub and read by handlers from memory.
+        self.__stream_status: StreamStatus = StreamStatus(self.__helix, token.removeprefix("oauth:"), eventsub_url)
+        self.__stream_status.track(_initial_channels)
+        
+        ## The emotes of each joined channel, loaded from the local cache and refreshed in the background.
+        self.__emotes: EmoteRegistry = EmoteRegistry(self.__helix, emote_cache, third_party_urls=third_party_emote_urls)
+        self.__emotes.track(_initial_channels)
+        
+        self.__channel_joiner: Optional[ChannelJoiner] = None
+        if onboarding_port is not None or load_channel_credentials:
+            from Core.ChannelJoiner import OAUTH_URL, ChannelJoiner, ChannelRegistry, OAuthClient
+            self.__channel_joiner = ChannelJoiner(self,
+                                                  ChannelRegistry(channels_database),
+                                                  OAuthClient(self.__helix, os.getenv("CLIENT_SECRET"), os.getenv("REDIRECT_URI"),
+                                                              oauth_url if oauth_url is not None else OAUTH_URL),
+                                                  onboarding_port,
+                                                  join=join_onboarded)
+        
+        ## Timeouts and bans are applied through Helix as the channel's owner if they onboarded the bot,
+        ## otherwise with the bot's own token, which needs the `moderator:manage:banned_users` scope.
+        self.__moderation: Moderation = Moderation(self.__helix, self.__chatters, token.removeprefix("oauth:"), "DoggieKampo",
+                                                   broadcaster_tokens=self.__channel_joiner.broadcaster_token if self.__channel_joiner is not None else None)
+        
+        self.__metrics_server: Optional[MetricsServer] = None
+        if metrics_port is not None:
+            from Core.Metrics import MetricsServer
+            self.__metrics_server = MetricsServer(metrics_port)
+        
+        ## Modes and variables of every module in every channel, kept with the channel registry.
+        self.__channel_config: ChannelConfigStore = ChannelConfigStore(channels_database)
+        
+        ## Cogs are loaded on their first command or handler call, and can be reloaded without reconnecting.
+        ## The score writer is kept by the bot, so queued scores survive reloads of the pyramid handler.
+        self.__pyramids_database: str = pyramids_database
+        self.__score_writer: Optional[ScoreWriter] = score_writer
+        self.__cog_loader: CogLoader = CogLoader(self, cog_manifest)
+        self.__cog_loader.configure("PyramidHandler", lambda: {"database_path" : self.__pyramids_database,
+                                                               "score_writer" : self.__get_score_writer(),
+                                                               "restored_states" : self.__take_restored_pyramids()})
+        self.__handle_pyramids: Callable[..., Awaitable[Any]] = self.__cog_loader.handler("PyramidHandler", "handle_pyramids")
         
-        self.__pyramid_handler = PyramidHandler()
-        self.add_cog(self.__pyramid_handler)
+        ## Handlers are registered by what they care about, so each message only reaches the handlers that want it.
+        self.__pipeline: MessagePipeline = MessagePipeline(prefix='?', emotes=self.__emotes)
+        self.__pipeline.add_passive_handler(self.__track_pyramids)
+        self.__pipeline.add_trigger("sent love to @?DoggieKampo", self.__send_love)
+        self.__pipeline.add_command_handler(self.__handle_commands)
+        
+        ## Messages are queued rather than handled as they are read, so a burst in one channel cannot stall the connection.
+        self.__ingest: IngestQueue = IngestQueue(self.__pipeline, ingest_max_commands, ingest_max_passive, ingest_coalesce)
+        
+        ## State from the last run that is recent enough to still be true is restored, pyramid attempts wait for the pyramid handler to load.
+        self.__restored_pyramids: dict[str, SavedPyramid] = {}
+        self.__snapshotter: Optional[Snapshotter] = None
+        if snapshot_path is not None:
+            warm_state: Optional[WarmState] = read_snapshot(snapshot_path)
+            if warm_state is not None:
+                self.__chatters.restore(warm_state.chatters)
+                self.__stream_status.restore(warm_state.online)
+                self.__restored_pyramids = warm_state.pyramids
+                print(f"Restored {len(warm_state.pyramids)} pyramids, {len(warm_state.online)} stream statuses"
+                      + f" and {len(warm_state.chatters)} chatters from {time.time() - warm_state.created:.0f}s ago")
+            self.__snapshotter = Snapshotter(snapshot_path, self.__collect_warm_state, snapshot_interval)
+        
+        self.__start_time: float = start
+        _STARTUP_SECONDS.set(time.perf_counter() - start)
+        print(f"Started in {_STARTUP_SECONDS.get() * 1000:.0f}ms")
+    
+    @property
+    def send_scheduler(self) -> SendScheduler:
+        "The scheduler all outbound chat messages are sent through."
+        return self.__send_scheduler
+    
+    @property
+    def chatters(self) -> ChatterCache:
+        "The user ids of chatters, by name."
+        return self.__chatters
+    
+    @property
+    def stream_status(self) -> StreamStatus:
+        "Whether each of the bot's channels is live."
+        return self.__stream_status
+    
+    @property
+    def emotes(self) -> EmoteRegistry:
+        "The emotes usable in each of the bot's channels."
+        return self.__emotes
+    
+    @property
+    def moderation(self) -> Moderation:
+        "The dispatcher timeouts and bans are applied through."
+        return self.__moderation
+    
+    @property
+    def ingest(self) -> IngestQueue:
+        "The per-channel queues of received messages waiting to be handled."
+        return self.__ingest
+    
+    @property
+    def cog_loader(self) -> CogLoader:
+        "The loader of the bot's cogs."
+        return self.__cog_loader
+    
+    @property
+    def channel_config(self) -> ChannelConfigStore:
+        "The per-channel modes and variables of the bot's modules."
+        return self.__channel_config
+    
+    @property
+    def channel_joiner(self) -> "Optional[ChannelJoiner]":
+        "The channel joiner onboarding new channels, and holding the credentials of joined channels, if onboarding or channel credentials are enabled."
+        return self.__channel_joiner
+    
+    async def event_ready(self) -> None:
+        "Event called when the bot has logged in and joined its initial channels."
+        _READY_SECONDS.set(time.perf_counter() - self.__start_time)
+        await self.__stream_status.start()
+        await self.__emotes.start()
+        if self.__snapshotter is not None:
+            await self.__snapshotter.start()
+        if self.__metrics_server is not None:
+            await self.__metrics_server.start()
+        if self.__channel_joiner is not None:
+            await self.__channel_joiner.start()
     
     ##################################################################################
     #### User joining and parting
     
+    async def join_channels(self, channels: Union[list[str], tuple[str]]) -> None:
+        "Join channels, and start tracking whether they are live and their emotes."
+        await super().join_channels(channels)
+        self.__stream_status.track(channels)
+        self.__emotes.track(channels)
+    
+    async def part_channels(self, channels: Union[list[str], tuple[str]]) -> None:
+        "Part channels, and stop tracking whether they are live and their emotes."
+        await super().part_channels(channels)
+        self.__stream_status.untrack(channels)
+        self.__emotes.untrack(channels)
+    
     async def event_join(self, channel: twitchio.Channel, user: twitchio.User):
         "Event called when a JOIN is received from Twitch."
         return await super().event_join(channel, user)
@@ -50,30 +250,13 @@ class OllieBot(commands.Bot):
         "Event called when a PART is received from Twitch."
         return await super().event_part(user)
     
+    async def event_userstate(self, user: twitchio.Chatter):
+        "Event called when a USERSTATE is received from Twitch, which gives the bot's own badges in a channel."
+        self.__send_scheduler.set_moderator(user.channel.name, user.is_mod)
+    
     ##################################################################################
     #### Messages
     
-    async def __is_online(self, channel: str) -> bool:
-        """Check if the channel is online."""
-        time_now = datetime.now()
-        
-        if (channel not in self.__last_online_get_time
-            or (time_now - self.__last_online_get_time[channel]) > timedelta(seconds=15)):
-            
-            self.__last_online_get_time[channel] = time_now
-            
-            response = requests.get(f"https://api.twitch.tv/helix/streams?user_login={channel}",
-                                    headers={"Authorization" : f"Bearer {os.getenv('APP_TOKEN')}",
-                                             "Client-Id" : os.getenv("CLIENT_ID")}).json()
-            
-            if "error" in response:
-                self.__online[channel] = False
-                raise RuntimeError(f"{response['error']} ({response['status']}) : {response['message']}")
-            
-            self.__online[channel] = response["data"] != []
-        
-        return self.__online[channel]
-    
     async def event_message(self, message: twitchio.Message) -> None:
         "Event called when a PRIVMSG is received from Twitch."
         
@@ -81,26 +264,88 @@ class OllieBot(commands.Bot):
         if message.echo:
             return
         
-        context: commands.Context = await self.get_context(message)
+        ## Every message carries its sender's id, which keeps the ids of active chatters cached for free.
+        if message.author.id:
+            self.__chatters.observe(message.author.name, int(message.author.id))
         
         # user = await context.channel.user(force=True)
         # print(user.view_count)
         # user.create_prediction()
         # user.end_prediction()
         
-        try:
-            online = await self.__is_online(message.channel.name)
-        except RuntimeError as e:
-            print(e)
-        
-        if online:
-            await self.__pyramid_handler.handle_pyramids(context)
-        
-        if re.search("sent love to @?DoggieKampo", str(message.content)) is not None:
-            await context.send(f"!love @{str(message.content).split(' ')[0]}")
-        
+        self.__ingest.submit(message)
+    
+    async def __track_pyramids(self, message: twitchio.Message) -> None:
+        "Track pyramids in the message's channel while it is online."
+        if self.__stream_status.is_online(message.channel.name):
+            await self.__handle_pyramids(message)
+    
+    async def __handle_commands(self, message: twitchio.Message) -> None:
+        "Load the cog of the message's command if it is not loaded, then handle the command."
+        content: str = str(message.content)
+        ## Replies are prefixed with the @name of the chatter being replied to.
+        if message.tags and "reply-parent-msg-id" in message.tags:
+            content = content.partition(" ")[2]
+        self.__cog_loader.load_for_command(content.removeprefix("?").partition(" ")[0])
         await self.handle_commands(message)
     
+    def __get_score_writer(self) -> ScoreWriter:
+        "Get the pyramid score writer, starting it on first use."
+        if self.__score_writer is None:
+            ## The database is switched to write-ahead logging and migrated before the writer thread starts,
+            ## as the switch cannot be made while the pyramid handler is creating its indexes.
+            connect_writer(self.__pyramids_database).close()
+            self.__score_writer = ScoreWriter(self.__pyramids_database)
+        return self.__score_writer
+    
+    def __take_restored_pyramids(self) -> dict[str, SavedPyramid]:
+        "Get the restored pyramid attempts for the first load of the pyramid handler, later loads start afresh."
+        restored_pyramids: dict[str, SavedPyramid] = self.__restored_pyramids
+        self.__restored_pyramids = {}
+        return restored_pyramids
+    
+    def __collect_warm_state(self) -> WarmState:
+        "Collect the state to save in a snapshot."
+        pyramid_handler: Optional[commands.Cog] = self.__cog_loader.get("PyramidHandler")
+        ## Restored attempts not yet given to the pyramid handler are kept until they are too old to restore.
+        return WarmState(time.time(),
+                         pyramid_handler.pyramid_states() if pyramid_handler is not None else dict(self.__restored_pyramids),
+                         self.__stream_status.statuses(),
+                         self.__chatters.items())
+    
+    async def __send_love(self, message: twitchio.Message, match: re.Match) -> None:
+        self.__send_scheduler.submit(message.channel.name, f"!love @{str(message.content).split(' ')[0]}", Priority.PASSIVE)
+    
+    async def close(self) -> None:
+        "Send queued messages, disconnect from Twitch, and close the bot's services."
+        await self.__send_scheduler.close()
+        await super().close()
+        await self.close_services()
+    
+    async def close_services(self, send_timeout: float = 5.0) -> None:
+        """
+        Stop handling received messages, write a final snapshot, send queued messages, unload every cog, commit queued scores, apply requested timeouts, stop tracking stream status and emotes and close the Helix connection pool.
+        
+        This does not touch the IRC connection, so it can also be used when the bot's handlers were run without connecting.
+        """
+        await self.__ingest.close()
+        ## The snapshot is taken before the pyramid handler is unloaded with its states.
+        if self.__snapshotter is not None:
+            await self.__snapshotter.close()
+        await self.__send_scheduler.close(send_timeout)
+        if self.__channel_joiner is not None:
+            await self.__channel_joiner.close()
+        self.__cog_loader.close()
+        if self.__score_writer is not None:
+            self.__score_writer.close()
+        self.__channel_config.close()
+        await self.__moderation.close(send_timeout)
+        await self.__stream_status.close()
+        await self.__emotes.close()
+        await self.__helix.close()
+        if self.__metrics_server is not None:
+            await self.__metrics_server.close()
+    
     ##################################################################################
     #### Built-in commands
     
@@ -109,66 +354,122 @@ class OllieBot(commands.Bot):
         if context.author.is_mod:
             command_string: str = get_command_string(context)
             for _ in range(10):
-                await context.send(command_string)
+                send_message(context, command_string, Priority.PASSIVE)
+    
+    @commands.command()
+    async def stats(self, context: commands.Context) -> None:
+        "Summarise the bot's latency and throughput metrics, for moderators."
+        if not context.author.is_mod:
+            return
+        
+        def latency(name: str, labels: Optional[dict[str, str]] = None) -> str:
+            histogram: Optional[Histogram] = REGISTRY.get(name, labels)
+            if histogram is None or not histogram.count:
+                return "n/a"
+            return f"{histogram.quantile(0.5) * 1000:.2g}/{histogram.quantile(0.99) * 1000:.2g}ms"
+        
+        ## The score cache's counters only exist once the pyramid handler is loaded.
+        hits_counter: Optional[Counter] = REGISTRY.get("olliebot_score_cache_hits_total")
+        misses_counter: Optional[Counter] = REGISTRY.get("olliebot_score_cache_misses_total")
+        hits: float = hits_counter.get() if hits_counter is not None else 0.0
+        misses: float = misses_counter.get() if misses_counter is not None else 0.0
+        send_message(context, f"Messages: {self.__pipeline.received}"
+                            + f" | Pyramids p50/p99: {latency('olliebot_handler_seconds', {'handler' : 'track_pyramids'})}"
+                            + f" | Lock wait: {latency('olliebot_pyramid_lock_wait_seconds')}"
+                            + f" | Live: {REGISTRY.get('olliebot_streams_online').get():.0f}/{len(self.__stream_status.channels)}"
+                            + f" | Send: {latency('olliebot_send_latency_seconds', {'priority' : 'reply'})}"
+                            + f" | Cache hit rate: {(hits / (hits + misses)) if hits + misses else 0.0:.1%}"
+                            + f" | Backlog: {self.__ingest.depth} Shed: {self.__ingest.shed}"
+                            + f" | Queued: {self.__send_scheduler.depth} Sent: {self.__send_scheduler.sent} Dropped: {self.__send_scheduler.dropped}")
+    
+    @commands.command(name="cogs")
+    async def list_cogs(self, context: commands.Context) -> None:
+        "List the bot's cogs, and how long each loaded cog took to import and construct, for moderators."
+        if not context.author.is_mod:
+            return
+        timings: dict[str, tuple[float, float]] = self.__cog_loader.timings
+        send_message(context, f"Started in {_STARTUP_SECONDS.get() * 1000:.0f}ms | Cogs :: "
+                            + ", ".join(f"{cog_name}: " + (f"{timings[cog_name][0] * 1000:.1f}ms import, {timings[cog_name][1] * 1000:.1f}ms init"
+                                                           if self.__cog_loader.get(cog_name) is not None else "not loaded")
+                                        for cog_name in self.__cog_loader.specs))
+    
+    @commands.command()
+    async def reload(self, context: commands.Context) -> None:
+        "Reload a cog in place, without reconnecting to chat."
+        if context.author.is_mod and context.author.name.lower() == "olliekampo":
+            cog_name: str = get_command_string(context).strip()
+            if cog_name not in self.__cog_loader.specs:
+                send_message(context, f"Unknown cog \"{cog_name}\", must be one of; {', '.join(self.__cog_loader.specs)}")
+                return
+            try:
+                await self.__cog_loader.reload(cog_name)
+            except Exception as error:
+                send_message(context, f"Failed to reload {cog_name}: {type(error).__name__}: {error}")
+                return
+            import_seconds, init_seconds = self.__cog_loader.timings[cog_name]
+            send_message(context, f"Reloaded {cog_name} in {(import_seconds + init_seconds) * 1000:.1f}ms.")
     
     @commands.command()
     async def hello(self, context: commands.Context) -> None:
         "Greet the user the message was sent to if the message is non-empty, otherwise say hello to the sender."
         user_name: str = get_user(context)
         if user_name != str(context.author.name):
-            await context.send(f"OhMyDog Herrow {user_name} peepoHey <3")
-        else: await context.send(f"OhMyDog Woof woof Herrow {user_name} OhMyDog")
+            send_message(context, f"OhMyDog Herrow {user_name} peepoHey <3")
+        else: send_message(context, f"OhMyDog Woof woof Herrow {user_name} OhMyDog")
     
     @commands.command()
     async def treat(self, context: commands.Context) -> None:
         ... ## TODO
     
+    def __timeout_author(self, context: commands.Context, duration: int, reason: str) -> None:
+        "Time out the chatter who invoked a command for the given number of seconds."
+        self.__moderation.timeout(context.channel.name, context.author.name, duration, reason,
+                                  int(context.author.id) if context.author.id else None)
+    
     @commands.command()
     async def roulette(self, context: commands.Context) -> None:
         "The chatter has a 1 in 6 chance of being timed out for 2 minutes."
         if not random.randint(0, 5):
-            await context.send(f"/timeout {context.author.name} 2m")
-            await context.send(f"The die is rolled PauseChamp The chatter is lost PepeHands")
-        else: await context.send(f"The die is rolled PauseChamp The chatter survives widepeepoHappy")
+            self.__timeout_author(context, 120, "Lost at roulette")
+            send_message(context, f"The die is rolled PauseChamp The chatter is lost PepeHands")
+        else: send_message(context, f"The die is rolled PauseChamp The chatter survives widepeepoHappy")
     
     @commands.command()
     async def high_stakes_roulette(self, context: commands.Context) -> None:
         if not random.randint(0, 1):
-            await context.send(f"/timeout {context.author.name} 2m")
-            await context.send("I didn't bother rolling the die YEP I decided you lost anyway BigBrother")
+            self.__timeout_author(context, 120, "Lost at high stakes roulette")
+            send_message(context, "I didn't bother rolling the die YEP I decided you lost anyway BigBrother")
         elif not random.randint(0, 5):
-            await context.send(f"/timeout {context.author.name} 2m")
-            await context.send("The die is rolled PauseChamp The chatter is lost PepeHands")
-        else: await context.send("The die is rolled PauseChamp The chatter survives widepeepoHappy")
+            self.__timeout_author(context, 120, "Lost at high stakes roulette")
+            send_message(context, "The die is rolled PauseChamp The chatter is lost PepeHands")
+        else: send_message(context, "The die is rolled PauseChamp The chatter survives widepeepoHappy")
     
     @commands.command()
     async def low_stakes_roulette(self, context: commands.Context) -> None:
-        await context.send(f"/timeout {context.author.name} 2m")
-        await context.send(f"Coward {context.author.name} :)")
+        self.__timeout_author(context, 120, "Played low stakes roulette")
+        send_message(context, f"Coward {context.author.name} :)")
 
 if __name__ == "__main__":
-    # connection: sqlite3.Connection = sqlite3.connect("SQL/twitch_channels.sqlite3")
-    # cursor: sqlite3.Cursor = connection.cursor()
-    # cursor.execute("""
-    #                SELECT channel_name
-    #                FROM channels
-    #                """)
-    # channel_list: list[str] = cursor.fetchall()
-    # connection.close()
-    
-    ollie_bot = OllieBot(os.getenv("TMI_TOKEN"),
-                         os.getenv("CLIENT_ID"),
-                         "Froggen")
-    ollie_bot.run()
-
-# class ChannelJoiner:
-#     def __init__(self) -> None:
-#         pass
-    
-    ## This has to have a socket or something similar that;
-    ##      - blocks and waits for a redirect from twitch with an auth token,
-    ##      - accepts the connection,
-    ##      - obtains the user id (how do we obtain this?) and the auth token,
-    ##      - it then saves to the sql database; channel_name, channel_owner_id, join_date, enabled, auth_token, refresh_token, tokens_valid
-    ##      - it then calls a join channel method with the given channel name that queries the database again, loads the api tokens to be used by the HTTP "requests" connection for api calls related to that specific channel,
-    ##      - this then in turn calls twitchio's join channel method, which connects to the twitch IRC server.
\ No newline at end of file
+    metrics_port: Optional[str] = os.getenv("METRICS_PORT")
+    onboarding_port: Optional[str] = os.getenv("ONBOARDING_PORT")
+    workers: int = int(os.getenv("WORKERS", "1"))
+    
+    ## With more than one worker, channels from the registry are split between worker processes,
+    ## channels onboarded by the first worker are picked up when the supervisor next polls the registry.
+    if workers > 1:
+        from Core.Supervisor import Supervisor
+        Supervisor(OllieBot,
+                   workers,
+                   os.getenv("TMI_TOKEN"),
+                   os.getenv("CLIENT_ID"),
+                   metrics_port=int(metrics_port) if metrics_port else None,
+                   onboarding_port=int(onboarding_port) if onboarding_port else None).run()
+    
+    else:
+        from Core.Supervisor import load_channels
+        ollie_bot = OllieBot(os.getenv("TMI_TOKEN"),
+                             os.getenv("CLIENT_ID"),
+                             load_channels() or "Froggen",
+                             metrics_port=int(metrics_port) if metrics_port else None,
+                             onboarding_port=int(onboarding_port) if onboarding_port else None)
+        ollie_bot.run()
@@ -0,0 +1,257 @@
+"""
+Bulk backfill of pyramid scores from recorded chat logs.
+
+Streams log files through the same pyramid detector as the live handler, across a pool of
+worker processes. Each channel's emotes are loaded from the bot's emote cache, so that, as live,
+only emotes can build pyramids in channels whose emotes are known. Every channel is partitioned to a single worker, so each channel's chat is
+seen in order, exactly as it was live. Workers aggregate their results per chatter, and the
+merged scores are written in large transactions at the end.
+
+Scores are keyed by user id, taken from the `user-id` tags of raw IRC logs. Chatters whose id the
+logs never recorded are given a surrogate id, which is merged into their real id when they are next seen live.
+
+Run from the repository root:
+```
+python -m Tools.Backfill chat-2023-01.log chat-2023-02.log --workers 8
+python -m Tools.Backfill chat.log --database SQL/pyramids.sqlite3 --rebuild
+python -m Tools.Backfill chat.log --emote-cache ""
+```
+
+Logs are read by `Tools.ChatLog`, as raw IRC lines or tab-separated `channel, sender, text[, badges[, user id]]` lines.
+"""
+
+import argparse
+import multiprocessing
+from multiprocessing.queues import Queue
+import os
+import queue
+import sqlite3
+import time
+from typing import Any, Iterable, Optional
+import zlib
+
+from Core.Chatters import surrogate_id
+from Core.Emotes import EMOTE_CACHE_PATH, load_emote_sets
+from Core.PyramidDetector import PyramidDetector, PyramidEventKind
+from Core.ScoreWriter import add_result, connect_writer, merge_deltas, write_scores
+from Tools.ChatLog import ChatLine, line_channel, parse_chat_line
+
+__all__ = ("backfill_partition",
+           "backfill")
+
+## The results of the detector's events that are scored, as passed to `add_result`.
+_RESULTS: dict[PyramidEventKind, str] = {PyramidEventKind.SUCCESS : "success",
+                                         PyramidEventKind.FAILED : "failed",
+                                         PyramidEventKind.BLOCKED : "blocked"}
+
+## The time in seconds to wait on a worker before checking it is still alive.
+_WORKER_POLL_SECONDS: float = 1.0
+
+def _partition(channel_name: str, partitions: int) -> int:
+    "The partition of a channel, stable across processes and runs."
+    return zlib.crc32(channel_name.encode()) % partitions
+
+def _check_workers(processes: list[multiprocessing.Process]) -> None:
+    "Raise a `RuntimeError` if any of the workers has failed."
+    for process in processes:
+        if process.exitcode:
+            raise RuntimeError(f"Backfill worker {process.name} failed with exit code {process.exitcode}.")
+
+def _put_chunk(chunks: Queue, chunk: Optional[list[str]], process: multiprocessing.Process) -> None:
+    "Put a chunk on a worker's queue, raising a `RuntimeError` if the worker fails while its queue is full."
+    while True:
+        try:
+            chunks.put(chunk, timeout=_WORKER_POLL_SECONDS)
+            return
+        except queue.Full:
+            _check_workers([process])
+
+def backfill_partition(chunks: Queue, results: Queue, emote_sets: Optional[dict[str, frozenset[str]]] = None) -> None:
+    """
+    Detect the pyramids in the chunks of raw log lines arriving on a queue until a None is received,
+    then put the number of messages read, the score deltas of every chatter by name,
+    and the user ids recorded for those chatters on the results queue.
+
+    Only emotes can build pyramids in the channels whose emotes are given, any repeated word can in the others.
+    """
+    emote_sets = emote_sets or {}
+    detector: PyramidDetector = PyramidDetector()
+    feed = detector.feed
+    scores: dict[str, list[int]] = {}
+    user_ids: dict[str, int] = {}
+    messages: int = 0
+    while (chunk := chunks.get()) is not None:
+        for line in chunk:
+            chat_line: Optional[ChatLine] = parse_chat_line(line.rstrip("\r\n"))
+            if chat_line is None:
+                continue
+            messages += 1
+            if chat_line.user_id:
+                user_ids[chat_line.sender] = int(chat_line.user_id)
+            for event in feed(chat_line.channel, chat_line.sender, chat_line.badges, chat_line.text,
+                              emote_sets.get(chat_line.channel), chat_line.emotes):
+                if (result := _RESULTS.get(event.kind)) is not None:
+                    deltas: Optional[list[int]] = scores.get(event.chatter_name)
+                    if deltas is None:
+                        deltas = scores[event.chatter_name] = [0, 0, 0, 0, 0]
+                    add_result(deltas, result, event.stolen, event.size)
+    ## Results are keyed by name until the end, as a chatter's id may only be recorded after their first result.
+    results.put((messages, scores, {chatter_name : user_ids[chatter_name] for chatter_name in scores if chatter_name in user_ids}))
+
+def backfill(log_paths: Iterable[str],
+             database_path: str = "SQL/pyramids.sqlite3",
+             workers: int = 4,
+             chunk_lines: int = 20_000,
+             transaction_rows: int = 100_000,
+             rebuild: bool = False,
+             emote_cache: Optional[str] = EMOTE_CACHE_PATH
+             ) -> dict[str, Any]:
+    """
+    Backfill pyramid scores from chat logs, and return a summary of the run.
+
+    Parameters
+    ----------
+    `log_paths: Iterable[str]` - The chat logs, in the order they were recorded.
+
+    `workers: int = 4` - The number of worker processes, channels are partitioned between them.
+
+    `chunk_lines: int = 20_000` - The number of lines sent to a worker at once.
+
+    `transaction_rows: int = 100_000` - The number of chatters written in each transaction.
+
+    `rebuild: bool = False` - Whether to clear the existing scores first, otherwise the backfilled scores are added to them.
+
+    `emote_cache: Optional[str] = EMOTE_CACHE_PATH` - The bot's emote cache, beside which the caches of a supervisor's workers are also read, or None to let any repeated word build pyramids in every channel.
+
+    Raises a `RuntimeError` if a worker fails, after stopping the others, rather than waiting forever on its results.
+    """
+    if workers < 1:
+        raise ValueError(f"A backfill needs at least one worker, got {workers}.")
+    start: float = time.perf_counter()
+    emote_sets: dict[str, frozenset[str]] = load_emote_sets(emote_cache) if emote_cache is not None else {}
+
+    ## Workers are spawned rather than forked, as for the supervisor's workers.
+    context = multiprocessing.get_context("spawn")
+    ## Each worker has its own bounded queue, so the lines of a channel arrive in order and reading never runs far ahead.
+    queues: list[Queue] = [context.Queue(maxsize=8) for _ in range(workers)]
+    results: Queue = context.Queue()
+    processes: list[multiprocessing.Process] = [context.Process(target=backfill_partition,
+                                                                name=f"Backfill-{index}",
+                                                                args=(queues[index], results, emote_sets))
+                                                for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    lines: int = 0
+    buffers: list[list[str]] = [[] for _ in range(workers)]
+    partitions: dict[str, int] = {}
+    messages: int = 0
+    scores: dict[str, list[int]] = {}
+    user_ids: dict[str, int] = {}
+    try:
+        for log_path in log_paths:
+            with open(log_path, encoding="utf-8", errors="replace", buffering=1 << 20) as log_file:
+                for line in log_file:
+                    lines += 1
+                    channel_name: Optional[str] = line_channel(line)
+                    if channel_name is None:
+                        continue
+                    partition: Optional[int] = partitions.get(channel_name)
+                    if partition is None:
+                        partition = partitions[channel_name] = _partition(channel_name, workers)
+                    buffer: list[str] = buffers[partition]
+                    buffer.append(line)
+                    if len(buffer) >= chunk_lines:
+                        _put_chunk(queues[partition], buffer, processes[partition])
+                        buffers[partition] = []
+        for partition, buffer in enumerate(buffers):
+            if buffer:
+                _put_chunk(queues[partition], buffer, processes[partition])
+        for partition, chunks in enumerate(queues):
+            _put_chunk(chunks, None, processes[partition])
+
+        ## Results must be received before the workers are joined, or a worker could block forever putting them.
+        received: int = 0
+        while received < workers:
+            try:
+                partition_messages, partition_scores, partition_user_ids = results.get(timeout=_WORKER_POLL_SECONDS)
+            except queue.Empty:
+                ## A worker that exits cleanly has already put its results, so only a failed worker is waited on forever.
+                _check_workers(processes)
+                continue
+            received += 1
+            messages += partition_messages
+            user_ids.update(partition_user_ids)
+            for chatter_name, deltas in partition_scores.items():
+                if (merged := scores.get(chatter_name)) is not None:
+                    merge_deltas(merged, deltas)
+                else: scores[chatter_name] = deltas
+    except BaseException:
+        ## Chunks still buffered for a stopped worker are abandoned, rather than blocking the exit.
+        for chunks in queues:
+            chunks.cancel_join_thread()
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+
+    ## A renamed chatter's results under each of their names are merged under their id.
+    id_scores: dict[int, list[int]] = {}
+    names: dict[int, str] = {}
+    for chatter_name, deltas in scores.items():
+        user_id: int = user_ids.get(chatter_name) or surrogate_id(chatter_name)
+        if (merged := id_scores.get(user_id)) is not None:
+            merge_deltas(merged, deltas)
+        else: id_scores[user_id] = deltas
+        names[user_id] = chatter_name
+    detected: float = time.perf_counter()
+
+    connection: sqlite3.Connection = connect_writer(database_path)
+    try:
+        if rebuild:
+            ## The delete is committed in the same transaction as the first batch of scores.
+            connection.execute("DELETE FROM pyramid_scores")
+        chatter_ids: list[int] = list(id_scores)
+        for index in range(0, len(chatter_ids), transaction_rows):
+            write_scores(connection, {user_id : id_scores[user_id]
+                                      for user_id in chatter_ids[index:index + transaction_rows]}, names)
+        if rebuild and not chatter_ids:
+            connection.commit()
+    finally:
+        connection.close()
+    elapsed: float = time.perf_counter() - start
+
+    return {"lines" : lines,
+            "messages" : messages,
+            "channels" : len(partitions),
+            "channels_with_emotes" : sum(channel_name in emote_sets for channel_name in partitions),
+            "chatters" : len(id_scores),
+            "surrogate_ids" : sum(user_id < 0 for user_id in id_scores),
+            "successes" : sum(deltas[0] for deltas in id_scores.values()),
+            "failures" : sum(deltas[1] for deltas in id_scores.values()),
+            "blocks" : sum(deltas[2] for deltas in id_scores.values()),
+            "detect_seconds" : round(detected - start, 3),
+            "write_seconds" : round(elapsed - (detected - start), 3),
+            "lines_per_minute" : round(lines * 60 / elapsed) if elapsed else 0}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill pyramid scores from recorded chat logs.")
+    parser.add_argument("logs", nargs="+", help="The chat logs to backfill, in the order they were recorded.")
+    parser.add_argument("--database", type=str, default="SQL/pyramids.sqlite3", help="The pyramid scores database.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="The number of worker processes.")
+    parser.add_argument("--chunk-lines", type=int, default=20_000, help="The number of lines sent to a worker at once.")
+    parser.add_argument("--transaction-rows", type=int, default=100_000, help="The number of chatters written in each transaction.")
+    parser.add_argument("--rebuild", action="store_true", help="Clear the existing scores before backfilling.")
+    parser.add_argument("--emote-cache", type=str, default=EMOTE_CACHE_PATH,
+                        help="The bot's emote cache, or an empty string to let any repeated word build pyramids.")
+    args = parser.parse_args()
+
+    results: dict[str, Any] = backfill(args.logs, args.database, args.workers,
+                                       args.chunk_lines, args.transaction_rows, args.rebuild,
+                                       args.emote_cache or None)
+    for name, value in results.items():
+        print(f"{name:>18} : {value}")
+
+if __name__ == "__main__":
+    main()
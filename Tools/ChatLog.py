@@ -0,0 +1,71 @@
+"""
+Reading recorded chat logs.
+
+Logs may be raw IRC lines (`@tags :nick!nick@nick.tmi.twitch.tv PRIVMSG #channel :text`)
+or tab-separated `channel, sender, text[, badges[, user id]]` lines, other lines are skipped.
+"""
+
+import re
+from typing import Iterator, NamedTuple, Optional
+
+__all__ = ("ChatLine",
+           "parse_chat_line",
+           "line_channel",
+           "read_chat_log")
+
+class ChatLine(NamedTuple):
+    "A single chat message to replay."
+    channel: str
+    sender: str
+    text: str
+    badges: str = ""
+    ## The sender's user id, if the log recorded it.
+    user_id: str = ""
+    ## The IRC `emotes` tag of the message, if the log recorded it.
+    emotes: str = ""
+
+_IRC_PRIVMSG: re.Pattern = re.compile(r"^(?:@(?P<tags>\S+) )?:(?P<nick>[^!\s]+)!\S+ PRIVMSG #(?P<channel>\S+) :(?P<text>.*)$")
+
+def parse_chat_line(line: str) -> Optional[ChatLine]:
+    "Parse a line of a chat log, without its line ending, or return None if it is not a chat message."
+    if (match := _IRC_PRIVMSG.match(line)) is not None:
+        badges: str = ""
+        user_id: str = ""
+        emotes: str = ""
+        if match["tags"]:
+            for tag in match["tags"].split(";"):
+                if tag.startswith("badges="):
+                    badges = tag[7:]
+                elif tag.startswith("user-id="):
+                    user_id = tag[8:]
+                elif tag.startswith("emotes="):
+                    emotes = tag[7:]
+        return ChatLine(match["channel"].lower(), match["nick"].lower(), match["text"], badges, user_id, emotes)
+    if line.count("\t") >= 2:
+        fields: list[str] = line.split("\t")
+        return ChatLine(fields[0].lower(), fields[1].lower(), fields[2],
+                        fields[3] if len(fields) > 3 else "",
+                        fields[4] if len(fields) > 4 else "")
+    return None
+
+def line_channel(line: str) -> Optional[str]:
+    """
+    Get the channel of a line of a chat log, or None if it is not a chat message.
+
+    This only finds the channel's name, so lines can be routed by channel much faster than they can be parsed.
+    """
+    index: int = line.find(" PRIVMSG #")
+    if index != -1:
+        end: int = line.find(" ", index + 10)
+        return line[index + 10:end].lower() if end != -1 else None
+    index = line.find("\t")
+    if index != -1:
+        return line[:index].lower()
+    return None
+
+def read_chat_log(path: str) -> Iterator[ChatLine]:
+    "Stream the chat lines of a recorded log file, in raw IRC or tab-separated format."
+    with open(path, encoding="utf-8", errors="replace") as log_file:
+        for line in log_file:
+            if (chat_line := parse_chat_line(line.rstrip("\r\n"))) is not None:
+                yield chat_line
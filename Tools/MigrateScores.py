@@ -0,0 +1,99 @@
+"""
+Migration of pyramid scores from chatter names to user ids.
+
+Opening the scores database for writing migrates a table still keyed by chatter name, giving every
+chatter a surrogate id. The bot merges a chatter's surrogate row into their real id when they are next
+seen, this resolves every surrogate row at once instead, looking up their names in batched Helix `/users` requests.
+Names that no longer exist keep their surrogate ids. Best run while the bot is stopped,
+as a running bot would not see scores merged into rows it already holds in memory until they are evicted.
+
+Batches of scores the bot gave up on writing, kept in dead letter files such as `pyramids.failed.jsonl` beside the database, are written first.
+
+Run from the repository root, with the `CLIENT_ID` and `APP_TOKEN` environment variables set:
+```
+python -m Tools.MigrateScores
+python -m Tools.MigrateScores --database SQL/pyramids.sqlite3 --batch 1000
+```
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import sqlite3
+import time
+from typing import Any, Optional
+
+from Core.Helix import HELIX_URL, HelixClient, HelixError
+from Core.ScoreWriter import connect_writer, dead_letter_file, merge_scores, replay_dead_letters
+
+__all__ = ("resolve_surrogates",)
+
+async def resolve_surrogates(database_path: str = "SQL/pyramids.sqlite3",
+                             helix_url: str = HELIX_URL,
+                             batch_size: int = 1000
+                             ) -> dict[str, Any]:
+    """
+    Migrate the scores database if needed, write the batches in its dead letter files,
+    then merge every surrogate row into its chatter's real id, and return a summary of the run.
+
+    Parameters
+    ----------
+    `helix_url: str = HELIX_URL` - The Helix API, which can be pointed at a local stand-in.
+
+    `batch_size: int = 1000` - The number of names looked up before their rows are merged,
+    each name is looked up once, in requests of up to 100 names.
+    """
+    start: float = time.perf_counter()
+    connection: sqlite3.Connection = connect_writer(database_path)
+    replayed: int = 0
+    ## The dead letter file of a bot run alone, and those of a supervisor's workers.
+    root, extension = os.path.splitext(dead_letter_file(database_path))
+    for path in sorted(glob.glob(f"{glob.escape(root)}*{extension}")):
+        try:
+            replayed += replay_dead_letters(connection, path)
+        except (OSError, ValueError, KeyError, TypeError, sqlite3.Error) as error:
+            print(f"Failed to write the dead letters in {path}: {error}")
+    helix: HelixClient = HelixClient(base_url=helix_url)
+    surrogates: list[tuple[int, str]] = connection.execute("""
+                                                           SELECT user_id, chatter_name
+                                                           FROM pyramid_scores
+                                                           WHERE user_id < 0
+                                                           """).fetchall()
+    resolved: int = 0
+    try:
+        for index in range(0, len(surrogates), batch_size):
+            batch: list[tuple[int, str]] = surrogates[index:index + batch_size]
+            try:
+                user_ids: dict[str, str] = await helix.get_user_ids(chatter_name for _, chatter_name in batch)
+            except HelixError as error:
+                print(f"Failed to look up chatters: {error}")
+                continue
+            for surrogate, chatter_name in batch:
+                user_id: Optional[str] = user_ids.get(chatter_name)
+                ## Chatters seen live since the migration already have a row under their real id, which the scores are added to.
+                if user_id is not None and merge_scores(connection, surrogate, int(user_id), chatter_name):
+                    resolved += 1
+    finally:
+        await helix.close()
+        connection.close()
+
+    return {"replayed" : replayed,
+            "surrogates" : len(surrogates),
+            "resolved" : resolved,
+            "unresolved" : len(surrogates) - resolved,
+            "seconds" : round(time.perf_counter() - start, 3)}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Migrate pyramid scores from chatter names to user ids.")
+    parser.add_argument("--database", type=str, default="SQL/pyramids.sqlite3", help="The pyramid scores database.")
+    parser.add_argument("--helix-url", type=str, default=HELIX_URL, help="The Helix API to look up chatters through.")
+    parser.add_argument("--batch", type=int, default=1000, help="The number of names looked up before their rows are merged.")
+    args = parser.parse_args()
+
+    results: dict[str, Any] = asyncio.run(resolve_surrogates(args.database, args.helix_url, args.batch))
+    for name, value in results.items():
+        print(f"{name:>12} : {value}")
+
+if __name__ == "__main__":
+    main()
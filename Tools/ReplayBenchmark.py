@@ -0,0 +1,468 @@
+"""
+Chat-log replay benchmark for the bot's message path.
+
+Replays recorded or synthetic chat through the real `OllieBot.event_message` and
+`PyramidHandler.handle_pyramids` handlers, with stub messages built without an IRC
+connection, local stand-ins for Helix and the EventSub websocket, and a send transport that discards messages.
+Reports throughput, p50/p99 handler latency and SQLite commits per thousand messages.
+
+Run from the repository root:
+```
+python -m Tools.ReplayBenchmark --channels 20 --messages 100000
+python -m Tools.ReplayBenchmark --log chat.log --output bench_results.jsonl
+```
+
+Logs are read by `Tools.ChatLog`, as raw IRC lines or tab-separated `channel, sender, text[, badges[, user id]]` lines.
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import hashlib
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Iterable, Iterator, Optional
+from aiohttp import web
+import twitchio
+
+from Core.SendScheduler import FakeTransport
+from Tools.ChatLog import ChatLine, read_chat_log
+from OllieBot import OllieBot
+
+__all__ = ("generate_chat",
+           "FakeHelix",
+           "FakeEventSub",
+           "ReplayHarness")
+
+##################################################
+#### Chat sources
+
+_EMOTES: tuple[str, ...] = ("Kappa", "PogChamp", "LUL", "OhMyDog", "KEKW", "PepeHands", "Pog", "monkaS", "EZ", "catJAM")
+_WORDS: tuple[str, ...] = ("hello", "lol", "nice", "what", "is", "this", "gg", "no", "way", "chat", "stream", "the", "play", "clip", "it")
+_COMMANDS: tuple[str, ...] = ("?pyramid_score success", "?pyramid_score failed", "?pyramid_high_scores success", "?hello", "?roulette")
+
+def generate_chat(channels: int = 10,
+                  messages: int = 100_000,
+                  chatters: int = 5_000,
+                  seed: int = 0
+                  ) -> Iterator[ChatLine]:
+    """
+    Generate synthetic multi-channel chat.
+
+    Each channel runs its own script of ordinary chatter, commands, completed pyramids,
+    blocked pyramids, stolen pyramids and raid bursts of emote walls, and the scripts
+    of all channels are interleaved at random.
+    """
+    generator: random.Random = random.Random(seed)
+    channel_names: list[str] = [f"channel{index}" for index in range(channels)]
+    chatter_names: list[str] = [f"chatter{index}" for index in range(chatters)]
+
+    def pyramid(sender: str, emote: str, height: int) -> list[tuple[str, str]]:
+        levels: list[int] = list(range(1, height + 1)) + list(range(height - 1, 0, -1))
+        return [(sender, " ".join([emote] * level)) for level in levels]
+
+    def script() -> Iterator[tuple[str, str, str]]:
+        while True:
+            roll: float = generator.random()
+            sender: str = generator.choice(chatter_names)
+            emote: str = generator.choice(_EMOTES)
+            if roll < 0.80:
+                yield (sender, " ".join(generator.choices(_WORDS + _EMOTES, k=generator.randint(1, 8))), "")
+            elif roll < 0.86:
+                yield (sender, generator.choice(_COMMANDS), "")
+            elif roll < 0.91:
+                yield from ((name, text, "") for name, text in pyramid(sender, emote, generator.randint(3, 5)))
+            elif roll < 0.95:
+                levels: list[tuple[str, str]] = pyramid(sender, emote, generator.randint(3, 5))
+                yield from ((name, text, "") for name, text in levels[:generator.randint(2, len(levels) - 1)])
+                yield (generator.choice(chatter_names), "no pyramids here", "")
+            elif roll < 0.98:
+                levels = pyramid(sender, emote, generator.randint(3, 5))
+                yield from ((name, text, "") for name, text in levels[:-1])
+                yield (generator.choice(chatter_names), emote, "")
+            else:
+                for _ in range(generator.randint(30, 100)):
+                    yield (generator.choice(chatter_names), " ".join([emote] * generator.randint(1, 6)), "subscriber/12")
+
+    scripts: list[Iterator[tuple[str, str, str]]] = [script() for _ in channel_names]
+    for _ in range(messages):
+        index: int = generator.randrange(channels)
+        sender, text, badges = next(scripts[index])
+        yield ChatLine(channel_names[index], sender, text, badges)
+
+##################################################
+#### Stand-ins
+
+class FakeHelix:
+    """
+    A local stand-in for the Helix endpoints the bot uses.
+
+    `/streams` reports every channel as live unless it is in `offline`, after waiting `streams_delay` seconds,
+    `/users` gives every login an id, EventSub subscriptions are accepted and counted, and timeouts and bans are recorded.
+    The global Twitch emotes are the first half of the synthetic chat's emotes, and every channel has the other half.
+    The given number of timeouts and bans are rate limited before any are accepted, until `rate_limit_reset` seconds from then,
+    and those made with any of the `rejected_tokens` are refused as unauthorized.
+    """
+
+    __slots__ = ("__runner",
+                 "url",
+                 "requests",
+                 "subscriptions",
+                 "bans",
+                 "rate_limited",
+                 "rate_limit_reset",
+                 "rejected_tokens",
+                 "offline",
+                 "streams_delay")
+
+    def __init__(self, rate_limited: int = 0, rate_limit_reset: int = 0) -> None:
+        self.__runner: Optional[web.AppRunner] = None
+        self.url: str = ""
+        self.requests: int = 0
+        ## Maps subscription ids to their (type, broadcaster user id).
+        self.subscriptions: dict[str, tuple[str, str]] = {}
+        ## The (broadcaster id, moderator id, user id, duration) of each timeout and ban accepted, the duration is None for bans.
+        self.bans: list[tuple[str, str, str, Optional[int]]] = []
+        self.rate_limited: int = rate_limited
+        self.rate_limit_reset: int = rate_limit_reset
+        self.rejected_tokens: set[str] = set()
+        self.offline: set[str] = set()
+        self.streams_delay: float = 0.0
+
+    async def start(self) -> None:
+        application: web.Application = web.Application()
+        application.router.add_get("/helix/streams", self.__streams)
+        application.router.add_get("/helix/users", self.__users)
+        application.router.add_post("/helix/eventsub/subscriptions", self.__subscribe)
+        application.router.add_delete("/helix/eventsub/subscriptions", self.__unsubscribe)
+        application.router.add_post("/helix/moderation/bans", self.__ban)
+        application.router.add_get("/helix/chat/emotes/global", self.__global_emotes)
+        application.router.add_get("/helix/chat/emotes", self.__channel_emotes)
+        self.__runner = web.AppRunner(application, access_log=None)
+        await self.__runner.setup()
+        site: web.TCPSite = web.TCPSite(self.__runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.__runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/helix"
+
+    async def close(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def __streams(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        ## The channels live when the request arrived, however long the response takes.
+        live: list[str] = [login for login in request.query.getall("user_login", []) if login not in self.offline]
+        if self.streams_delay:
+            await asyncio.sleep(self.streams_delay)
+        return web.json_response({"data" : [{"user_login" : login, "type" : "live"} for login in live]})
+
+    async def __users(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"data" : [{"id" : user_id(login), "login" : login}
+                                            for login in request.query.getall("login", [])]})
+
+    async def __subscribe(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body: dict[str, Any] = await request.json()
+        subscription_id: str = str(len(self.subscriptions) + 1)
+        self.subscriptions[subscription_id] = (body["type"], body["condition"]["broadcaster_user_id"])
+        return web.json_response({"data" : [{"id" : subscription_id, "status" : "enabled", **body}]}, status=202)
+
+    async def __unsubscribe(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.subscriptions.pop(request.query.get("id", ""), None)
+        return web.Response(status=204)
+
+    async def __global_emotes(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"data" : [{"id" : emote, "name" : emote} for emote in _EMOTES[:len(_EMOTES) // 2]]})
+
+    async def __channel_emotes(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"data" : [{"id" : emote, "name" : emote} for emote in _EMOTES[len(_EMOTES) // 2:]]})
+
+    async def __ban(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.rate_limited > 0:
+            self.rate_limited -= 1
+            return web.json_response({"error" : "Too Many Requests", "status" : 429, "message" : ""}, status=429,
+                                     headers={"Ratelimit-Reset" : str(int(time.time()) + self.rate_limit_reset)})
+        if request.headers.get("Authorization", "").removeprefix("Bearer ") in self.rejected_tokens:
+            return web.json_response({"error" : "Unauthorized", "status" : 401, "message" : "Invalid OAuth token"}, status=401)
+        data: dict[str, Any] = (await request.json())["data"]
+        self.bans.append((request.query["broadcaster_id"], request.query["moderator_id"], data["user_id"], data.get("duration")))
+        return web.json_response({"data" : [{"broadcaster_id" : request.query["broadcaster_id"],
+                                             "moderator_id" : request.query["moderator_id"],
+                                             "user_id" : data["user_id"]}]})
+
+def user_id(login: str) -> str:
+    "The user id the stand-ins give a login."
+    return str(int.from_bytes(hashlib.blake2b(login.encode(), digest_size=6).digest(), "big"))
+
+class FakeEventSub:
+    """
+    A local stand-in for the EventSub websocket.
+
+    Every connection is welcomed with a new session, and notifications are pushed to every open connection.
+    """
+
+    __slots__ = ("__runner",
+                 "__websockets",
+                 "__sessions",
+                 "url")
+
+    def __init__(self) -> None:
+        self.__runner: Optional[web.AppRunner] = None
+        self.__websockets: list[web.WebSocketResponse] = []
+        self.__sessions: itertools.count = itertools.count(1)
+        self.url: str = ""
+
+    @property
+    def connections(self) -> int:
+        return len(self.__websockets)
+
+    async def start(self) -> None:
+        application: web.Application = web.Application()
+        application.router.add_get("/ws", self.__connect)
+        self.__runner = web.AppRunner(application, access_log=None)
+        await self.__runner.setup()
+        site: web.TCPSite = web.TCPSite(self.__runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.__runner.addresses[0][:2]
+        self.url = f"ws://{host}:{port}/ws"
+
+    async def close(self) -> None:
+        await self.disconnect()
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def set_online(self, channel_name: str, online: bool) -> None:
+        "Push a stream online or offline notification for a channel."
+        event_type: str = "stream.online" if online else "stream.offline"
+        await self.__send_all("notification", {"subscription" : {"type" : event_type, "version" : "1",
+                                                                 "condition" : {"broadcaster_user_id" : user_id(channel_name)}},
+                                               "event" : {"broadcaster_user_id" : user_id(channel_name),
+                                                          "broadcaster_user_login" : channel_name}})
+
+    async def revoke(self, channel_name: str) -> None:
+        "Revoke a channel's stream online subscription, as when the broadcaster's authorization is withdrawn."
+        await self.__send_all("revocation", {"subscription" : {"type" : "stream.online", "version" : "1",
+                                                               "status" : "authorization_revoked",
+                                                               "condition" : {"broadcaster_user_id" : user_id(channel_name)}}})
+
+    async def reconnect(self) -> None:
+        "Ask every connection to move to a new connection, keeping its subscriptions."
+        await self.__send_all("session_reconnect", {"session" : {"id" : "reconnect", "status" : "reconnecting",
+                                                                 "reconnect_url" : f"{self.url}?reconnect=1"}})
+
+    async def disconnect(self) -> None:
+        "Close every connection, as if the session was lost."
+        for websocket in list(self.__websockets):
+            await websocket.close()
+
+    async def __send_all(self, message_type: str, payload: dict[str, Any]) -> None:
+        for websocket in list(self.__websockets):
+            await websocket.send_json({"metadata" : {"message_id" : str(next(self.__sessions)),
+                                                     "message_type" : message_type,
+                                                     "message_timestamp" : datetime.utcnow().isoformat() + "Z"},
+                                       "payload" : payload})
+
+    async def __connect(self, request: web.Request) -> web.WebSocketResponse:
+        websocket: web.WebSocketResponse = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.__websockets.append(websocket)
+        try:
+            await websocket.send_json({"metadata" : {"message_id" : str(next(self.__sessions)),
+                                                     "message_type" : "session_welcome",
+                                                     "message_timestamp" : datetime.utcnow().isoformat() + "Z"},
+                                       "payload" : {"session" : {"id" : f"session-{next(self.__sessions)}",
+                                                                 "status" : "connected",
+                                                                 "keepalive_timeout_seconds" : 10,
+                                                                 "reconnect_url" : None}}})
+            async for _ in websocket:
+                pass
+        finally:
+            self.__websockets.remove(websocket)
+        return websocket
+
+##################################################
+#### Harness
+
+class ReplayHarness:
+    """
+    Drives chat lines through a real bot instance that is not connected to Twitch.
+
+    The bot uses a scratch copy of the pyramid scores schema, the stand-in Helix endpoint
+    and EventSub websocket, and a send transport that discards every message.
+    Each channel's stream status is polled when its first line is replayed, so every channel starts live.
+    """
+
+    __slots__ = ("__directory",
+                 "__helix",
+                 "eventsub",
+                 "__transport",
+                 "bot",
+                 "__channels",
+                 "message_latencies",
+                 "pyramid_latencies")
+
+    def __init__(self) -> None:
+        self.__directory: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory(prefix="olliebot-bench-")
+        self.__helix: FakeHelix = FakeHelix()
+        self.eventsub: FakeEventSub = FakeEventSub()
+        self.__transport: FakeTransport = FakeTransport(record=False)
+        self.bot: Optional[OllieBot] = None
+        self.__channels: dict[str, twitchio.Channel] = {}
+        self.message_latencies: list[int] = []
+        self.pyramid_latencies: list[int] = []
+
+    @property
+    def helix_requests(self) -> int:
+        return self.__helix.requests
+
+    async def start(self) -> None:
+        "Start the stand-ins and create the bot."
+        await self.__helix.start()
+        await self.eventsub.start()
+        database_path: str = os.path.join(self.__directory.name, "pyramids.sqlite3")
+        self.bot = OllieBot("oauth:benchmark", "benchmark", [],
+                            helix_url=self.__helix.url,
+                            transport=self.__transport,
+                            pyramids_database=database_path,
+                            channels_database=os.path.join(self.__directory.name, "twitch_channels.sqlite3"),
+                            eventsub_url=self.eventsub.url,
+                            emote_cache=os.path.join(self.__directory.name, "emotes.json"),
+                            third_party_emote_urls={},
+                            snapshot_path=os.path.join(self.__directory.name, "warm_state.bin"))
+        await self.bot.stream_status.start()
+
+        ## Time the pyramid handler separately from the whole message path.
+        ## It is loaded up front, so its import is not timed as part of the first message.
+        pyramid_handler = self.bot.cog_loader.load("PyramidHandler")
+        handle_pyramids = pyramid_handler.handle_pyramids
+        pyramid_latencies: list[int] = self.pyramid_latencies
+        async def timed_handle_pyramids(message: twitchio.Message) -> None:
+            start: int = time.perf_counter_ns()
+            await handle_pyramids(message)
+            pyramid_latencies.append(time.perf_counter_ns() - start)
+        pyramid_handler.handle_pyramids = timed_handle_pyramids
+
+    async def close(self) -> None:
+        if self.bot is not None:
+            await self.bot.close_services(send_timeout=0.0)
+        await self.eventsub.close()
+        await self.__helix.close()
+        self.__directory.cleanup()
+
+    def make_message(self, line: ChatLine) -> twitchio.Message:
+        "Build a stub message for a chat line, as twitchio would for a PRIVMSG."
+        channel: Optional[twitchio.Channel] = self.__channels.get(line.channel)
+        if channel is None:
+            channel = self.__channels[line.channel] = twitchio.Channel(name=line.channel, websocket=self.bot._connection)
+            self.bot.send_scheduler.set_moderator(line.channel, True)
+        tags: dict[str, str] = {"badges" : line.badges,
+                                "subscriber" : "1" if "subscriber" in line.badges else "0",
+                                "mod" : "1" if "moderator" in line.badges else "0",
+                                "display-name" : line.sender,
+                                "color" : "",
+                                "user-id" : line.user_id or user_id(line.sender),
+                                "emotes" : line.emotes,
+                                "room-id" : line.channel,
+                                "tmi-sent-ts" : str(int(time.time() * 1000))}
+        author = twitchio.Chatter(tags=tags, name=line.sender, channel=channel, bot=self.bot, websocket=self.bot._connection)
+        return twitchio.Message(content=line.text, author=author, channel=channel, tags=tags, raw_data="", echo=False)
+
+    async def replay(self, lines: Iterable[ChatLine]) -> int:
+        "Replay chat lines through the bot's message handler, returning the number replayed."
+        count: int = 0
+        event_message = self.bot.event_message
+        ingest = self.bot.ingest
+        latencies: list[int] = self.message_latencies
+        for line in lines:
+            if line.channel not in self.__channels:
+                self.bot.stream_status.track([line.channel])
+                await self.bot.stream_status.refresh([line.channel])
+                self.bot.emotes.track([line.channel])
+                await self.bot.emotes.refresh([line.channel])
+            message: twitchio.Message = self.make_message(line)
+            start: int = time.perf_counter_ns()
+            await event_message(message)
+            ## Messages are only queued on receipt, wait for each to be handled so its latency covers the whole message path,
+            ## and the replay never falls far enough behind for messages to be shed.
+            await ingest.join()
+            latencies.append(time.perf_counter_ns() - start)
+            count += 1
+            ## Let the send scheduler and Helix lookups run, as the IRC reader would between messages.
+            if not count % 64:
+                await asyncio.sleep(0)
+        return count
+
+def percentile(samples: list[int], fraction: float) -> float:
+    "Get a percentile of a list of nanosecond samples, in microseconds."
+    if not samples:
+        return 0.0
+    ordered: list[int] = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] / 1000.0
+
+async def run_benchmark(lines: Iterable[ChatLine], label: str = "") -> dict[str, Any]:
+    "Replay chat lines through a fresh harness and report its measurements."
+    harness: ReplayHarness = ReplayHarness()
+    await harness.start()
+    try:
+        start: float = time.perf_counter()
+        count: int = await harness.replay(lines)
+        elapsed: float = time.perf_counter() - start
+        pyramid_handler = harness.bot.cog_loader.get("PyramidHandler")
+        scheduler = harness.bot.send_scheduler
+        sent, dropped = scheduler.sent, scheduler.dropped
+        shed: int = harness.bot.ingest.shed
+    finally:
+        await harness.close()
+    ## Scores still queued at the end of the replay are committed on close.
+    commits: int = pyramid_handler.commits
+    return {"label" : label,
+            "time" : datetime.now().isoformat(timespec="seconds"),
+            "messages" : count,
+            "seconds" : round(elapsed, 3),
+            "messages_per_second" : round(count / elapsed, 1) if elapsed else 0.0,
+            "event_message_p50_us" : percentile(harness.message_latencies, 0.50),
+            "event_message_p99_us" : percentile(harness.message_latencies, 0.99),
+            "handle_pyramids_p50_us" : percentile(harness.pyramid_latencies, 0.50),
+            "handle_pyramids_p99_us" : percentile(harness.pyramid_latencies, 0.99),
+            "sqlite_commits" : commits,
+            "sqlite_commits_per_1k" : round(commits * 1000 / count, 3) if count else 0.0,
+            "helix_requests" : harness.helix_requests,
+            "messages_sent" : sent,
+            "messages_dropped" : dropped,
+            "messages_shed" : shed}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay chat through the bot's message path and measure it.")
+    parser.add_argument("--log", type=str, default=None, help="A recorded chat log to replay, instead of synthetic chat.")
+    parser.add_argument("--channels", type=int, default=10, help="The number of synthetic channels.")
+    parser.add_argument("--messages", type=int, default=100_000, help="The number of synthetic messages.")
+    parser.add_argument("--chatters", type=int, default=5_000, help="The number of distinct synthetic chatters.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic chat generator.")
+    parser.add_argument("--label", type=str, default="", help="A label recorded with the results, such as a commit hash.")
+    parser.add_argument("--output", type=str, default=None, help="A JSON lines file to append the results to.")
+    args = parser.parse_args()
+
+    lines: Iterable[ChatLine]
+    if args.log is not None:
+        lines = read_chat_log(args.log)
+    else: lines = generate_chat(args.channels, args.messages, args.chatters, args.seed)
+
+    results: dict[str, Any] = asyncio.run(run_benchmark(lines, args.label))
+    for name, value in results.items():
+        print(f"{name:>24} : {value}")
+    if args.output is not None:
+        with open(args.output, "a", encoding="utf-8") as output_file:
+            output_file.write(json.dumps(results) + "\n")
+
+if __name__ == "__main__":
+    main()
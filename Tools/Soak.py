@@ -0,0 +1,203 @@
+"""
+Long-running soak test of the bot's message path, for finding memory that grows without bound.
+
+Drives the replay harness of `Tools.ReplayBenchmark` through hours of synthetic multi-channel chat,
+replayed as fast as the bot handles it. After a warm-up interval, which lets caches fill to their working size,
+a `tracemalloc` snapshot is taken as the baseline, then every interval the resident memory is measured and
+compared against the budget, and a snapshot is compared against the baseline to find the allocation sites that grew.
+Resident memory is budgeted per channel, as the growth since the bot was created divided by the number of channels,
+and the soak fails as soon as it goes over the budget.
+
+Chat is replayed faster than real time, so anything that expires on the wall clock, such as idle pyramid state,
+sees far less time pass than the chat simulates. Tracing allocations slows the replay down several times,
+the memory holding the traces is left out of the resident memory compared against the budget, but tracing
+still inflates it somewhat, so budgets are best set for the mode they are run in. Tracing is turned off with `--frames 0`.
+
+Run from the repository root:
+```
+python -m Tools.Soak --hours 2 --channels 50
+python -m Tools.Soak --hours 8 --channels 200 --interval 100000 --budget-kib 512 --output soak_results.jsonl
+```
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import gc
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Any, Iterator, Optional
+
+from Tools.ChatLog import ChatLine
+from Tools.ReplayBenchmark import ReplayHarness, generate_chat, percentile
+
+__all__ = ("resident_memory",
+           "site_sizes",
+           "growth_sites",
+           "run_soak")
+
+## Allocations made by the tracing and importing machinery are not the bot's.
+_SNAPSHOT_FILTERS: tuple[tracemalloc.Filter, ...] = (tracemalloc.Filter(False, tracemalloc.__file__),
+                                                     tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                                                     tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                                                     tracemalloc.Filter(False, "<unknown>"))
+
+def resident_memory() -> int:
+    "Get the resident memory of this process in bytes, or its peak resident memory where the current is not available."
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        ## The peak is in kilobytes on Linux, and bytes on macOS.
+        peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def site_sizes(snapshot: tracemalloc.Snapshot) -> dict[tracemalloc.Traceback, tuple[int, int]]:
+    """
+    Get the traced bytes and blocks allocated at each site of a snapshot.
+
+    This is all that is kept of the baseline snapshot, which would otherwise hold a trace of every
+    allocated block for the whole soak, and be counted in the resident memory being measured.
+    """
+    return {statistic.traceback : (statistic.size, statistic.count) for statistic in snapshot.statistics("traceback")}
+
+def growth_sites(baseline: dict[tracemalloc.Traceback, tuple[int, int]],
+                 snapshot: tracemalloc.Snapshot,
+                 top: int = 10
+                 ) -> list[dict[str, Any]]:
+    "Get the allocation sites whose traced memory grew the most since the baseline, largest growth first."
+    growth: list[tuple[int, int, int, tracemalloc.Traceback]] = []
+    for statistic in snapshot.statistics("traceback"):
+        size, count = baseline.get(statistic.traceback, (0, 0))
+        if statistic.size > size:
+            growth.append((statistic.size - size, statistic.count - count, statistic.size, statistic.traceback))
+    growth.sort(key=lambda site: site[0], reverse=True)
+    return [{"site" : " <- ".join(f"{frame.filename}:{frame.lineno}" for frame in traceback),
+             "growth_kib" : round(size_diff / 1024, 1),
+             "blocks_growth" : count_diff,
+             "size_kib" : round(size / 1024, 1)}
+            for size_diff, count_diff, size, traceback in growth[:top]]
+
+async def run_soak(lines: Iterator[ChatLine],
+                   channels: int,
+                   interval: int = 50_000,
+                   budget_kib: float = 2048.0,
+                   frames: int = 1,
+                   top: int = 10
+                   ) -> dict[str, Any]:
+    """
+    Replay chat lines through a fresh harness in intervals, measuring memory after each, and return a summary of the soak.
+
+    Parameters
+    ----------
+    `channels: int` - The number of channels the chat is spread over, which the budget is divided between.
+
+    `interval: int = 50_000` - The number of messages replayed between measurements, the first is the warm-up.
+
+    `budget_kib: float = 2048.0` - The most resident memory each channel may grow by, in kibibytes.
+
+    `frames: int = 1` - The number of frames traced for each allocation, zero does not trace allocations.
+
+    `top: int = 10` - The number of growing allocation sites reported.
+    """
+    if frames > 0:
+        tracemalloc.start(frames)
+    harness: ReplayHarness = ReplayHarness()
+    await harness.start()
+    gc.collect()
+    rss_start: int = resident_memory() - (tracemalloc.get_tracemalloc_memory() if frames > 0 else 0)
+    baseline: Optional[dict[tracemalloc.Traceback, tuple[int, int]]] = None
+    intervals: list[dict[str, Any]] = []
+    replayed: int = 0
+    start: float = time.perf_counter()
+    over_budget: bool = False
+    try:
+        while True:
+            interval_start: float = time.perf_counter()
+            count: int = await harness.replay(itertools.islice(lines, interval))
+            if not count:
+                break
+            replayed += count
+            interval_seconds: float = time.perf_counter() - interval_start
+            ## The harness keeps every latency sample, which would otherwise be the largest growth of all.
+            p99_us: float = percentile(harness.message_latencies, 0.99)
+            harness.message_latencies.clear()
+            harness.pyramid_latencies.clear()
+
+            gc.collect()
+            rss: int = resident_memory() - (tracemalloc.get_tracemalloc_memory() if frames > 0 else 0)
+            rss_per_channel_kib: float = (rss - rss_start) / channels / 1024
+            result: dict[str, Any] = {"messages" : replayed,
+                                      "seconds" : round(time.perf_counter() - start, 1),
+                                      "messages_per_second" : round(count / interval_seconds, 1) if interval_seconds else 0.0,
+                                      "event_message_p99_us" : p99_us,
+                                      "rss_mib" : round(rss / 1024 ** 2, 1),
+                                      "rss_per_channel_kib" : round(rss_per_channel_kib, 1)}
+            if frames > 0:
+                snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+                result["traced_mib"] = round(tracemalloc.get_traced_memory()[0] / 1024 ** 2, 1)
+                if baseline is None:
+                    baseline = site_sizes(snapshot)
+                else: result["top_growth"] = growth_sites(baseline, snapshot, top)
+                del snapshot
+            intervals.append(result)
+            print(f"{replayed:>12,} messages | {result['messages_per_second']:>9,.0f} msg/s"
+                  + f" | RSS {result['rss_mib']:>7.1f}MiB, {rss_per_channel_kib:>8.1f}KiB per channel"
+                  + (f" | traced {result['traced_mib']:>7.1f}MiB" if frames > 0 else "")
+                  + (f" | top growth {result['top_growth'][0]['growth_kib']:.1f}KiB at {result['top_growth'][0]['site']}"
+                     if result.get("top_growth") else ""))
+            if rss_per_channel_kib > budget_kib:
+                over_budget = True
+                break
+    finally:
+        await harness.close()
+        if frames > 0:
+            tracemalloc.stop()
+
+    return {"time" : datetime.now().isoformat(timespec="seconds"),
+            "messages" : replayed,
+            "channels" : channels,
+            "seconds" : round(time.perf_counter() - start, 1),
+            "budget_kib" : budget_kib,
+            "over_budget" : over_budget,
+            "rss_per_channel_kib" : intervals[-1]["rss_per_channel_kib"] if intervals else 0.0,
+            "top_growth" : intervals[-1].get("top_growth", []) if intervals else [],
+            "intervals" : intervals}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Soak the bot's message path in synthetic chat and detect memory growth.")
+    parser.add_argument("--hours", type=float, default=2.0, help="The hours of chat to simulate.")
+    parser.add_argument("--rate", type=float, default=5.0, help="The messages per second simulated in each channel.")
+    parser.add_argument("--channels", type=int, default=50, help="The number of synthetic channels.")
+    parser.add_argument("--chatters", type=int, default=20_000, help="The number of distinct synthetic chatters.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic chat generator.")
+    parser.add_argument("--interval", type=int, default=50_000, help="The number of messages replayed between measurements.")
+    parser.add_argument("--budget-kib", type=float, default=2048.0, help="The most resident memory each channel may grow by, in kibibytes.")
+    parser.add_argument("--frames", type=int, default=1, help="The number of frames traced for each allocation, zero does not trace.")
+    parser.add_argument("--top", type=int, default=10, help="The number of growing allocation sites reported.")
+    parser.add_argument("--output", type=str, default=None, help="A JSON lines file to append the results to.")
+    args = parser.parse_args()
+
+    messages: int = int(args.hours * 3600 * args.rate * args.channels)
+    print(f"Simulating {args.hours:g} hours of chat in {args.channels} channels, {messages:,} messages")
+    results: dict[str, Any] = asyncio.run(run_soak(generate_chat(args.channels, messages, args.chatters, args.seed),
+                                                   args.channels, args.interval, args.budget_kib, args.frames, args.top))
+    if results["top_growth"]:
+        print("Top growing allocation sites since the warm-up:")
+        for site in results["top_growth"]:
+            print(f"{site['growth_kib']:>12,.1f}KiB {site['blocks_growth']:>+10,} blocks : {site['site']}")
+    if args.output is not None:
+        with open(args.output, "a", encoding="utf-8") as output_file:
+            output_file.write(json.dumps(results) + "\n")
+    if results["over_budget"]:
+        print(f"Failed: resident memory grew by {results['rss_per_channel_kib']:.1f}KiB per channel, over the budget of {args.budget_kib:g}KiB")
+        sys.exit(1)
+    print(f"Passed: resident memory grew by {results['rss_per_channel_kib']:.1f}KiB per channel, within the budget of {args.budget_kib:g}KiB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Any, Callable, Optional
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+from Core.ChannelJoiner import ChannelCredentials, ChannelJoiner, ChannelRegistry, OAuthClient
+from Core.Helix import HelixClient
+from Tools.ReplayBenchmark import user_id
+
+async def wait_until(condition: Callable[[], bool], timeout: float = 5.0) -> None:
+    "Wait for a condition to hold, failing the test if it does not within the timeout."
+    deadline: float = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "Timed out waiting for the condition."
+        await asyncio.sleep(0.01)
+
+def free_port() -> int:
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+class FakeOAuth:
+    """
+    A local stand-in for the Twitch OAuth endpoints.
+
+    Every authorization code is granted tokens for the channel the code names, and refresh tokens are always accepted.
+    If `malformed` is set, token responses are missing their refresh token and expiry.
+    """
+
+    def __init__(self, expires_in: int = 14400) -> None:
+        self.__runner: Optional[web.AppRunner] = None
+        self.url: str = ""
+        self.expires_in: int = expires_in
+        self.malformed: bool = False
+        self.refreshes: int = 0
+
+    async def start(self) -> None:
+        application: web.Application = web.Application()
+        application.router.add_post("/oauth2/token", self.__token)
+        application.router.add_get("/oauth2/validate", self.__validate)
+        self.__runner = web.AppRunner(application, access_log=None)
+        await self.__runner.setup()
+        site: web.TCPSite = web.TCPSite(self.__runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.__runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/oauth2"
+
+    async def close(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def __token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if form["grant_type"] == "refresh_token":
+            self.refreshes += 1
+            login: str = str(form["refresh_token"]).removeprefix("refresh-")
+        else: login = str(form["code"])
+        if self.malformed:
+            return web.json_response({"access_token" : f"access-{login}"})
+        return web.json_response({"access_token" : f"access-{login}-{self.refreshes}",
+                                  "refresh_token" : f"refresh-{login}",
+                                  "expires_in" : self.expires_in,
+                                  "token_type" : "bearer"})
+
+    async def __validate(self, request: web.Request) -> web.Response:
+        login: str = request.headers["Authorization"].removeprefix("OAuth access-").rpartition("-")[0]
+        return web.json_response({"client_id" : "client", "login" : login, "user_id" : user_id(login), "expires_in" : self.expires_in})
+
+class FakeChannel:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+
+class FakeBot:
+    "Stands in for the bot's IRC connection, recording the channels it is asked to join."
+
+    def __init__(self) -> None:
+        ## The monotonic time and channel names of each join.
+        self.joins: list[tuple[float, list[str]]] = []
+        self.connected_channels: list[FakeChannel] = []
+
+    async def join_channels(self, channel_names: list[str]) -> None:
+        self.joins.append((time.monotonic(), list(channel_names)))
+        self.connected_channels.extend(FakeChannel(channel_name) for channel_name in channel_names)
+
+    @property
+    def joined(self) -> list[str]:
+        return [channel.name for channel in self.connected_channels]
+
+class StandIns:
+    "The OAuth stand-in, a bot recording its joins, and a channel joiner listening on a free port."
+
+    def __init__(self, database_path: str, **joiner_options: Any) -> None:
+        self.database_path: str = database_path
+        self.joiner_options: dict[str, Any] = joiner_options
+        self.oauth: FakeOAuth = FakeOAuth()
+        self.bot: FakeBot = FakeBot()
+        ## The port the joiner listens on, or None for a joiner that only reads credentials.
+        self.port: Optional[int] = free_port()
+
+    async def __aenter__(self) -> "StandIns":
+        await self.oauth.start()
+        self.helix: HelixClient = HelixClient("client", "token")
+        self.joiner: ChannelJoiner = ChannelJoiner(self.bot,
+                                                   ChannelRegistry(self.database_path),
+                                                   OAuthClient(self.helix, "secret", "http://localhost/callback", self.oauth.url),
+                                                   self.port, "127.0.0.1", **self.joiner_options)
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.joiner.close()
+        await self.helix.close()
+        await self.oauth.close()
+
+    async def authorize(self, session: aiohttp.ClientSession) -> str:
+        "Visit the joiner's authorize page, and return the state it sent the owner to Twitch with."
+        async with session.get(f"http://127.0.0.1:{self.port}/authorize", allow_redirects=False) as response:
+            assert response.status == 302
+            location: URL = URL(response.headers["Location"])
+        assert str(location.with_query(None)) == f"{self.oauth.url}/authorize"
+        assert location.query["client_id"] == "client"
+        return location.query["state"]
+
+    async def callback(self, session: aiohttp.ClientSession, **query: str) -> tuple[int, str]:
+        "Redirect back to the joiner's callback, and return the status and text of its page."
+        async with session.get(f"http://127.0.0.1:{self.port}/callback", params=query) as response:
+            return (response.status, await response.text())
+
+def test_callback_saves_and_joins_channel(tmp_path) -> None:
+    async def scenario() -> None:
+        database_path: str = os.path.join(tmp_path, "channels.sqlite3")
+        async with StandIns(database_path) as stand_ins:
+            await stand_ins.joiner.start()
+            async with aiohttp.ClientSession() as session:
+                state: str = await stand_ins.authorize(session)
+                status, text = await stand_ins.callback(session, code="newchannel", state=state)
+                assert (status, text) == (200, "OllieBot will join newchannel shortly.")
+                ## A state is only used once.
+                status, _ = await stand_ins.callback(session, code="newchannel", state=state)
+                assert status == 400
+            await wait_until(lambda: stand_ins.bot.joined == ["newchannel"])
+
+            credentials: Optional[ChannelCredentials] = stand_ins.joiner.credentials("NewChannel")
+            assert credentials is not None
+            assert credentials.owner_id == user_id("newchannel")
+            assert credentials.access_token == "access-newchannel-0"
+            assert credentials.expires_at > time.time() + 14000
+
+        registry: ChannelRegistry = ChannelRegistry(database_path)
+        saved: list[ChannelCredentials] = registry.load_enabled()
+        registry.close()
+        assert [(credentials.channel_name, credentials.owner_id, credentials.access_token, credentials.refresh_token, credentials.tokens_valid)
+                for credentials in saved] == [("newchannel", user_id("newchannel"), "access-newchannel-0", "refresh-newchannel", True)]
+    asyncio.run(scenario())
+
+def test_callback_rejects_bad_requests(tmp_path) -> None:
+    async def scenario() -> None:
+        async with StandIns(os.path.join(tmp_path, "channels.sqlite3")) as stand_ins:
+            await stand_ins.joiner.start()
+            async with aiohttp.ClientSession() as session:
+                status, _ = await stand_ins.callback(session, code="newchannel", state="unknown")
+                assert status == 400
+                status, text = await stand_ins.callback(session, state=await stand_ins.authorize(session),
+                                                        error="access_denied", error_description="The user denied you access")
+                assert (status, text) == (400, "Authorization was not granted: The user denied you access.")
+
+                ## A token response missing fields is rejected, rather than failing with a server error.
+                stand_ins.oauth.malformed = True
+                status, _ = await stand_ins.callback(session, code="newchannel", state=await stand_ins.authorize(session))
+                assert status == 400
+            await asyncio.sleep(0.1)
+            assert stand_ins.bot.joins == []
+            assert stand_ins.joiner.credentials("newchannel") is None
+    asyncio.run(scenario())
+
+def test_registered_channels_are_joined_within_the_rate_limit(tmp_path) -> None:
+    async def scenario() -> None:
+        database_path: str = os.path.join(tmp_path, "channels.sqlite3")
+        registry: ChannelRegistry = ChannelRegistry(database_path)
+        for index in range(5):
+            registry.save(ChannelCredentials(f"channel{index}", user_id(f"channel{index}"), "access", "refresh", time.time() + 14400))
+        registry.close()
+
+        async with StandIns(database_path, join_limit=(2, 0.4)) as stand_ins:
+            await stand_ins.joiner.start(join_registered=True)
+            await wait_until(lambda: len(stand_ins.bot.joined) == 5)
+            assert sorted(stand_ins.bot.joined) == [f"channel{index}" for index in range(5)]
+            ## The first two channels are joined at once, then one as each token refills.
+            assert [len(channel_names) for _, channel_names in stand_ins.bot.joins] == [2, 1, 1, 1]
+            assert stand_ins.bot.joins[-1][0] - stand_ins.bot.joins[0][0] >= 0.5
+    asyncio.run(scenario())
+
+def test_expiring_tokens_are_refreshed(tmp_path) -> None:
+    async def scenario() -> None:
+        database_path: str = os.path.join(tmp_path, "channels.sqlite3")
+        registry: ChannelRegistry = ChannelRegistry(database_path)
+        registry.save(ChannelCredentials("expiring", user_id("expiring"), "access-expiring", "refresh-expiring", time.time() + 60))
+        registry.save(ChannelCredentials("fresh", user_id("fresh"), "access-fresh", "refresh-fresh", time.time() + 14400))
+        registry.close()
+
+        async with StandIns(database_path) as stand_ins:
+            await stand_ins.joiner.start()
+            await wait_until(lambda: stand_ins.oauth.refreshes == 1)
+            await wait_until(lambda: stand_ins.joiner.credentials("expiring").access_token == "access-expiring-1")
+            assert stand_ins.joiner.credentials("expiring").expires_at > time.time() + 14000
+            assert stand_ins.joiner.credentials("fresh").access_token == "access-fresh"
+            ## Onboarded channels are not joined unless asked.
+            assert stand_ins.bot.joins == []
+
+        registry = ChannelRegistry(database_path)
+        saved: dict[str, ChannelCredentials] = {credentials.channel_name : credentials for credentials in registry.load_enabled()}
+        registry.close()
+        assert saved["expiring"].access_token == "access-expiring-1"
+    asyncio.run(scenario())
+
+def test_malformed_refresh_keeps_tokens(tmp_path) -> None:
+    async def scenario() -> None:
+        database_path: str = os.path.join(tmp_path, "channels.sqlite3")
+        registry: ChannelRegistry = ChannelRegistry(database_path)
+        registry.save(ChannelCredentials("expiring", user_id("expiring"), "access-expiring", "refresh-expiring", time.time() + 60))
+        registry.close()
+
+        async with StandIns(database_path) as stand_ins:
+            stand_ins.oauth.malformed = True
+            await stand_ins.joiner.start()
+            await wait_until(lambda: stand_ins.oauth.refreshes == 1)
+            await asyncio.sleep(0.1)
+            credentials: ChannelCredentials = stand_ins.joiner.credentials("expiring")
+            ## The refresh is retried on the next pass, so the current tokens are kept and still valid.
+            assert (credentials.access_token, credentials.refresh_token, credentials.tokens_valid) == ("access-expiring", "refresh-expiring", True)
+            stand_ins.oauth.malformed = False
+            await wait_until(lambda: credentials.access_token == "access-expiring-2", timeout=10.0)
+    asyncio.run(scenario())
+
+def test_onboarding_without_joining(tmp_path) -> None:
+    async def scenario() -> None:
+        database_path: str = os.path.join(tmp_path, "channels.sqlite3")
+        async with StandIns(database_path, join=False) as stand_ins:
+            await stand_ins.joiner.start()
+            async with aiohttp.ClientSession() as session:
+                status, _ = await stand_ins.callback(session, code="newchannel", state=await stand_ins.authorize(session))
+                assert status == 200
+            await asyncio.sleep(0.1)
+            ## The channel is saved for a supervisor to assign, and its owner's token is usable at once.
+            assert stand_ins.bot.joins == []
+            assert stand_ins.joiner.broadcaster_token("newchannel") == (int(user_id("newchannel")), "access-newchannel-0")
+
+        ## A worker that does not onboard channels reads their credentials from the registry.
+        reader: StandIns = StandIns(database_path)
+        reader.port = None
+        async with reader:
+            await reader.joiner.start()
+            assert reader.joiner.broadcaster_token("newchannel") == (int(user_id("newchannel")), "access-newchannel-0")
+    asyncio.run(scenario())
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Iterable, Optional
+
+import pytest
+
+from Core.Chatters import ChatterCache
+from Core.Helix import HelixError
+from Tools.ReplayBenchmark import user_id
+
+class FlakyHelix:
+    "Stands in for the Helix client's user lookups, failing the given number of requests with the given status first."
+
+    def __init__(self, failures: int = 0, status: int = 503) -> None:
+        self.failures: int = failures
+        self.status: int = status
+        ## The logins of each request made.
+        self.requests: list[list[str]] = []
+
+    async def get_user_ids(self, user_logins: Iterable[str]) -> dict[str, str]:
+        logins: list[str] = list(user_logins)
+        self.requests.append(logins)
+        await asyncio.sleep(0.05)
+        if self.failures:
+            self.failures -= 1
+            raise HelixError("Service Unavailable", self.status, "Try again later")
+        return {login : user_id(login) for login in logins if login != "deleted"}
+
+def test_concurrent_lookups_are_one_request() -> None:
+    async def scenario() -> None:
+        helix: FlakyHelix = FlakyHelix()
+        chatters: ChatterCache = ChatterCache(helix)
+        first: asyncio.Task = asyncio.get_running_loop().create_task(chatters.resolve_one("alpha"))
+        await asyncio.sleep(0.01)
+        ## Made while the first lookup is in flight, so only the new names are sent, together.
+        user_ids: list[Optional[int]] = await asyncio.gather(*(chatters.resolve_one(name) for name in ("Alpha", "beta", "deleted", "beta")))
+        assert user_ids == [int(user_id("alpha")), int(user_id("beta")), None, int(user_id("beta"))]
+        assert await first == int(user_id("alpha"))
+        assert [sorted(logins) for logins in helix.requests] == [["alpha"], ["beta", "deleted"]]
+        assert chatters.get_id("beta") == int(user_id("beta"))
+    asyncio.run(scenario())
+
+def test_temporary_failures_are_retried() -> None:
+    async def scenario() -> None:
+        helix: FlakyHelix = FlakyHelix(failures=2)
+        chatters: ChatterCache = ChatterCache(helix, max_retries=2, backoff=0.01)
+        assert await chatters.resolve_one("alpha") == int(user_id("alpha"))
+        assert len(helix.requests) == 3
+
+        ## A lookup still failing after its retries is reported, rather than taken for a chatter that does not exist.
+        helix.failures = 3
+        with pytest.raises(HelixError):
+            await chatters.resolve_one("beta")
+        assert len(helix.requests) == 6
+
+        ## Other failures would fail again, so are not retried.
+        helix.failures, helix.status = 1, 400
+        with pytest.raises(HelixError):
+            await chatters.resolve_one("gamma")
+        assert len(helix.requests) == 7
+        assert await chatters.resolve_one("gamma") == int(user_id("gamma"))
+    asyncio.run(scenario())
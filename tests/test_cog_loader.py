@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+import sys
+from typing import Any
+
+from Core.CogLoader import CogLoader
+
+COG_SOURCE: str = '''
+import asyncio
+
+class ReloadableCog:
+    commands: dict = {}
+
+    def __init__(self, bot, generation=0):
+        self.bot = bot
+        self.generation = generation
+
+    async def prepare_unload(self):
+        self.bot.events.append(("prepare", self.generation))
+        await asyncio.sleep(0.1)
+        self.bot.events.append(("prepared", self.generation))
+
+    def cog_unload(self):
+        self.bot.events.append(("unload", self.generation))
+'''
+
+class FakeBot:
+    "Stands in for the bot, keeping its cogs by name and recording what happens to them."
+
+    def __init__(self) -> None:
+        self.cogs: dict[str, Any] = {}
+        self.events: list[tuple[str, int]] = []
+
+    def add_cog(self, cog: Any) -> None:
+        self.cogs[type(cog).__name__] = cog
+
+    def remove_cog(self, cog_name: str) -> None:
+        self.cogs.pop(cog_name).cog_unload()
+
+def test_reload_awaits_prepare_unload(tmp_path, monkeypatch) -> None:
+    with open(os.path.join(tmp_path, "reloadable_cog.py"), "w", encoding="utf-8") as module_file:
+        module_file.write(COG_SOURCE)
+    manifest_path: str = os.path.join(tmp_path, "manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump({"cogs" : [{"class" : "ReloadableCog", "module" : "reloadable_cog", "module_name" : "Reloadable"}]}, manifest_file)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "reloadable_cog", raising=False)
+
+    async def scenario() -> None:
+        bot: FakeBot = FakeBot()
+        loader: CogLoader = CogLoader(bot, manifest_path)
+        generations: list[int] = [0]
+        loader.configure("ReloadableCog", lambda: {"generation" : generations[-1]})
+        loader.load("ReloadableCog")
+
+        ## The event loop keeps running while the old cog prepares to unload.
+        ticks: int = 0
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        ticker: asyncio.Task = asyncio.get_running_loop().create_task(tick())
+        generations.append(1)
+        cog: Any = await loader.reload("ReloadableCog")
+        ticker.cancel()
+        assert ticks >= 5
+        assert cog.generation == 1 and loader.get("ReloadableCog") is cog
+        assert bot.events == [("prepare", 0), ("prepared", 0), ("unload", 0)]
+        loader.close()
+        assert bot.events[-1] == ("unload", 1)
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import asyncio
+import os
+from typing import Any, Optional
+
+import pytest
+
+from Cogs.OllieBotCog import OllieBotCog
+from Core.ChannelConfig import ChannelConfigStore
+
+class VariablesCog(OllieBotCog):
+    @classmethod
+    def module_name(cls) -> str:
+        return "variables"
+
+    @classmethod
+    def module_modes(cls) -> dict[str, bool]:
+        return {}
+
+    @classmethod
+    def module_variables(cls) -> dict[str, Any]:
+        return {"duration" : 600, "enabled" : True, "greeting" : "hello", "limit" : 5}
+
+    @classmethod
+    def module_variable_bounds(cls) -> dict[str, tuple[Optional[float], Optional[float]]]:
+        return {"duration" : (1, 1209600), "limit" : (None, 10)}
+
+class FakeBot:
+    def __init__(self, database_path: str) -> None:
+        self.channel_config: ChannelConfigStore = ChannelConfigStore(database_path)
+
+def test_variables_are_checked_against_their_type_and_bounds(tmp_path) -> None:
+    async def scenario() -> None:
+        bot: FakeBot = FakeBot(os.path.join(tmp_path, "channels.sqlite3"))
+        cog: VariablesCog = VariablesCog(bot)
+        try:
+            await cog.set_var("channel", "duration", "1209600")
+            await cog.set_var("channel", "enabled", "off")
+            await cog.set_var("channel", "greeting", "1")
+            await cog.set_var("channel", "limit", "-3")
+            assert [await cog.get_var("channel", var_name) for var_name in ("duration", "enabled", "greeting", "limit")] == [1209600, False, "1", -3]
+
+            for var_name, value, error in (("duration", "0", "Expected 1 to 1209600, got 0."),
+                                           ("duration", "-60", "Expected 1 to 1209600, got -60."),
+                                           ("duration", "1209601", "Expected 1 to 1209600, got 1209601."),
+                                           ("duration", "ten", "Expected a whole number, got \"ten\"."),
+                                           ("duration", True, "Expected a whole number, got \"True\"."),
+                                           ("enabled", "maybe", "Expected on or off, got \"maybe\"."),
+                                           ("limit", "11", "Expected at most 10, got 11.")):
+                with pytest.raises(ValueError) as raised:
+                    await cog.set_var("channel", var_name, value)
+                assert str(raised.value) == error
+            ## A rejected value leaves the variable as it was.
+            assert await cog.get_var("channel", "duration") == 1209600
+            with pytest.raises(KeyError):
+                await cog.set_var("channel", "unknown", "1")
+        finally:
+            bot.channel_config.close()
+    asyncio.run(scenario())
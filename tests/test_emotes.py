@@ -0,0 +1,35 @@
+import json
+import os
+from typing import Any, Optional
+
+from Core.Emotes import load_emote_sets
+from Core.Supervisor import _worker_path
+
+def write_cache(cache_path: str, global_emotes: Optional[tuple[float, list[str]]], channel_emotes: dict[str, tuple[float, list[str]]]) -> None:
+    cache: dict[str, Any] = {"global" : None if global_emotes is None else {"updated" : global_emotes[0], "emotes" : global_emotes[1]},
+                             "channels" : {channel_name : {"updated" : updated, "emotes" : emotes}
+                                           for channel_name, (updated, emotes) in channel_emotes.items()}}
+    with open(cache_path, "w", encoding="utf-8") as cache_file:
+        json.dump(cache, cache_file)
+
+def test_worker_caches_are_merged(tmp_path) -> None:
+    cache_path: str = os.path.join(tmp_path, "emotes.json")
+    assert _worker_path(cache_path, 1) == os.path.join(tmp_path, "emotes.1.json")
+    ## A cache left from a bot run alone, and one per supervised worker.
+    write_cache(cache_path, (100.0, ["Kappa"]), {"alpha" : (100.0, ["old"]), "gamma" : (100.0, ["gammaEmote"])})
+    write_cache(_worker_path(cache_path, 0), (300.0, ["Kappa", "LUL"]), {"alpha" : (300.0, ["new"])})
+    write_cache(_worker_path(cache_path, 1), None, {"beta" : (200.0, ["betaEmote"])})
+    ## Neither a worker's unfinished write nor an unreadable cache is used.
+    write_cache(f"{_worker_path(cache_path, 1)}.tmp", (400.0, ["Partial"]), {})
+    with open(_worker_path(cache_path, 2), "w", encoding="utf-8") as cache_file:
+        cache_file.write("{")
+
+    assert load_emote_sets(cache_path) == {"alpha" : frozenset({"Kappa", "LUL", "new"}),
+                                           "beta" : frozenset({"Kappa", "LUL", "betaEmote"}),
+                                           "gamma" : frozenset({"Kappa", "LUL", "gammaEmote"})}
+
+def test_missing_cache_has_no_sets(tmp_path) -> None:
+    assert load_emote_sets(os.path.join(tmp_path, "emotes.json")) == {}
+    ## Channel emotes are of no use without the global emotes they are used with.
+    write_cache(os.path.join(tmp_path, "emotes.0.json"), None, {"alpha" : (100.0, ["alphaEmote"])})
+    assert load_emote_sets(os.path.join(tmp_path, "emotes.json")) == {}
@@ -0,0 +1,62 @@
+import asyncio
+
+from Core.Helix import HelixClient
+from Core.Metrics import REGISTRY, Histogram
+from Tools.ReplayBenchmark import FakeHelix
+
+def test_concurrent_lookups_are_one_request() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix()
+        await helix.start()
+        helix.offline.add("beta")
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        try:
+            logins: list[str] = ["alpha", "beta", "gamma", "Alpha", "beta"] * 4
+            online: list[bool] = await asyncio.gather(*(client.is_online(login) for login in logins))
+            assert online == [True, False, True, True, False] * 4
+            assert helix.requests == 1
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
+
+def test_lookup_shares_request_in_flight() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix()
+        await helix.start()
+        helix.streams_delay = 0.2
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        try:
+            first: asyncio.Task = asyncio.get_running_loop().create_task(client.is_online("alpha"))
+            await asyncio.sleep(0.05)
+            ## Made in a later event loop iteration, while the first lookup is waiting on its response.
+            assert await client.is_online("alpha")
+            assert await first
+            assert helix.requests == 1
+
+            ## Once answered, a new lookup makes a new request.
+            assert await client.is_online("alpha")
+            assert helix.requests == 2
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
+
+def test_request_latency_is_recorded_per_endpoint() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix()
+        await helix.start()
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        try:
+            await client.get_user_ids(["alpha"])
+            histogram: Histogram = REGISTRY.get("olliebot_helix_request_seconds", {"endpoint" : "users"})
+            count: int = histogram.count
+            await client.get_user_ids(["beta"])
+            await client.request("GET", "/users", [("login", "gamma")])
+            ## Each request is observed in its endpoint's one histogram, however the endpoint was written.
+            assert REGISTRY.get("olliebot_helix_request_seconds", {"endpoint" : "users"}) is histogram
+            assert histogram.count == count + 2
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
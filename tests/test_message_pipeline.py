@@ -0,0 +1,69 @@
+import asyncio
+from typing import Optional
+
+from Core.IngestQueue import IngestQueue
+from Core.MessagePipeline import MessageKind, MessagePipeline
+
+class FakeChannel:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+
+class FakeMessage:
+    "Stands in for a received chat message, with only what the pipeline and ingest queue read."
+
+    def __init__(self, channel_name: str, content: str) -> None:
+        self.channel: FakeChannel = FakeChannel(channel_name)
+        self.content: str = content
+        self.tags: dict[str, str] = {}
+
+def test_every_received_message_is_counted_once() -> None:
+    async def scenario() -> None:
+        pipeline: MessagePipeline = MessagePipeline(prefix="?")
+        handled: list[str] = []
+        async def track(message: FakeMessage) -> None:
+            handled.append(message.content)
+        pipeline.add_passive_handler(track)
+        ingest: IngestQueue = IngestQueue(pipeline, max_passive=1, coalesce=False)
+
+        ## Only the first passive message fits in the channel's queue, the rest are shed but still received.
+        for content in ("first", "second", "?command", "third"):
+            ingest.submit(FakeMessage("channel", content))
+        await ingest.join()
+        assert handled == ["first"]
+        assert pipeline.received == 4
+        ## A message dispatched with its kind already known is not counted again.
+        await pipeline.dispatch(FakeMessage("channel", "fourth"), MessageKind.PASSIVE)
+        assert pipeline.received == 4
+        await pipeline.dispatch(FakeMessage("channel", "fifth"))
+        assert pipeline.received == 5
+    asyncio.run(scenario())
+
+class FakeEmotes:
+    "Stands in for the emote registry, knowing the emotes of only the channels given."
+
+    def __init__(self, emote_sets: dict[str, frozenset[str]]) -> None:
+        self.emote_sets: dict[str, frozenset[str]] = emote_sets
+
+    def get(self, channel_name: str) -> Optional[frozenset[str]]:
+        return self.emote_sets.get(channel_name)
+
+def test_pyramid_candidates_are_classified() -> None:
+    async def scenario() -> None:
+        pipeline: MessagePipeline = MessagePipeline(prefix="?", emotes=FakeEmotes({"known" : frozenset({"Kappa"})}))
+        assert pipeline.classify(FakeMessage("known", "Kappa Kappa")) & MessageKind.PYRAMID_CANDIDATE
+        assert not pipeline.classify(FakeMessage("known", "hello there")) & MessageKind.PYRAMID_CANDIDATE
+        ## In a channel whose emotes are not known, any word could build a pyramid.
+        assert pipeline.classify(FakeMessage("unknown", "hello there")) & MessageKind.PYRAMID_CANDIDATE
+
+        handled: list[str] = []
+        async def track(message: FakeMessage) -> None:
+            handled.append(message.content)
+        pipeline.add_passive_handler(track)
+        ingest: IngestQueue = IngestQueue(pipeline)
+        ## Repeated candidates are each a level of a pyramid, so only the repeated non-candidate is coalesced.
+        for channel_name, content in (("known", "Kappa"), ("known", "Kappa"), ("known", "hi"), ("known", "hi"),
+                                      ("unknown", "hi"), ("unknown", "hi")):
+            ingest.submit(FakeMessage(channel_name, content))
+        await ingest.join()
+        assert handled == ["Kappa", "Kappa", "hi", "hi", "hi"]
+    asyncio.run(scenario())
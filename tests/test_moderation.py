@@ -0,0 +1,80 @@
+import asyncio
+import time
+from typing import Optional
+
+from Core.Chatters import ChatterCache
+from Core.Helix import HelixClient
+from Core.Moderation import Moderation
+from Tools.ReplayBenchmark import FakeHelix, user_id
+
+def test_rate_limited_action_waits_for_reset() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix(rate_limited=1, rate_limit_reset=2)
+        await helix.start()
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        moderation: Moderation = Moderation(client, ChatterCache(client), "token", "olliebot", backoff=0.01)
+        try:
+            start: float = time.monotonic()
+            assert moderation.timeout("channel", "chatter", 60)
+            await moderation.join()
+            ## The reset is whole seconds of epoch time, so at least one second away, which outlasts the backoff.
+            assert time.monotonic() - start >= 0.9
+            assert helix.bans == [(user_id("channel"), user_id("olliebot"), user_id("chatter"), 60)]
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
+
+def test_repeated_actions_are_deduplicated() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix()
+        await helix.start()
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        moderation: Moderation = Moderation(client, ChatterCache(client), "token", "olliebot")
+        try:
+            assert moderation.timeout("channel", "chatter", 60)
+            assert not moderation.timeout("Channel", "Chatter", 60)
+            assert not moderation.timeout("channel", "chatter", 30)
+            ## A longer timeout, or a ban, replaces a shorter timeout.
+            assert moderation.timeout("channel", "chatter", 600)
+            assert moderation.ban("channel", "chatter")
+            assert not moderation.timeout("channel", "chatter", 6000)
+            assert not moderation.ban("channel", "chatter")
+            ## The same chatter in another channel is a different action.
+            assert moderation.timeout("other", "chatter", 60)
+            await moderation.join()
+            assert sorted(helix.bans, key=str) == sorted([(user_id("channel"), user_id("olliebot"), user_id("chatter"), 60),
+                                                          (user_id("channel"), user_id("olliebot"), user_id("chatter"), 600),
+                                                          (user_id("channel"), user_id("olliebot"), user_id("chatter"), None),
+                                                          (user_id("other"), user_id("olliebot"), user_id("chatter"), 60)], key=str)
+            ## The ids of every channel and chatter requested together are looked up in one request.
+            assert helix.requests == 5
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
+
+def test_actions_are_applied_as_the_channel_owner() -> None:
+    async def scenario() -> None:
+        helix: FakeHelix = FakeHelix()
+        await helix.start()
+        client: HelixClient = HelixClient("client", "token", base_url=helix.url)
+        def broadcaster_tokens(channel_name: str) -> Optional[tuple[int, str]]:
+            return (int(user_id("owned")), "owner-token") if channel_name == "owned" else None
+        moderation: Moderation = Moderation(client, ChatterCache(client), "token", "olliebot", broadcaster_tokens=broadcaster_tokens)
+        try:
+            assert moderation.timeout("owned", "chatter", 60)
+            assert moderation.timeout("other", "chatter", 60)
+            await moderation.join()
+            assert sorted(helix.bans) == sorted([(user_id("owned"), user_id("owned"), user_id("chatter"), 60),
+                                                 (user_id("other"), user_id("olliebot"), user_id("chatter"), 60)])
+
+            ## An owner's token that is no longer accepted falls back to the bot's.
+            helix.rejected_tokens.add("owner-token")
+            assert moderation.ban("owned", "spammer")
+            await moderation.join()
+            assert helix.bans[-1] == (user_id("owned"), user_id("olliebot"), user_id("spammer"), None)
+        finally:
+            await client.close()
+            await helix.close()
+    asyncio.run(scenario())
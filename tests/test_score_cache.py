@@ -0,0 +1,84 @@
+import os
+import sqlite3
+
+from Core.Chatters import surrogate_id
+from Core.ScoreCache import ScoreCache
+from Core.ScoreWriter import ScoreWriter, connect_writer
+
+def high_scores(connection: sqlite3.Connection, limit: int) -> list[tuple[str, int]]:
+    "The success leaders as the pyramid handler's high score query orders them."
+    return connection.execute("""
+                              SELECT chatter_name, success
+                              FROM pyramid_scores
+                              ORDER BY success DESC, chatter_name, user_id
+                              LIMIT :limit
+                              """, {"limit" : limit}).fetchall()
+
+def test_leaders_break_ties_as_the_high_score_query(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    connection: sqlite3.Connection = connect_writer(database_path)
+    with connection:
+        connection.executemany("INSERT INTO pyramid_scores VALUES (?, ?, ?, 0, 0, 0, 0)",
+                               [(1, "delta", 3), (2, "bravo", 3), (3, "echo", 3), (4, "alpha", 1), (5, "foxtrot", 1)])
+    writer: ScoreWriter = ScoreWriter(database_path)
+    try:
+        cache: ScoreCache = ScoreCache(connection, writer, top_k=2)
+        assert cache.get_high_scores("success", 2) == high_scores(connection, 2) == [("bravo", 3), ("delta", 3)]
+
+        ## Tying the last leader without coming before them by name does not enter the leaders.
+        cache.record(5, "foxtrot", "success")
+        cache.record(5, "foxtrot", "success")
+        assert cache.get_high_scores("success", 2) == [("bravo", 3), ("delta", 3)]
+        ## Tying the last leader and coming before them by name does.
+        cache.record(4, "alpha", "success")
+        cache.record(4, "alpha", "success")
+        assert cache.get_high_scores("success", 2) == [("alpha", 3), ("bravo", 3)]
+        assert writer.flush(timeout=5.0)
+        assert cache.get_high_scores("success", 2) == high_scores(connection, 2)
+
+        ## A leader's new name is shown even when their place does not change.
+        cache.record(2, "aardvark", "success")
+        assert cache.get_high_scores("success", 2) == [("aardvark", 4), ("alpha", 3)]
+    finally:
+        writer.close()
+        connection.close()
+
+def test_surrogate_results_are_claimed_by_the_real_id(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    connection: sqlite3.Connection = connect_writer(database_path)
+    with connection:
+        connection.executemany("INSERT INTO pyramid_scores VALUES (?, ?, ?, 0, 0, 0, 0)",
+                               [(1, "alpha", 5), (2, "bravo", 4), (3, "charlie", 1)])
+    writer: ScoreWriter = ScoreWriter(database_path)
+    try:
+        cache: ScoreCache = ScoreCache(connection, writer, top_k=2)
+        ## Recorded while bravo's id could not be looked up, the surrogate takes bravo's place in the leaders.
+        for _ in range(5):
+            cache.record(surrogate_id("bravo"), "bravo", "success")
+        assert cache.get_high_scores("success", 2) == [("alpha", 5), ("bravo", 5)]
+
+        cache.claim(2, "bravo")
+        assert cache.get_score(2, "success") == 9
+        assert cache.get_score(surrogate_id("bravo"), "success") is None
+        assert cache.get_high_scores("success", 2) == [("bravo", 9), ("alpha", 5)]
+        assert writer.flush(timeout=5.0)
+        assert cache.get_high_scores("success", 2) == high_scores(connection, 2)
+        assert connection.execute("SELECT COUNT(*) FROM pyramid_scores WHERE user_id < 0").fetchone() == (0,)
+
+        ## Leading under both ids, the chatter keeps one place, and the next chatter is not known until one enters.
+        for _ in range(10):
+            cache.record(surrogate_id("bravo"), "bravo", "success")
+        assert cache.get_high_scores("success", 2) == [("bravo", 10), ("bravo", 9)]
+        cache.claim(2, "bravo")
+        assert cache.get_high_scores("success", 1) == [("bravo", 19)]
+        assert cache.get_high_scores("success", 2) is None
+        cache.record(1, "alpha", "success")
+        assert cache.get_high_scores("success", 2) is None
+        for _ in range(14):
+            cache.record(1, "alpha", "success")
+        assert cache.get_high_scores("success", 2) == [("alpha", 20), ("bravo", 19)]
+        assert writer.flush(timeout=5.0)
+        assert cache.get_high_scores("success", 2) == high_scores(connection, 2)
+    finally:
+        writer.close()
+        connection.close()
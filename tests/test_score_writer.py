@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from Core.Chatters import surrogate_id
+from Core.ScoreWriter import (PyramidEventRow, ScoreMerge, ScoreWriter, connect_writer, dead_letter_file, merge_scores, period_start,
+                              replay_dead_letters)
+
+class FailingScoreWriter(ScoreWriter):
+    "A score writer whose next writes fail, as many as `failures`, or every write while `failing` is set."
+
+    def __init__(self, database_path: str, failures: int = 0, **options) -> None:
+        self.failures: int = failures
+        self.failing: bool = False
+        ## The monotonic time of each attempt to write.
+        self.attempts: list[float] = []
+        super().__init__(database_path, **options)
+
+    def _write(self,
+               connection: Optional[sqlite3.Connection],
+               batch: dict[int, list[int]],
+               names: dict[int, str],
+               events: list[PyramidEventRow],
+               merges: list[ScoreMerge]
+               ) -> None:
+        self.attempts.append(time.monotonic())
+        if self.failing or self.failures > 0:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        super()._write(connection, batch, names, events, merges)
+
+def read_scores(database_path: str) -> list[tuple]:
+    connection: sqlite3.Connection = sqlite3.connect(database_path)
+    try:
+        return connection.execute("SELECT * FROM pyramid_scores ORDER BY user_id").fetchall()
+    finally:
+        connection.close()
+
+def test_failed_batch_is_retried_with_backoff(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    writer: FailingScoreWriter = FailingScoreWriter(database_path, failures=3, flush_interval=0.05)
+    try:
+        writer.increment(1, "alpha", "success", size=3)
+        assert writer.flush(timeout=5.0)
+        assert len(writer.attempts) == 4
+        ## Each retry waits twice as long as the last.
+        gaps: list[float] = [later - earlier for earlier, later in zip(writer.attempts, writer.attempts[1:])]
+        assert gaps[0] >= 0.04 and gaps[1] >= 0.09 and gaps[2] >= 0.19
+        assert writer.abandoned == 0
+    finally:
+        writer.close()
+    assert read_scores(database_path) == [(1, "alpha", 1, 0, 0, 0, 3)]
+    assert not os.path.exists(dead_letter_file(database_path))
+
+def test_batch_is_given_up_after_retries_and_replayed(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    writer: FailingScoreWriter = FailingScoreWriter(database_path, flush_interval=0.01, max_retries=2)
+    writer.failing = True
+    try:
+        writer.increment(1, "alpha", "success", size=3, channel_name="channel")
+        writer.merge(-5, 1, "alpha")
+        ## A flush without a timeout still returns once the batch is given up on.
+        assert not writer.flush()
+        assert len(writer.attempts) == 3
+        assert writer.abandoned == 1
+
+        ## The writer goes on with later batches.
+        writer.failing = False
+        writer.increment(2, "beta", "failed")
+        assert writer.flush(timeout=5.0)
+    finally:
+        writer.close()
+    assert read_scores(database_path) == [(2, "beta", 0, 1, 0, 0, 0)]
+
+    connection: sqlite3.Connection = connect_writer(database_path)
+    try:
+        assert replay_dead_letters(connection, dead_letter_file(database_path)) == 1
+        assert (connection.execute("SELECT channel_name, user_id, chatter_name, result, size FROM pyramid_events").fetchall()
+                == [("channel", 1, "alpha", "success", 3)])
+    finally:
+        connection.close()
+    assert read_scores(database_path) == [(1, "alpha", 1, 0, 0, 0, 3), (2, "beta", 0, 1, 0, 0, 0)]
+    assert not os.path.exists(dead_letter_file(database_path))
+
+def test_close_gives_up_on_failing_writes(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    writer: FailingScoreWriter = FailingScoreWriter(database_path, flush_interval=60.0, max_backoff=60.0)
+    writer.failing = True
+    writer.increment(1, "alpha", "success")
+    assert not writer.flush(timeout=0.2)
+    writer.increment(2, "beta", "blocked")
+    ## Closing does not wait out the backoff, and saves both the retried batch and the one queued behind it.
+    start: float = time.monotonic()
+    writer.close()
+    assert time.monotonic() - start < 5.0
+    assert writer.abandoned == 2
+    with open(dead_letter_file(database_path), encoding="utf-8") as dead_letters:
+        assert len(dead_letters.readlines()) == 2
+
+def test_history_follows_renames(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    writer: ScoreWriter = ScoreWriter(database_path)
+    try:
+        writer.increment(1, "alpha", "success", size=3, channel_name="channel")
+        assert writer.flush(timeout=5.0)
+        writer.increment(1, "renamed", "success", size=5, channel_name="channel")
+        writer.increment(2, "alpha", "failed", channel_name="channel")
+        assert writer.flush(timeout=5.0)
+    finally:
+        writer.close()
+    connection: sqlite3.Connection = sqlite3.connect(database_path)
+    try:
+        ## The rollups are kept by user id, so a renamed chatter keeps one row, shown under their latest name.
+        assert (connection.execute("SELECT user_id, chatter_name, success, failed, biggest FROM pyramid_daily_scores ORDER BY user_id").fetchall()
+                == [(1, "renamed", 2, 0, 5), (2, "alpha", 0, 1, 0)])
+        assert connection.execute("SELECT user_id, chatter_name FROM pyramid_events ORDER BY time").fetchall() == [(1, "alpha"), (1, "renamed"), (2, "alpha")]
+    finally:
+        connection.close()
+
+def test_history_keyed_by_name_is_migrated(tmp_path) -> None:
+    database_path: str = os.path.join(tmp_path, "pyramids.sqlite3")
+    day: int = period_start(time.time(), "day")
+    connection: sqlite3.Connection = sqlite3.connect(database_path)
+    with connection:
+        connection.execute("""
+                           CREATE TABLE pyramid_scores (user_id INTEGER PRIMARY KEY, chatter_name varchar(255) NOT NULL,
+                                                        success int, failed int, blocked int, stolen int, biggest int)
+                           """)
+        connection.execute("INSERT INTO pyramid_scores VALUES (5, 'alpha', 2, 0, 0, 0, 3)")
+        connection.execute("""
+                           CREATE TABLE pyramid_events (time real NOT NULL, channel_name varchar(255) NOT NULL, chatter_name varchar(255) NOT NULL,
+                                                        result varchar(8) NOT NULL, size int NOT NULL, stolen_from varchar(255) NOT NULL)
+                           """)
+        connection.execute("CREATE INDEX pyramid_events_time ON pyramid_events (time)")
+        connection.executemany("INSERT INTO pyramid_events VALUES (?, 'channel', ?, ?, 3, '')",
+                               [(day + 1.0, "Alpha", "success"), (day + 2.0, "alpha", "success"), (day + 3.0, "ghost", "failed")])
+        connection.execute("""
+                           CREATE TABLE pyramid_daily_scores (period_start int NOT NULL, channel_name varchar(255) NOT NULL,
+                                                              chatter_name varchar(255) NOT NULL,
+                                                              success int, failed int, blocked int, stolen int, biggest int,
+                                                              PRIMARY KEY (channel_name, period_start, chatter_name))
+                           """)
+        connection.executemany("INSERT INTO pyramid_daily_scores VALUES (?, 'channel', ?, ?, ?, 0, 0, 3)",
+                               [(day, "Alpha", 1, 0), (day, "alpha", 1, 0), (day, "ghost", 0, 1)])
+    connection.close()
+
+    connection = connect_writer(database_path)
+    try:
+        ## Names are given their chatter's id from the score table, or a surrogate id if it has none.
+        assert (connection.execute("SELECT user_id, chatter_name, result FROM pyramid_events ORDER BY time").fetchall()
+                == [(5, "alpha", "success"), (5, "alpha", "success"), (surrogate_id("ghost"), "ghost", "failed")])
+        assert (connection.execute("SELECT user_id, chatter_name, success, failed FROM pyramid_daily_scores ORDER BY user_id").fetchall()
+                == [(surrogate_id("ghost"), "ghost", 0, 1), (5, "alpha", 2, 0)])
+        assert connection.execute("SELECT COUNT(*) FROM pyramid_events_by_name").fetchone() == (3,)
+
+        ## Resolving a surrogate id moves its history to the real id.
+        connection.execute("INSERT INTO pyramid_scores VALUES (?, 'ghost', 0, 1, 0, 0, 3)", (surrogate_id("ghost"),))
+        connection.commit()
+        assert merge_scores(connection, surrogate_id("ghost"), 9, "ghost")
+        assert connection.execute("SELECT user_id FROM pyramid_events WHERE chatter_name = 'ghost'").fetchall() == [(9,)]
+        assert (connection.execute("SELECT user_id, chatter_name, failed FROM pyramid_daily_scores ORDER BY user_id").fetchall()
+                == [(5, "alpha", 0), (9, "ghost", 1)])
+    finally:
+        connection.close()
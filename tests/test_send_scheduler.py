@@ -0,0 +1,68 @@
+import asyncio
+
+from Core.SendScheduler import FakeTransport, Priority, SendScheduler
+
+def sent_messages(transport: FakeTransport) -> list[tuple[str, str]]:
+    return [(channel_name, message) for _, channel_name, message in transport.sent]
+
+def test_messages_are_sent_by_priority_then_in_order() -> None:
+    async def scenario() -> None:
+        transport: FakeTransport = FakeTransport()
+        ## The limits allow every message at once, so only their priorities order them.
+        scheduler: SendScheduler = SendScheduler(transport, user_limit=(20, 1.0))
+        ## Every message is queued before the dispatcher first runs.
+        scheduler.submit("channel", "passive 1", Priority.PASSIVE)
+        scheduler.submit("channel", "reply 1", Priority.REPLY)
+        scheduler.submit("other", "passive 2", Priority.PASSIVE)
+        scheduler.submit("Channel", "moderation 1", Priority.MODERATION)
+        scheduler.submit("other", "reply 2", Priority.REPLY)
+        await scheduler.close()
+        assert sent_messages(transport) == [("channel", "moderation 1"),
+                                            ("channel", "reply 1"),
+                                            ("other", "reply 2"),
+                                            ("channel", "passive 1"),
+                                            ("other", "passive 2")]
+        assert scheduler.sent == 5
+    asyncio.run(scenario())
+
+def test_channel_rate_limit() -> None:
+    async def scenario() -> None:
+        transport: FakeTransport = FakeTransport()
+        scheduler: SendScheduler = SendScheduler(transport, user_limit=(2, 0.5))
+        for index in range(4):
+            scheduler.submit("channel", f"reply {index}")
+        scheduler.submit("other", "reply")
+        await asyncio.sleep(0.1)
+        ## The channel's burst is used up, but other channels have their own limit.
+        assert sent_messages(transport) == [("channel", "reply 0"), ("channel", "reply 1"), ("other", "reply")]
+        await scheduler.close()
+        assert [message for _, message in sent_messages(transport)] == ["reply 0", "reply 1", "reply", "reply 2", "reply 3"]
+        assert transport.sent[-1][0] - transport.sent[0][0] >= 0.4
+    asyncio.run(scenario())
+
+def test_full_queue_merges_then_drops_lowest_priority() -> None:
+    async def scenario() -> None:
+        transport: FakeTransport = FakeTransport()
+        scheduler: SendScheduler = SendScheduler(transport, max_queue_length=3, user_limit=(20, 1.0))
+        assert scheduler.submit("channel", "passive 1", Priority.PASSIVE)
+        assert scheduler.submit("channel", "passive 2", Priority.PASSIVE)
+        assert scheduler.submit("channel", "reply 1", Priority.REPLY)
+
+        ## An identical passive message is merged into the queued one.
+        assert not scheduler.submit("channel", "passive 1", Priority.PASSIVE)
+        assert scheduler.merged == 1
+        ## A reply drops the oldest passive message.
+        assert scheduler.submit("channel", "reply 2", Priority.REPLY)
+        ## A passive message replaces the oldest passive message left.
+        assert scheduler.submit("channel", "passive 3", Priority.PASSIVE)
+        ## A passive message is dropped itself once only replies are queued.
+        assert scheduler.submit("channel", "reply 3", Priority.REPLY)
+        assert not scheduler.submit("channel", "passive 4", Priority.PASSIVE)
+        assert scheduler.dropped == 4
+        ## Moderation messages are never dropped, even beyond the queue's length.
+        assert scheduler.submit("channel", "moderation 1", Priority.MODERATION)
+        assert scheduler.depth == 4
+
+        await scheduler.close()
+        assert [message for _, message in sent_messages(transport)] == ["moderation 1", "reply 1", "reply 2", "reply 3"]
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Callable
+
+from Core.Helix import HelixClient
+from Core.StreamStatus import StreamStatus
+from Tools.ReplayBenchmark import FakeEventSub, FakeHelix
+
+async def wait_until(condition: Callable[[], bool], timeout: float = 5.0) -> None:
+    "Wait for a condition to hold, failing the test if it does not within the timeout."
+    deadline: float = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "Timed out waiting for the condition."
+        await asyncio.sleep(0.01)
+
+class StandIns:
+    "The Helix and EventSub stand-ins, and a stream status tracker of the given channels connected to them."
+
+    def __init__(self, channel_names: list[str], poll_interval: float = 3600.0) -> None:
+        self.helix: FakeHelix = FakeHelix()
+        self.eventsub: FakeEventSub = FakeEventSub()
+        self.channel_names: list[str] = channel_names
+        self.poll_interval: float = poll_interval
+
+    async def __aenter__(self) -> "StandIns":
+        await self.helix.start()
+        await self.eventsub.start()
+        self.client: HelixClient = HelixClient("client", "token", base_url=self.helix.url)
+        self.status: StreamStatus = StreamStatus(self.client, eventsub_url=self.eventsub.url, poll_interval=self.poll_interval)
+        self.status.track(self.channel_names)
+        await self.status.start()
+        await wait_until(lambda: self.status.subscribed == len(self.channel_names))
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.status.close()
+        await self.client.close()
+        await self.eventsub.close()
+        await self.helix.close()
+
+def test_notifications_update_status() -> None:
+    async def scenario() -> None:
+        async with StandIns(["alpha", "beta"]) as stand_ins:
+            await wait_until(lambda: stand_ins.status.statuses() == {"alpha" : True, "beta" : True})
+            await stand_ins.eventsub.set_online("alpha", False)
+            await wait_until(lambda: not stand_ins.status.is_online("alpha"))
+            assert stand_ins.status.is_online("beta")
+            ## Each channel is subscribed to going online and offline.
+            assert len(stand_ins.helix.subscriptions) == 4
+    asyncio.run(scenario())
+
+def test_reconnect_keeps_subscriptions() -> None:
+    async def scenario() -> None:
+        async with StandIns(["alpha"]) as stand_ins:
+            await wait_until(lambda: stand_ins.status.is_online("alpha"))
+            ## The new connection is welcomed with a poll catching up on changes, which sees the channel go offline.
+            stand_ins.helix.offline.add("alpha")
+            await stand_ins.eventsub.reconnect()
+            await wait_until(lambda: not stand_ins.status.is_online("alpha"))
+            await wait_until(lambda: stand_ins.eventsub.connections == 1)
+            assert stand_ins.status.subscribed == 1
+            assert len(stand_ins.helix.subscriptions) == 2
+            await stand_ins.eventsub.set_online("alpha", True)
+            await wait_until(lambda: stand_ins.status.is_online("alpha"))
+    asyncio.run(scenario())
+
+def test_lost_session_resubscribes() -> None:
+    async def scenario() -> None:
+        async with StandIns(["alpha"]) as stand_ins:
+            await stand_ins.eventsub.disconnect()
+            ## A new session has none of the old session's subscriptions, so they are made again.
+            await wait_until(lambda: len(stand_ins.helix.subscriptions) == 4)
+            await wait_until(lambda: stand_ins.status.subscribed == 1)
+            await stand_ins.eventsub.set_online("alpha", False)
+            await wait_until(lambda: not stand_ins.status.is_online("alpha"))
+    asyncio.run(scenario())
+
+def test_revoked_channel_falls_back_to_polling() -> None:
+    async def scenario() -> None:
+        async with StandIns(["alpha", "beta"], poll_interval=0.2) as stand_ins:
+            await stand_ins.eventsub.revoke("alpha")
+            await wait_until(lambda: stand_ins.status.subscribed == 1)
+            stand_ins.helix.offline.add("alpha")
+            await wait_until(lambda: not stand_ins.status.is_online("alpha"))
+            assert stand_ins.status.is_online("beta")
+    asyncio.run(scenario())
+
+def test_poll_does_not_overwrite_later_notification() -> None:
+    async def scenario() -> None:
+        async with StandIns(["alpha"]) as stand_ins:
+            await wait_until(lambda: stand_ins.status.is_online("alpha"))
+            ## The poll is sent while the channel is live, and answered after it has gone offline.
+            stand_ins.helix.streams_delay = 0.3
+            poll: asyncio.Task = asyncio.get_running_loop().create_task(stand_ins.status.refresh())
+            await asyncio.sleep(0.1)
+            await stand_ins.eventsub.set_online("alpha", False)
+            await wait_until(lambda: not stand_ins.status.is_online("alpha"))
+            await poll
+            assert not stand_ins.status.is_online("alpha")
+
+            ## A poll sent after the notification is newer, and replaces it.
+            stand_ins.helix.streams_delay = 0.0
+            await stand_ins.status.refresh()
+            assert stand_ins.status.is_online("alpha")
+    asyncio.run(scenario())